@@ -0,0 +1,72 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from btbphylo import de_duplicate
+
+"""
+    Script for benchmarking de_duplicate.remove_duplicates on simulated
+    WGS samples of increasing size. For each number of rows, prints the
+    run time of remove_duplicates and of applying the rules of each
+    kwarg in turn with get_indexes_to_remove, and checks that both keep
+    the same samples.
+"""
+
+KWARGS = {"Outcome": "Pass", "flag": "BritishbTB", "pcMapped": "max",
+          "Ncount": "min"}
+
+
+def simulate(n_rows, submissions_fraction, seed=0):
+    rng = np.random.default_rng(seed)
+    n_submissions = max(1, int(n_rows * submissions_fraction))
+    return pd.DataFrame({
+        "Sample": [f"sample_{i}" for i in range(n_rows)],
+        "Submission": pd.Series(
+            rng.integers(0, n_submissions, n_rows)).astype(str),
+        "Outcome": rng.choice(["Pass", "LowQualData", "Contaminated"],
+                              n_rows, p=[0.8, 0.1, 0.1]),
+        "flag": rng.choice(["BritishbTB", "nonBritishbTB", "MicPin"],
+                           n_rows, p=[0.9, 0.05, 0.05]),
+        "pcMapped": np.round(rng.uniform(90, 100, n_rows), 1),
+        "Ncount": rng.integers(0, 5000, n_rows)})
+
+
+def apply_rules(df, **kwargs):
+    remaining_indexes = df.index
+    for column_name, value in kwargs.items():
+        remaining_indexes = remaining_indexes.difference(
+            de_duplicate.get_indexes_to_remove(df.loc[remaining_indexes],
+                                               column_name, value))
+    return df.drop(df.index.difference(remaining_indexes)).\
+        drop_duplicates(["Submission"])
+
+
+def run(n_rows, submissions_fraction):
+    for n in n_rows:
+        df = simulate(n, submissions_fraction)
+        start = time.perf_counter()
+        metadata, df_deduped = de_duplicate.remove_duplicates(df, **KWARGS)
+        print(f"{n} rows: remove_duplicates: "
+              f"{time.perf_counter() - start:.2f} s, "
+              f"{metadata['number_of_duplicate_WGS_submissions']} "
+              "duplicates")
+        start = time.perf_counter()
+        df_rules = apply_rules(df, **KWARGS)
+        print(f"{n} rows: get_indexes_to_remove per kwarg: "
+              f"{time.perf_counter() - start:.2f} s")
+        print(f"identical output: {df_deduped.equals(df_rules)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="benchmark_de_duplicate")
+    parser.add_argument("--n_rows", type=int, nargs="+",
+                        default=[100000, 1000000],
+                        help="numbers of simulated samples")
+    parser.add_argument("--submissions_fraction", type=float, default=0.9,
+                        help="number of simulated submissions, drawn at \
+                            random for each sample, as a fraction of the \
+                            number of samples")
+    args = parser.parse_args()
+    run(args.n_rows, args.submissions_fraction)
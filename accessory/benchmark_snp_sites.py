@@ -0,0 +1,76 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from btbphylo import alignment
+from btbphylo import utils
+
+"""
+    Script for benchmarking the native snp-sites engine against the
+    external 'snp-sites -c'. Runs both engines on a multi fasta, or on
+    a simulated alignment if none is given, prints their run times and
+    checks that their outputs are identical. The external tool is
+    skipped if snp-sites is not installed.
+"""
+
+
+def simulate(multi_fasta_path, n_samples, length, n_snps, seed=0):
+    rng = np.random.default_rng(seed)
+    reference = np.frombuffer(b"ACGT", dtype=np.uint8)[
+        rng.integers(0, 4, length)]
+    sites = rng.choice(length, n_snps, replace=False)
+    with open(multi_fasta_path, "wb") as f:
+        for i in range(n_samples):
+            sequence = reference.copy()
+            sequence[sites] = np.frombuffer(b"ACGT", dtype=np.uint8)[
+                rng.integers(0, 4, n_snps)]
+            # mask a few short runs with N
+            for start in rng.integers(0, length - 100, 5):
+                sequence[start:start + 100] = ord("N")
+            f.write(f">sample_{i}\n".encode())
+            f.write(sequence.tobytes() + b"\n")
+
+
+def run(multi_fasta_path, n_samples, length, n_snps):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        if multi_fasta_path is None:
+            multi_fasta_path = os.path.join(temp_dir, "multi_fasta.fas")
+            simulate(multi_fasta_path, n_samples, length, n_snps)
+        native_outpath = os.path.join(temp_dir, "native.fas")
+        start = time.perf_counter()
+        metadata, _ = alignment.snp_sites(native_outpath, multi_fasta_path)
+        print(f"native: {time.perf_counter() - start:.2f} s, "
+              f"{metadata['number_of_snps']} snps")
+        if not shutil.which("snp-sites"):
+            print("snp-sites: not installed")
+            return
+        snp_sites_outpath = os.path.join(temp_dir, "snps.fas")
+        start = time.perf_counter()
+        utils.run(["snp-sites", "-c", "-o", snp_sites_outpath,
+                   multi_fasta_path])
+        print(f"snp-sites: {time.perf_counter() - start:.2f} s")
+        with open(native_outpath, "rb") as native, \
+                open(snp_sites_outpath, "rb") as snp_sites:
+            identical = native.read() == snp_sites.read()
+        print(f"identical output: {identical}")
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="benchmark_snp_sites")
+    parser.add_argument("--multi_fasta_path", default=None,
+                        help="path to a multi fasta; simulated if not given")
+    parser.add_argument("--n_samples", type=int, default=500,
+                        help="number of simulated samples")
+    parser.add_argument("--length", type=int, default=4349904,
+                        help="length of the simulated alignment")
+    parser.add_argument("--n_snps", type=int, default=10000,
+                        help="number of simulated snp sites")
+    args = parser.parse_args()
+    run(args.multi_fasta_path, args.n_samples, args.length, args.n_snps)
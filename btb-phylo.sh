@@ -75,6 +75,7 @@ else
 fi
 
 ALL_SAMPLES="$(dirname $(realpath $0))/all_wgs_samples.csv"
+MANIFEST="$(dirname $(realpath $0))/all_wgs_samples_manifest.json"
 
 # if running with docker 
 if [ $DOCKER == 1 ]; then
@@ -85,6 +86,8 @@ if [ $DOCKER == 1 ]; then
             "matches,mismatches,noCoverage,anomalous,Ncount,ResultLoc,ID,TotalReads,Abundance,"\
             "Submission" > $ALL_SAMPLES
     fi
+    # an empty manifest is treated as missing
+    touch $MANIFEST
     if [ ! -d $RESULTS ]
     then
         mkdir $RESULTS
@@ -97,6 +100,7 @@ if [ $DOCKER == 1 ]; then
             --mount type=bind,source=$RESULTS,target=/results \
             --mount type=bind,source=$CONSENSUS,target=/consensus \
             --mount type=bind,source=$ALL_SAMPLES,target=/btb-phylo/all_wgs_samples.csv \
+            --mount type=bind,source=$MANIFEST,target=/btb-phylo/all_wgs_samples_manifest.json \
             --mount type=bind,source=$CATTLE_AND_MOVEMENT,target=/btb-phylo/cattle_and_movement \
             aphacsubot/btb-phylo:prod /results /consensus -j $THREADS -m cattle_and_movement 
     else
@@ -108,6 +112,7 @@ if [ $DOCKER == 1 ]; then
             --mount type=bind,source=$CONSENSUS,target=/consensus \
             --mount type=bind,source=$CONFIG_PATH,target=/config.json \
             --mount type=bind,source=$ALL_SAMPLES,target=/btb-phylo/all_wgs_samples.csv \
+            --mount type=bind,source=$MANIFEST,target=/btb-phylo/all_wgs_samples_manifest.json \
             aphacsubot/btb-phylo:$branch /results /consensus -c /config.json -j $THREADS
     fi
 # if not running with docker (or running inside the docker container)
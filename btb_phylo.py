@@ -13,12 +13,22 @@ import threading
 import pandas as pd
 
 import btbphylo.utils as utils
+import btbphylo.storage as storage
 import btbphylo.update_summary as update_summary
 import btbphylo.de_duplicate as de_duplicate
 import btbphylo.consistify as consistify
 import btbphylo.missing_samples_report as missing_samples_report
 import btbphylo.filter_samples as filter_samples
 import btbphylo.phylogeny as phylogeny
+import btbphylo.consensus_cache as consensus_cache
+import btbphylo.alignment as alignment
+import btbphylo.distances as distances
+import btbphylo.incremental as incremental
+import btbphylo.variant_profiles as variant_profiles
+import btbphylo.snp_matrix as snp_matrix
+import btbphylo.neighbour_joining as neighbour_joining
+import btbphylo.mega as mega
+import btbphylo.placement as placement
 
 DEFAULT_CLADE_INFO_PATH = \
     os.path.join(os.path.dirname(os.path.abspath(__file__)),
@@ -30,13 +40,18 @@ DEFAULT_OUTLIERS_PATH = \
 
 
 def update_samples(results_path,
-                   all_wgs_samples_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH):
+                   all_wgs_samples_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH,
+                   download_workers=update_summary.DEFAULT_DOWNLOAD_WORKERS,
+                   s3_prefixes=update_summary.DEFAULT_FINALOUT_PREFIXES,
+                   listing_ttl=0, partition_by="group"):
     """
         Updates the local copy of the 'all_wgs_samples' .csv file
         containing WGS metadata for all WGS samples. Or builds a new
         file from scratch if it does not already exist. Downloads all
-        FinalOut.csv files from s3-csu-003 and appends them to the a
-        pandas DataFrame and saves the data to csv.
+        new or reprocessed FinalOut.csv files from s3-csu-003 and
+        appends them to the a pandas DataFrame and saves the data to
+        csv. Ingested FinalOut.csv files are recorded in a manifest
+        alongside the summary csv.
 
         Parameters:
             results_path (str): output path to results directory
@@ -44,6 +59,19 @@ def update_samples(results_path,
             all_wgs_samples_filepath (str): path to location of
             summary csv
 
+            download_workers (int): maximum number of concurrent s3
+            requests when listing and downloading FinalOut.csv files
+
+            s3_prefixes (list): prefixes in s3-csu-003 to search for
+            FinalOut.csv files, e.g. one per btb-seq pipeline version
+
+            listing_ttl (float): age in seconds below which a cached
+            listing of s3-csu-003 is reused instead of listing again
+
+            partition_by (str): partitioning of the summary if it is
+            saved as parquet, i.e. all_wgs_samples_filepath has a
+            '.parquet' extension: 'group' (clade) or 'batch'
+
         Returns:
             metadata (dict): metadata relating to the complete
             (unfiltered) dataset
@@ -59,26 +87,53 @@ def update_samples(results_path,
     print("\tloading all_wgs_samples.csv ... \n")
     # download sample summary csv
     df_all_wgs = update_summary.get_df_wgs(all_wgs_samples_filepath)
+    # load the ingestion manifest
+    manifest_filepath = \
+        update_summary.get_manifest_filepath(all_wgs_samples_filepath)
+    manifest = update_summary.load_manifest(manifest_filepath)
     # printing in separate thread
     t = threading.Thread(target=utils.process_print,
                          args=("\tgetting s3 keys for batch summary files",),
                          daemon=True)
     t.start()
-    # get s3 keys of FinalOut.csv for new batches of samples
-    new_keys = update_summary.new_final_out_keys(df_all_wgs)
+    # list FinalOut.csv objects (or use a cached listing)
+    finalout_objects = \
+        update_summary.list_finalout_objects(manifest, s3_prefixes,
+                                             download_workers, listing_ttl)
+    # if all_wgs_samples.csv pre-dates the manifest, record its batches
+    if not manifest["ingested"]:
+        update_summary.seed_manifest(manifest, df_all_wgs, finalout_objects)
+    # get s3 keys of FinalOut.csv for new and reprocessed batches of samples
+    new_keys, changed_keys = \
+        update_summary.new_final_out_keys(finalout_objects, manifest)
     # terminate printing thread
     t.running = False
     t.join()
+    print(f"\t{len(new_keys)} new and {len(changed_keys)} reprocessed batches "
+          "\n")
     print("\tappending new metadata to df_summary ... \n")
     # update the summary dataframe
-    df_all_wgs_updated, metadata = update_summary.append_df_wgs(df_all_wgs,
-                                                                new_keys)
+    df_all_wgs_updated, metadata = \
+        update_summary.append_df_wgs(df_all_wgs, new_keys,
+                                     n_workers=download_workers,
+                                     reprocessed_keys=changed_keys)
+    metadata["number_of_new_batches"] = len(new_keys)
+    metadata["number_of_reprocessed_batches"] = len(changed_keys)
     print("\tsaving all_wgs_samples.csv ... \n")
-    # save summary to csv
-    utils.df_to_csv(df_all_wgs_updated, all_wgs_samples_filepath)
+    # save summary to csv (or parquet)
+    utils.save_wgs_samples(df_all_wgs_updated, all_wgs_samples_filepath,
+                           partition_by)
+    # record successfully ingested batches in the manifest
+    ingested_keys = set(new_keys + changed_keys) - \
+        set(metadata.get("failed_batch_summaries", {}))
+    update_summary.update_manifest(manifest,
+                                   [s3_object for s3_object in finalout_objects
+                                    if s3_object["Key"] in ingested_keys])
+    update_summary.save_manifest(manifest, manifest_filepath)
     # copy all_wgs_samples.csv to metadata
-    shutil.copy(all_wgs_samples_filepath, os.path.join(metadata_path,
-                                                       "all_wgs_samples.csv"))
+    utils.export_wgs_samples_csv(all_wgs_samples_filepath,
+                                 os.path.join(metadata_path,
+                                              "all_wgs_samples.csv"))
     return metadata, df_all_wgs_updated
 
 
@@ -120,7 +175,7 @@ def de_duplicate_samples(results_path, df_wgs_samples=None,
     # load df_samples from summary csv if dataframe not provided
     if df_wgs_samples is None:
         print("\tloading all_wgs_samples.csv ... \n")
-        df_wgs_samples = utils.wgs_csv_to_df(all_wgs_samples_filepath)
+        df_wgs_samples = utils.load_wgs_samples(all_wgs_samples_filepath)
     # printing in seperate thread
     t = threading.Thread(target=utils.process_print,
                          args=("\tremoving duplicate WGS samples",),
@@ -138,8 +193,9 @@ def de_duplicate_samples(results_path, df_wgs_samples=None,
     df_wgs_deduped.to_csv(os.path.join(metadata_path,
                           "deduped_wgs.csv"), index=False)
     # copy all_wgs_samples.csv to metadata
-    shutil.copy(all_wgs_samples_filepath, os.path.join(metadata_path,
-                "all_wgs_samples.csv"))
+    utils.export_wgs_samples_csv(all_wgs_samples_filepath,
+                                 os.path.join(metadata_path,
+                                              "all_wgs_samples.csv"))
     return metadata, df_wgs_deduped
 
 
@@ -201,7 +257,7 @@ def consistify_samples(results_path, cattle_movements_path, df_wgs_samples=None,
     # load
     print("\tloading metadata files ... \n")
     if df_wgs_samples is None:
-        df_wgs_samples = utils.wgs_csv_to_df(all_wgs_samples_filepath)
+        df_wgs_samples = utils.load_wgs_samples(all_wgs_samples_filepath)
     df_cattle_samples = pd.read_csv(cattle_filepath, dtype=object)
     df_movement_samples = pd.read_csv(movement_filepath, dtype=object)
     # printing in seperate thread
@@ -224,8 +280,9 @@ def consistify_samples(results_path, cattle_movements_path, df_wgs_samples=None,
     shutil.copy(cattle_filepath, os.path.join(metadata_path, "cattle.csv"))
     shutil.copy(movement_filepath, os.path.join(metadata_path, "movement.csv"))
     # copy all_wgs_samples.csv to metadata
-    shutil.copy(all_wgs_samples_filepath, os.path.join(metadata_path,
-                                                       "all_wgs_samples.csv"))
+    utils.export_wgs_samples_csv(all_wgs_samples_filepath,
+                                 os.path.join(metadata_path,
+                                              "all_wgs_samples.csv"))
     return metadata, df_wgs_consist
 
 
@@ -271,15 +328,19 @@ def sample_filter(results_path, df_wgs_samples=None, allow_wipe_out=False,
             'Pass' only samples filtered according to criteria set out
             in arguments
 
-            df_wgs_samples (pandas DataFrame object): see parameters
+            df_wgs_samples (pandas DataFrame object): see parameters;
+            None if not provided and all_wgs_samples_filepath is a
+            parquet dataset
     """
     print("\n## Filter Samples ##\n")
     # create metadatapath
     metadata_path = os.path.join(results_path, "metadata")
     if not os.path.exists(metadata_path):
         os.makedirs(metadata_path)
-    # if no sample set provided
-    if df_wgs_samples is None:
+    # if no sample set provided: load csv. A parquet dataset is read
+    # while filtering so that only matching row groups are loaded
+    if df_wgs_samples is None and \
+            not utils.is_parquet(all_wgs_samples_filepath):
         print("\tloading all_wgs_samples.csv ... \n")
         df_wgs_samples = utils.wgs_csv_to_df(all_wgs_samples_filepath)
     if config:
@@ -306,13 +367,27 @@ def sample_filter(results_path, df_wgs_samples=None, allow_wipe_out=False,
     utils.df_to_csv(df_wgs_passed, os.path.join(metadata_path,
                     "passed_wgs.csv"))
     # copy all_wgs_samples.csv to metadata
-    shutil.copy(all_wgs_samples_filepath,
-                os.path.join(metadata_path, "all_wgs_samples.csv"))
+    utils.export_wgs_samples_csv(all_wgs_samples_filepath,
+                                 os.path.join(metadata_path,
+                                              "all_wgs_samples.csv"))
     return metadata, filter_args, df_wgs_passed, df_wgs_samples
 
 
 def phylo(results_path, consensus_path, download_only=False, n_threads=1,
-          build_tree=False, df_wgs=None, light_mode=False):
+          build_tree=False, df_wgs=None, light_mode=False,
+          download_workers=phylogeny.DEFAULT_DOWNLOAD_WORKERS,
+          consensus_cache_gb=None, consensus_encoding="fasta",
+          assembly="serial", check_lengths=False, streaming=False,
+          engine="snp-sites", dists_engine="snp-dists", checkpoint=False,
+          previous_state_path=None,
+          reference_path=None, matrix_format="csv", max_distance=None,
+          per_clade=False, cross_clade_summary=False,
+          cross_clade_sample=None, tree_method="mp", bootstraps=None,
+          mega_threads=mega.DEFAULT_THREADS,
+          initial_trees=mega.DEFAULT_INITIAL_TREES,
+          search_level=mega.DEFAULT_SEARCH_LEVEL, previous_tree_path=None,
+          placement_method="parsimony",
+          spr_radius=placement.DEFAULT_SPR_RADIUS):
     """
         Runs phylogeny on WGS samples: Downloads consensus files,
         concatenates into 1 large fasta file, runs snp-sites, runs
@@ -328,9 +403,12 @@ def phylo(results_path, consensus_path, download_only=False, n_threads=1,
             download_only (bool): only download consensus
             (do not run phylogeny)
 
-            n_threads (int): number of threads for snp-dists
+            n_threads (int): number of threads for snp-dists or the
+            native snp matrix, or of worker processes for a checkpointed
+            native snp matrix, see checkpoint
 
-            build_tree (bool): build a phylogentic tree with megacc
+            build_tree (bool): build a phylogentic tree, see
+            tree_method
 
             df_wgs (pandas DataFrame object): wgs samples on which to
             perform phylogeny
@@ -344,6 +422,110 @@ def phylo(results_path, consensus_path, download_only=False, n_threads=1,
 
             dash_c (bool): whether to run snp-sites with '-c'
 
+            download_workers (int): maximum number of concurrent
+            consensus downloads
+
+            consensus_cache_gb (float): size budget of the consensus
+            cache in consensus_path, in GB; None for no limit
+
+            consensus_encoding (str): "fasta" or "2bit", on-disk
+            encoding of newly cached consensus files
+
+            assembly (str): "serial" or "parallel" (positional)
+            assembly of the multi fasta. Parallel assembly leaves out
+            samples whose sequence length differs from the reference
+            length: that of reference_path if given, otherwise
+            phylogeny.REFERENCE_LENGTH
+
+            check_lengths (bool): with serial assembly, also leave out
+            samples whose sequence length differs from the reference
+            length; by default every sample is added
+
+            streaming (bool): pipe snp-sites straight into snp-dists;
+            snps.fas is only written if a tree is built
+
+            engine (str): "snp-sites", "native" or "profiles", the
+            engine used to find variable sites; the native engines also
+            save the site positions to metadata/snp_positions.csv. The
+            "profiles" engine derives the snp alignment from variant
+            profiles of each consensus against reference_path rather
+            than from a multi fasta
+
+            dists_engine (str): "snp-dists" or "native", the engine
+            used to build the snp matrix; if both engines are native
+            the alignment state is saved to results_path/state
+
+            checkpoint (bool): with the native dists engine, compute the
+            snp matrix in tiles checkpointed to results_path/tiles so
+            that an interrupted run resumes where it stopped; matrices
+            of at least distances.CHECKPOINT_MIN_SEQUENCES samples are
+            always checkpointed. The tiles are removed once the matrix
+            is written.
+
+            previous_state_path (str): optional path to the alignment
+            state of a previous run to update rather than rebuilding
+            the snp matrix; requires the native engines
+
+            reference_path (str): path to the reference fasta for the
+            "profiles" engine
+
+            matrix_format (str): "csv" to save the snp matrix to
+            snps.csv or "npy" to save its upper triangle to snps.npy
+            with a sample index, snps_samples.json, instead; see
+            btbphylo.snp_matrix
+
+            max_distance (int): with the native dists engine, only find
+            pairs of samples within max_distance snps of each other and
+            save them to snps_edges.csv rather than building the snp
+            matrix
+
+            per_clade (bool): with the native dists engine, build a snp
+            matrix per clade ('group') in results_path/clades rather
+            than one for all samples
+
+            cross_clade_summary (bool): with per_clade, also save the
+            minimum distance between each pair of clades to
+            results_path/clades/cross_clade_minimums.csv. At worst as
+            costly as the full snp matrix, see
+            distances.cross_clade_minimums()
+
+            cross_clade_sample (int): with cross_clade_summary, only
+            compare the cross_clade_sample samples of each clade nearest
+            the other clade, for an upper bound on each minimum; None to
+            compare all
+
+            tree_method (str): "mp" to build a maximum parsimony tree
+            with megacc or "nj" to build a neighbour-joining tree
+            natively, saved to results_path/mega/nj_tree.nwk
+
+            bootstraps (int): number of bootstrap replicates; None for
+            100 for a neighbour-joining tree, built by n_threads
+            processes, and 200 for a maximum parsimony tree
+
+            mega_threads (int): number of threads per megacc job; the
+            bootstrap replicates of a maximum parsimony tree are split
+            into blocks, one per megacc job, or with per_clade the trees
+            of each clade are built, as many jobs at a time as fit in
+            the machine's CPUs
+
+            initial_trees (int): number of initial trees (random
+            addition) of a maximum parsimony tree
+
+            search_level (int): search level of a maximum parsimony tree
+
+            previous_tree_path (str): optional path to the tree of a
+            previous run, in Newick format, to update with build_tree
+            rather than building a tree: samples no longer included are
+            pruned and new samples are placed on it, see placement. The
+            tree is saved to results_path/mega/placed_tree.nwk; if it
+            cannot be updated a tree is built with tree_method.
+
+            placement_method (str): "parsimony" or "distance" placement
+            of new samples on the previous tree
+
+            spr_radius (int): radius, in branches, of the SPR clean-up
+            around placed samples; 0 for none
+
         Returns:
             metadata (dict): phylogeny related metadata
     """
@@ -379,26 +561,254 @@ def phylo(results_path, consensus_path, download_only=False, n_threads=1,
     multi_fasta_path = os.path.join(fasta_path, "multi_fasta.fas")
     snp_sites_outpath = os.path.join(fasta_path, "snps.fas")
     snp_dists_outpath = os.path.join(results_path, "snps.csv")
+    edge_list_outpath = os.path.join(results_path, "snps_edges.csv")
+    clades_path = os.path.join(results_path, "clades")
     tree_path = os.path.join(results_path, "mega")
+    state_path = os.path.join(results_path, "state")
+    tiles_path = os.path.join(results_path, "tiles")
+    if previous_state_path and (engine, dists_engine) != ("native", "native"):
+        raise ValueError("Updating a previous state requires the native \
+            engines")
+    if engine == "profiles" and not reference_path:
+        raise ValueError("The profiles engine requires a reference")
+    if max_distance is not None and \
+            (dists_engine != "native" or previous_state_path or per_clade):
+        raise ValueError("max_distance requires the native dists engine \
+            and cannot update a previous state or build per clade matrices")
+    if per_clade and (dists_engine != "native" or previous_state_path):
+        raise ValueError("per_clade requires the native dists engine and \
+            cannot update a previous state")
+    if previous_tree_path and per_clade:
+        raise ValueError("Updating a previous tree cannot build per clade \
+            trees")
+    # the consensus of samples removed since the previous state are kept
+    # in the cache until the state is updated
+    previous_state = incremental.load_state(previous_state_path) \
+        if previous_state_path else None
+    keep_samples = list(df_wgs["Sample"]) + \
+        (previous_state["samples"] if previous_state else [])
     print("\n## Phylogeny ##\n")
-    # concatonate fasta files
-    phylogeny.build_multi_fasta(multi_fasta_path, df_wgs, consensus_path)
-    if not download_only:
+    # resolve every consensus object before downloading
+    print("\tchecking consensus objects ... \n")
+    consensus_objects, skipped = \
+        phylogeny.preflight_consensus(df_wgs, download_workers)
+    for sample, reason in skipped.items():
+        print(f"\t\tskipping sample {sample}: {reason}")
+    cache = consensus_cache.ConsensusCache(
+        consensus_path, None if consensus_cache_gb is None
+        else int(consensus_cache_gb * 1e9), consensus_encoding)
+    reference = variant_profiles.load_reference(reference_path) \
+        if reference_path else None
+    reference_length = phylogeny.REFERENCE_LENGTH if reference is None \
+        else len(reference)
+    if engine == "profiles":
+        profile_store = variant_profiles.ProfileStore(
+            os.path.join(consensus_path, "profiles"), reference)
+    try:
+        # download missing and out of date consensus files
+        print("\tdownloading consensus files ... \n")
+        skipped.update(phylogeny.download_consensus(consensus_objects, cache,
+                                                    download_workers))
+        if engine == "profiles":
+            # profile new consensus files instead of concatenating them
+            print("\tprofiling consensus files ... \n")
+            skipped.update(profile_store.update(
+                [sample for sample in df_wgs["Sample"]
+                 if sample not in skipped], cache))
+        elif assembly == "parallel":
+            # concatonate fasta files
+            print("\tassembling multi fasta ... \n")
+            try:
+                skipped.update(phylogeny.assemble_multi_fasta(
+                    multi_fasta_path, df_wgs, cache, skipped,
+                    reference_length=reference_length))
+            except consensus_cache.CorruptCacheError as e:
+                print(f"\t\t{e.message}: falling back to serial assembly")
+                skipped.update(phylogeny.build_multi_fasta(
+                    multi_fasta_path, df_wgs, cache, skipped,
+                    reference_length))
+        else:
+            # concatonate fasta files
+            print("\tassembling multi fasta ... \n")
+            skipped.update(phylogeny.build_multi_fasta(
+                multi_fasta_path, df_wgs, cache, skipped,
+                reference_length if check_lengths else None))
+        metadata["number_of_skipped_samples"] = len(skipped)
+        pd.DataFrame({"Sample": list(skipped),
+                      "Reason": list(skipped.values())}
+                     ).to_csv(os.path.join(metadata_path,
+                                           "skipped_samples.csv"),
+                              index=False)
+        # keep the consensus cache within its size budget
+        cache.evict(keep=keep_samples)
+    finally:
+        cache.save()
+        if engine == "profiles":
+            profile_store.save(samples=list(cache.index))
+            metadata["variant_profiles"] = profile_store.stats
+    metadata["consensus_cache"] = cache.metadata()
+    # snp-sites is piped into snp-dists if both external engines stream
+    streamed = streaming and engine == "snp-sites" and \
+        dists_engine == "snp-dists"
+    # the native engines build the snp matrix from the alignment state
+    from_state = engine == dists_engine == "native" and \
+        max_distance is None and not per_clade
+    if not download_only and from_state:
+        # samples in the order of the multi fasta
+        samples = [sample for sample in df_wgs["Sample"]
+                   if sample not in skipped]
+        etags = [cache.index[sample].get("ETag") for sample in samples]
+        state = None
+        if previous_state:
+            # update the previous run's snp matrix
+            print("\tupdating snp matrix ... \n")
+            try:
+                state, metadata["incremental"] = incremental.update_state(
+                    previous_state, multi_fasta_path, samples, etags, cache,
+                    n_threads)
+            except incremental.IncompatibleStateError as e:
+                print(f"\t\t{e.message}: rebuilding")
+                metadata["incremental"] = {"rebuilt": e.message}
+        if state is None:
+            # find snp sites and build the snp matrix natively
+            print("\tbuilding snp matrix ... \n")
+            checkpoint_path = tiles_path if distances.use_checkpoint(
+                len(samples), checkpoint) else None
+            state = incremental.build_state(multi_fasta_path, samples, etags,
+                                            n_threads, checkpoint_path)
+        incremental.write_outputs(state, snp_sites_outpath, snp_dists_outpath,
+                                  matrix_format)
+        distances.remove_checkpoint(tiles_path)
+        incremental.save_state(state_path, state)
+        metadata["number_of_snps"] = len(state["positions"])
+        pd.DataFrame({"Position": state["positions"] + 1}).to_csv(
+            os.path.join(metadata_path, "snp_positions.csv"), index=False)
+    elif not download_only and engine == "profiles":
+        # find snp sites from variant profiles
+        print("\tfinding snp sites ... \n")
+        profiles = [profile_store.get(sample) for sample in df_wgs["Sample"]
+                    if sample not in skipped]
+        positions = variant_profiles.snp_sites(profiles)
+        codes = variant_profiles.snp_codes(profiles, profile_store.reference,
+                                           positions)
+        names = [profile["name"] for profile in profiles]
+        alignment.write_codes(snp_sites_outpath, names, codes)
+        metadata["number_of_snps"] = len(positions)
+        pd.DataFrame({"Position": positions + 1}).to_csv(
+            os.path.join(metadata_path, "snp_positions.csv"), index=False)
+    elif not download_only and engine == "native":
+        # find snp sites natively
+        print("\tfinding snp sites ... \n")
+        metadata_sites, positions = alignment.snp_sites(snp_sites_outpath,
+                                                        multi_fasta_path)
+        metadata.update(metadata_sites)
+        pd.DataFrame({"Position": positions + 1}).to_csv(
+            os.path.join(metadata_path, "snp_positions.csv"), index=False)
+    elif not download_only and streamed:
+        # run snp-sites piped into snp-dists
+        print("\trunning snp_sites | snp_dists ... \n")
+        metadata.update(phylogeny.snp_sites_to_snp_matrix(
+            snp_dists_outpath, multi_fasta_path, n_threads,
+            snp_sites_outpath if build_tree else None))
+    elif not download_only:
         # run snp-sites
         print("\trunning snp_sites ... \n")
         metadata.update(phylogeny.snp_sites(snp_sites_outpath,
                                             multi_fasta_path))
+    if not download_only and dists_engine == "native" and not from_state:
+        names, bitsets = distances.encode_alignment(snp_sites_outpath)
+        if max_distance is not None:
+            # find close pairs natively
+            print("\tfinding close pairs ... \n")
+            metadata["close_pairs"] = distances.build_edge_list(
+                edge_list_outpath, names, bitsets, max_distance, n_threads)
+        elif per_clade:
+            # build a snp matrix per clade natively; sequences are in
+            # the order of the samples
+            print("\tbuilding snp matrices per clade ... \n")
+            clades = phylogeny.clade_indices(df_wgs, skipped)
+            snp_matrix.save_clade_matrices(
+                clades_path,
+                {clade: [names[i] for i in indices]
+                 for clade, indices in clades.items()},
+                distances.clade_distances(bitsets, clades, n_threads),
+                matrix_format,
+                distances.cross_clade_minimums(
+                    bitsets, clades, n_threads,
+                    max_sequences=cross_clade_sample)
+                if cross_clade_summary else None)
+            metadata["per_clade"] = {
+                "number_of_clades": len(clades),
+                "number_of_pairs": sum(len(indices) * (len(indices) - 1) // 2
+                                       for indices in clades.values()),
+                "number_of_pairs_in_full_matrix":
+                    len(names) * (len(names) - 1) // 2}
+        else:
+            # build the snp matrix natively
+            print("\tbuilding snp matrix ... \n")
+            checkpoint_path = tiles_path if distances.use_checkpoint(
+                len(names), checkpoint) else None
+            snp_matrix.save_matrix(
+                snp_dists_outpath, names,
+                distances.distance_matrix(bitsets, n_threads,
+                                          checkpoint_path),
+                matrix_format)
+            distances.remove_checkpoint(tiles_path)
+    elif not download_only and dists_engine == "snp-dists" and not streamed:
         # run snp-dists
         print("\trunning snp_dists ... \n")
         phylogeny.build_snp_matrix(snp_dists_outpath,
                                    snp_sites_outpath,
                                    n_threads)
-        if build_tree:
-            if not os.path.exists(tree_path):
-                os.makedirs(tree_path)
-            # build tree
-            print("\trunning mega ... \n")
-            phylogeny.build_tree(tree_path, snp_sites_outpath)
+    if not download_only and dists_engine == "snp-dists" and \
+            matrix_format == "npy":
+        # convert the output of snp-dists to a binary snp matrix
+        snp_matrix.csv_to_triangle(
+            snp_matrix.matrix_filepath(snp_dists_outpath), snp_dists_outpath)
+        os.remove(snp_dists_outpath)
+    if not download_only and build_tree:
+        if not os.path.exists(tree_path):
+            os.makedirs(tree_path)
+        placed = False
+        if previous_tree_path:
+            # place new samples on the previous run's tree
+            print("\tupdating tree ... \n")
+            try:
+                metadata["placement"] = placement.update_tree(
+                    previous_tree_path, tree_path, snp_sites_outpath,
+                    placement_method, spr_radius)
+                placed = True
+            except placement.IncompatibleTreeError as e:
+                print(f"\t\t{e.message}: rebuilding")
+                metadata["placement"] = {"rebuilt": e.message}
+        if not placed:
+            if tree_method == "nj":
+                # build a neighbour-joining tree natively
+                print("\tbuilding neighbour-joining tree ... \n")
+                neighbour_joining.build_tree(
+                    tree_path, snp_sites_outpath,
+                    neighbour_joining.DEFAULT_BOOTSTRAPS
+                    if bootstraps is None else bootstraps, n_threads)
+            elif per_clade:
+                # build a tree per clade
+                print("\trunning mega per clade ... \n")
+                names = [name.decode() for name, _ in
+                         alignment.fasta_records(snp_sites_outpath)]
+                metadata.update(mega.build_clade_trees(
+                    tree_path, snp_sites_outpath,
+                    {clade: [names[i] for i in indices] for clade, indices in
+                     phylogeny.clade_indices(df_wgs, skipped).items()},
+                    mega_threads, mega.DEFAULT_BOOTSTRAPS
+                    if bootstraps is None else bootstraps,
+                    initial_trees, search_level))
+            else:
+                # build tree
+                print("\trunning mega ... \n")
+                metadata.update(phylogeny.build_tree(
+                    tree_path, snp_sites_outpath, threads=mega_threads,
+                    bootstraps=mega.DEFAULT_BOOTSTRAPS if bootstraps is None
+                    else bootstraps, initial_trees=initial_trees,
+                    search_level=search_level))
     if light_mode:
         shutil.rmtree(fasta_path)
     return (metadata,)
@@ -406,7 +816,21 @@ def phylo(results_path, consensus_path, download_only=False, n_threads=1,
 
 def full_pipeline(results_path, consensus_path,
                   all_wgs_samples_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH,
-                  n_threads=1, build_tree=False, download_only=False, **kwargs):
+                  n_threads=1, build_tree=False, download_only=False,
+                  download_workers=phylogeny.DEFAULT_DOWNLOAD_WORKERS,
+                  consensus_cache_gb=None, consensus_encoding="fasta",
+                  assembly="serial", check_lengths=False, streaming=False,
+                  engine="snp-sites", dists_engine="snp-dists",
+                  checkpoint=False, previous_state_path=None,
+                  reference_path=None, matrix_format="csv",
+                  max_distance=None, per_clade=False,
+                  cross_clade_summary=False, cross_clade_sample=None,
+                  tree_method="mp", bootstraps=None,
+                  mega_threads=mega.DEFAULT_THREADS,
+                  initial_trees=mega.DEFAULT_INITIAL_TREES,
+                  search_level=mega.DEFAULT_SEARCH_LEVEL,
+                  previous_tree_path=None, placement_method="parsimony",
+                  spr_radius=placement.DEFAULT_SPR_RADIUS, **kwargs):
     """
         Runs the full pipeline:
             1. updates with new WGS samples;
@@ -427,11 +851,76 @@ def full_pipeline(results_path, consensus_path,
             n_threads (int): the number of threads to use for building
             the snp_matrix
 
-            build_tree (bool): build a phylogentic tree using mega
+            build_tree (bool): build a phylogentic tree using mega, or
+            natively with neighbour-joining, see tree_method
 
             download_only (bool): only download consensus files without
             running phylogeny
 
+            download_workers (int): maximum number of concurrent s3
+            downloads
+
+            consensus_cache_gb (float): size budget of the consensus
+            cache, in GB; None for no limit
+
+            consensus_encoding (str): "fasta" or "2bit", on-disk
+            encoding of newly cached consensus files
+
+            assembly (str): "serial" or "parallel" (positional)
+            assembly of the multi fasta
+
+            check_lengths (bool): check sequence lengths with serial
+            assembly, see phylo()
+
+            streaming (bool): pipe snp-sites straight into snp-dists
+
+            engine (str): "snp-sites", "native" or "profiles" engine
+            for finding variable sites
+
+            dists_engine (str): "snp-dists" or "native" engine for
+            building the snp matrix
+
+            checkpoint (bool): checkpoint the native snp matrix, see
+            phylo()
+
+            previous_state_path (str): optional path to the alignment
+            state of a previous run to update
+
+            reference_path (str): path to the reference fasta for the
+            "profiles" engine
+
+            matrix_format (str): "csv" or "npy" snp matrix, see phylo()
+
+            max_distance (int): only find pairs of samples within
+            max_distance snps, see phylo()
+
+            per_clade (bool): build a snp matrix per clade, see phylo()
+
+            cross_clade_summary (bool): save the minimum distances
+            between clades, see phylo()
+
+            cross_clade_sample (int): number of samples of each clade
+            compared for the minimum distances, see phylo()
+
+            tree_method (str): "mp" or "nj", see phylo()
+
+            bootstraps (int): number of bootstrap replicates, see phylo()
+
+            mega_threads (int): number of threads per megacc job
+
+            initial_trees (int): number of initial trees of a maximum
+            parsimony tree
+
+            search_level (int): search level of a maximum parsimony tree
+
+            previous_tree_path (str): optional path to the tree of a
+            previous run to update, see phylo()
+
+            placement_method (str): "parsimony" or "distance"
+
+            spr_radius (int): radius of the SPR clean-up around placed
+            samples
+
             **kwargs: see sample_filter() for available kwargs
 
         Returns:
@@ -439,7 +928,8 @@ def full_pipeline(results_path, consensus_path,
     """
     # update full sample summary
     metadata_update, df_all_wgs = update_samples(results_path,
-                                                 all_wgs_samples_filepath)
+                                                 all_wgs_samples_filepath,
+                                                 download_workers)
     metadata = metadata_update
     # remove duplicates
     metadata_dedup, df_wgs_deduped = de_duplicate_samples(results_path,
@@ -461,7 +951,30 @@ def full_pipeline(results_path, consensus_path,
     # run phylogeny
     metadata_phylo, *_ = phylo(results_path, consensus_path, download_only,
                                n_threads, build_tree, df_wgs_deduped,
-                               light_mode=True)
+                               light_mode=True,
+                               download_workers=download_workers,
+                               consensus_cache_gb=consensus_cache_gb,
+                               consensus_encoding=consensus_encoding,
+                               assembly=assembly,
+                               check_lengths=check_lengths,
+                               streaming=streaming,
+                               engine=engine, dists_engine=dists_engine,
+                               checkpoint=checkpoint,
+                               previous_state_path=previous_state_path,
+                               reference_path=reference_path,
+                               matrix_format=matrix_format,
+                               max_distance=max_distance,
+                               per_clade=per_clade,
+                               cross_clade_summary=cross_clade_summary,
+                               cross_clade_sample=cross_clade_sample,
+                               tree_method=tree_method,
+                               bootstraps=bootstraps,
+                               mega_threads=mega_threads,
+                               initial_trees=initial_trees,
+                               search_level=search_level,
+                               previous_tree_path=previous_tree_path,
+                               placement_method=placement_method,
+                               spr_radius=spr_radius)
     metadata.update(metadata_phylo)
     return (metadata,)
 
@@ -470,6 +983,14 @@ def view_bovine(results_path, consensus_path, cattle_movements_path,
                 clade_info_path=DEFAULT_CLADE_INFO_PATH,
                 outliers_path=DEFAULT_OUTLIERS_PATH,
                 all_wgs_samples_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH,
+                n_threads=4,
+                download_workers=phylogeny.DEFAULT_DOWNLOAD_WORKERS,
+                consensus_cache_gb=None, consensus_encoding="fasta",
+                assembly="serial", check_lengths=False, streaming=False,
+                engine="snp-sites", dists_engine="snp-dists",
+                checkpoint=False, previous_state_path=None,
+                reference_path=None, matrix_format="csv", per_clade=False,
+                cross_clade_summary=False, cross_clade_sample=None,
                 **kwargs):
     """
         Phylogeny for plugging into ViewBovine:
@@ -501,6 +1022,51 @@ def view_bovine(results_path, consensus_path, cattle_movements_path,
             all_wgs_samples_filepath (str): input path to location of
             summary csv
 
+            n_threads (int): the number of threads, or processes, to
+            use for building the snp_matrix
+
+            download_workers (int): maximum number of concurrent s3
+            downloads
+
+            consensus_cache_gb (float): size budget of the consensus
+            cache, in GB; None for no limit
+
+            consensus_encoding (str): "fasta" or "2bit", on-disk
+            encoding of newly cached consensus files
+
+            assembly (str): "serial" or "parallel" (positional)
+            assembly of the multi fasta
+
+            check_lengths (bool): check sequence lengths with serial
+            assembly, see phylo()
+
+            streaming (bool): pipe snp-sites straight into snp-dists
+
+            engine (str): "snp-sites", "native" or "profiles" engine
+            for finding variable sites
+
+            dists_engine (str): "snp-dists" or "native" engine for
+            building the snp matrix
+
+            checkpoint (bool): checkpoint the native snp matrix, see
+            phylo()
+
+            previous_state_path (str): optional path to the alignment
+            state of a previous run to update
+
+            reference_path (str): path to the reference fasta for the
+            "profiles" engine
+
+            matrix_format (str): "csv" or "npy" snp matrix, see phylo()
+
+            per_clade (bool): build a snp matrix per clade, see phylo()
+
+            cross_clade_summary (bool): save the minimum distances
+            between clades, see phylo()
+
+            cross_clade_sample (int): number of samples of each clade
+            compared for the minimum distances, see phylo()
+
             **kwargs: see sample_filter() for available kwargs
 
         Returns:
@@ -515,7 +1081,8 @@ def view_bovine(results_path, consensus_path, cattle_movements_path,
         outliers = [outlier.rstrip() for outlier in f]
     # update full sample summary
     metadata_update, df_all_wgs = update_samples(results_path,
-                                                 all_wgs_samples_filepath)
+                                                 all_wgs_samples_filepath,
+                                                 download_workers)
     metadata = metadata_update
     # remove duplicates
     metadata_dedup, df_wgs_deduped = de_duplicate_samples(results_path,
@@ -591,20 +1158,198 @@ def view_bovine(results_path, consensus_path, cattle_movements_path,
     # save report to metadata folder
     df_report.to_csv(os.path.join(metadata_path, "report.csv"), index=False)
     # run phylogeny
-    metadata_phylo, *_ = phylo(results_path, consensus_path, n_threads=4,
-                               df_wgs=df_wgs_consistified, light_mode=True)
+    metadata_phylo, *_ = phylo(results_path, consensus_path,
+                               n_threads=n_threads,
+                               df_wgs=df_wgs_consistified, light_mode=True,
+                               download_workers=download_workers,
+                               consensus_cache_gb=consensus_cache_gb,
+                               consensus_encoding=consensus_encoding,
+                               assembly=assembly,
+                               check_lengths=check_lengths,
+                               streaming=streaming,
+                               engine=engine, dists_engine=dists_engine,
+                               checkpoint=checkpoint,
+                               previous_state_path=previous_state_path,
+                               reference_path=reference_path,
+                               matrix_format=matrix_format,
+                               per_clade=per_clade,
+                               cross_clade_summary=cross_clade_summary,
+                               cross_clade_sample=cross_clade_sample)
     # process sample names in the snp matrix: snps.csv to be consistent with
     # cattle and movement data
-    phylogeny.post_process_snps_csv(os.path.join(results_path, "snps.csv"))
+    if per_clade:
+        clades_path = os.path.join(results_path, "clades")
+        with open(os.path.join(clades_path,
+                               snp_matrix.CLADE_INDEX_FILENAME)) as f:
+            matrix_paths = [os.path.join(clades_path, entry["file"]) for entry
+                            in json.load(f)["clades"].values()]
+    else:
+        matrix_paths = [os.path.join(results_path, "snps.csv")
+                        if matrix_format == "csv" else
+                        os.path.join(results_path, snp_matrix.MATRIX_FILENAME)]
+    for matrix_path in matrix_paths:
+        if matrix_format == "npy":
+            phylogeny.post_process_snp_matrix(matrix_path)
+        else:
+            phylogeny.post_process_snps_csv(matrix_path)
     metadata.update(metadata_phylo)
     return (metadata,)
 
 
+def migrate_consensus(consensus_path, consensus_encoding="2bit"):
+    """
+        One-off migration of an existing consensus directory into the
+        consensus cache with the given encoding. Legacy '<Sample>.fas'
+        files are adopted and cached files with a different encoding
+        are re-encoded.
+
+        Parameters:
+            consensus_path (str): path to directory of consensus files
+
+            consensus_encoding (str): "fasta" or "2bit"
+
+        Returns:
+            metadata (dict): consensus cache metadata
+    """
+    print("\n## Migrate consensus ##\n")
+    cache = consensus_cache.ConsensusCache(consensus_path,
+                                           encoding=consensus_encoding)
+    size_before = cache.size_bytes + \
+        sum(os.path.getsize(os.path.join(consensus_path, filename))
+            for filename in os.listdir(consensus_path)
+            if filename.endswith(".fas"))
+    try:
+        num_migrated = cache.migrate()
+    finally:
+        cache.save()
+    print(f"\tmigrated {num_migrated} samples: {size_before/1e6:.1f} MB -> "
+          f"{cache.size_bytes/1e6:.1f} MB\n")
+    return (dict(cache.metadata(), number_of_migrated_samples=num_migrated),)
+
+
+def add_phylo_args(parser, tree=True):
+    """
+        Adds the options of the phylogeny sub-commands to parser; with
+        tree also those for only downloading, finding close pairs and
+        building a tree, which ViewBovine does not take
+    """
+    parser.add_argument("--download_workers", type=int,
+                        default=phylogeny.DEFAULT_DOWNLOAD_WORKERS,
+                        help="maximum number of concurrent s3 downloads")
+    parser.add_argument("--consensus_cache_gb", type=float, default=None,
+                        help="size budget of the consensus cache in GB; \
+                            least recently used samples are evicted")
+    parser.add_argument("--consensus_encoding", default="fasta",
+                        choices=list(consensus_cache.ENCODINGS),
+                        help="on-disk encoding of cached consensus files")
+    parser.add_argument("--assembly", default="serial",
+                        choices=["serial", "parallel"],
+                        help=f"build the multi fasta serially or by \
+                            copying consensus files into place in \
+                            parallel; parallel assembly leaves out \
+                            samples whose sequence length differs from \
+                            the reference length, that of '--reference' \
+                            or {phylogeny.REFERENCE_LENGTH} (AF2122/97)")
+    parser.add_argument("--check_lengths", action="store_true",
+                        default=False, help="with '--assembly serial', \
+                            also leave out samples whose sequence length \
+                            differs from the reference length")
+    parser.add_argument("--streaming", action="store_true", default=False,
+                        help="pipe snp-sites into snp-dists without \
+                            writing snps.fas")
+    parser.add_argument("--engine", default="snp-sites",
+                        choices=["snp-sites", "native", "profiles"],
+                        help="engine for finding variable sites")
+    parser.add_argument("--reference", dest="reference_path", default=None,
+                        help="path to the reference fasta against which \
+                            variant profiles are built for the profiles \
+                            engine")
+    parser.add_argument("--dists_engine", default="snp-dists",
+                        choices=["snp-dists", "native"],
+                        help="engine for building the snp matrix")
+    parser.add_argument("--checkpoint", action="store_true", default=False,
+                        help="with '--dists_engine native', checkpoint \
+                            the snp matrix in tiles to the 'tiles' \
+                            directory so that an interrupted run resumes; \
+                            always done for 10000 or more samples")
+    parser.add_argument("--previous_state", dest="previous_state_path",
+                        default=None, help="path to the 'state' directory \
+                            of a previous run with the native engines, to \
+                            update rather than rebuild the snp matrix")
+    parser.add_argument("--matrix_format", default="csv",
+                        choices=["csv", "npy"],
+                        help="save the snp matrix as snps.csv or as a \
+                            binary upper triangle, snps.npy, with a \
+                            sample index, snps_samples.json")
+    parser.add_argument("--per_clade", action="store_true", default=False,
+                        help="with '--dists_engine native', build a snp \
+                            matrix per clade in the 'clades' directory \
+                            instead of one for all samples")
+    parser.add_argument("--cross_clade_summary", action="store_true",
+                        default=False, help="with '--per_clade', also \
+                            save the minimum distance between each pair \
+                            of clades. Pairs of samples ruled out by \
+                            lower bounds are skipped, but at worst every \
+                            pair of samples in different clades is \
+                            compared, about the cost of the full snp \
+                            matrix; see '--cross_clade_sample'")
+    parser.add_argument("--cross_clade_sample", type=int, default=None,
+                        help="with '--cross_clade_summary', only compare \
+                            this many samples of each clade, those \
+                            nearest the other clade, for an upper bound \
+                            on each minimum distance at a cost of at most \
+                            its square per pair of clades")
+    if not tree:
+        return
+    parser.add_argument("--download_only", help="if only dowloading \
+        connsensus sequences", action="store_true", default=False)
+    parser.add_argument("--max_distance", type=int, default=None,
+                        help="with '--dists_engine native', only find \
+                            pairs of samples within this many snps of \
+                            each other and save them to snps_edges.csv \
+                            instead of the snp matrix")
+    parser.add_argument("--build_tree", action="store_true", default=False,
+                        help="build a tree")
+    parser.add_argument("--tree_method", default="mp", choices=["mp", "nj"],
+                        help="build a maximum parsimony tree with megacc \
+                            or a neighbour-joining tree natively")
+    parser.add_argument("--bootstraps", type=int, default=None,
+                        help="number of bootstrap replicates; defaults \
+                            to 100 for 'nj' and 200 for 'mp'")
+    parser.add_argument("--mega_threads", type=int,
+                        default=mega.DEFAULT_THREADS,
+                        help="number of threads per megacc job")
+    parser.add_argument("--initial_trees", type=int,
+                        default=mega.DEFAULT_INITIAL_TREES,
+                        help="number of initial trees of a maximum \
+                            parsimony tree")
+    parser.add_argument("--search_level", type=int,
+                        default=mega.DEFAULT_SEARCH_LEVEL,
+                        help="search level of a maximum parsimony tree")
+    parser.add_argument("--previous_tree", dest="previous_tree_path",
+                        default=None, help="path to the tree of a \
+                            previous run, in Newick format; with \
+                            --build_tree new samples are placed on it \
+                            rather than building a tree")
+    parser.add_argument("--placement_method", default="parsimony",
+                        choices=placement.PLACEMENT_METHODS,
+                        help="placement of new samples on the previous \
+                            tree")
+    parser.add_argument("--spr_radius", type=int,
+                        default=placement.DEFAULT_SPR_RADIUS,
+                        help="radius of the SPR clean-up around placed \
+                            samples; 0 for none")
+
+
 def parse_args():
     """
         Parse command line arguments for use with each function
     """
     parser = argparse.ArgumentParser(prog="btb-phylo")
+    parser.add_argument("--storage", default=storage.get_storage_uri(),
+                        help="object storage uri: 's3://' or \
+                            'file:///path/to/root?latency=0.05&bandwidth=20e6' \
+                                for a local stand-in of s3")
     subparsers = parser.add_subparsers(help='sub-command help')
 
     # update complete summary csv
@@ -614,6 +1359,19 @@ def parse_args():
     subparser.add_argument("--all_wgs_samples_filepath", help="path to \
                            'all_wgs_samples' .csv file",
                            default=utils.DEFAULT_WGS_SAMPLES_FILEPATH)
+    subparser.add_argument("--download_workers", type=int,
+                           default=update_summary.DEFAULT_DOWNLOAD_WORKERS,
+                           help="maximum number of concurrent s3 requests")
+    subparser.add_argument("--s3_prefixes", nargs="+",
+                           default=update_summary.DEFAULT_FINALOUT_PREFIXES,
+                           help="prefixes in s3-csu-003 to search for \
+                               FinalOut.csv files")
+    subparser.add_argument("--listing_ttl", type=float, default=0,
+                           help="reuse the cached s3 listing if it is younger \
+                               than this many seconds")
+    subparser.add_argument("--partition_by", choices=["group", "batch"],
+                           default="group", help="partitioning of \
+                               'all_wgs_samples' if saved as .parquet")
     subparser.set_defaults(func=update_samples)
 
     # filter samples
@@ -678,14 +1436,11 @@ def parse_args():
     subparser.add_argument("results_path", help="path to results directory")
     subparser.add_argument("consensus_path", help="path to where consensus \
         files will be held")
-    subparser.add_argument("--download_only", help="if only dowloading \
-        connsensus sequences", action="store_true", default=False)
     subparser.add_argument("--n_threads", "-j", default=1,
                            help="number of threads for snp-dists")
-    subparser.add_argument("--build_tree", action="store_true", default=False,
-                           help="build a tree")
     subparser.add_argument("--light_mode", action="store_true", default=False,
                            help="save fastas to temporary directory")
+    add_phylo_args(subparser)
     subparser.set_defaults(func=phylo)
 
     # full pipeline
@@ -698,12 +1453,8 @@ def parse_args():
     subparser.add_argument("--all_wgs_samples_filepath", help="path to \
                            'all_wgs_samples' .csv file",
                            default=utils.DEFAULT_WGS_SAMPLES_FILEPATH)
-    subparser.add_argument("--download_only", help="if only dowloading \
-        connsensus sequences", action="store_true", default=False)
     subparser.add_argument("--n_threads", "-j", default=1, help="number of \
         threads for snp-dists")
-    subparser.add_argument("--build_tree", action="store_true", default=False,
-                           help="build a tree")
     subparser.add_argument("--config", default=None,
                            help="path to configuration file")
     subparser.add_argument("--sample_name", "-s", dest="Sample", nargs="+",
@@ -722,6 +1473,7 @@ def parse_args():
                            help="optional filter")
     subparser.add_argument("--meandepth", "-md", dest="MeanDepth", type=float,
                            nargs=2, help="optional filter")
+    add_phylo_args(subparser)
     subparser.set_defaults(func=full_pipeline)
 
     # viewbovine
@@ -737,14 +1489,28 @@ def parse_args():
         file", default=DEFAULT_CLADE_INFO_PATH)
     subparser.add_argument("--outliers_path", help="path to outliers txt \
         file", default=DEFAULT_OUTLIERS_PATH)
+    subparser.add_argument("--n_threads", "-j", type=int, default=4,
+                           help="number of threads for snp-dists or of \
+                               processes for the native snp matrix")
     subparser.add_argument("--all_wgs_samples_filepath", help="path to \
                            'all_wgs_samples' .csv file",
                            default=utils.DEFAULT_WGS_SAMPLES_FILEPATH)
+    add_phylo_args(subparser, tree=False)
     subparser.set_defaults(func=view_bovine)
 
+    # migrate consensus
+    subparser = subparsers.add_parser('migrate_consensus', help="migrates a \
+        consensus directory to the consensus cache with the given encoding")
+    subparser.add_argument("consensus_path", help="path to where consensus \
+        files are held")
+    subparser.add_argument("--consensus_encoding", default="2bit",
+                           choices=list(consensus_cache.ENCODINGS),
+                           help="on-disk encoding of cached consensus files")
+    subparser.set_defaults(func=migrate_consensus)
+
     # pasre args
     kwargs = vars(parser.parse_args())
-    if not kwargs:
+    if "func" not in kwargs:
         parser.print_help()
         sys.exit(0)
     return kwargs
@@ -755,12 +1521,19 @@ def run(**kwargs):
     metadata = {"datetime": str(datetime.now())}
     btb_phylo_git_commit = subprocess.check_output(["git", "rev-parse", "HEAD"])
     metadata["git_commit"] = btb_phylo_git_commit.decode().strip('\n')
+    # select object storage backend
+    storage.set_storage(kwargs.pop("storage"))
+    metadata["storage"] = storage.get_storage_uri()
     # retrieve opperation
     func = kwargs.pop("func")
     # run
     meta_update, *_ = func(**kwargs)
     # update metadata
     metadata.update(meta_update)
+    # sub-commands without a results directory only print metadata
+    if "results_path" not in kwargs:
+        print(json.dumps(metadata, indent=2))
+        return
     # create metadata directory in results folder
     metadata_path = os.path.join(kwargs["results_path"], "metadata")
     if not os.path.exists(metadata_path):
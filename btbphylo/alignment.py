@@ -0,0 +1,151 @@
+import os
+import mmap
+from contextlib import contextmanager
+
+import numpy as np
+
+"""
+    A native replacement for 'snp-sites -c'. The multi fasta is memory
+    mapped and read in two streaming passes: the first accumulates, for
+    every alignment column, the first sequence's base and whether the
+    column is ACGT-only and variable; the second writes each sequence's
+    variable ACGT-only sites. Memory use is proportional to the
+    alignment length rather than to the number of sequences.
+"""
+
+# case-insensitive lookup table from byte to nucleotide code: A, C, G
+# and T are 0 to 3 and anything else is 4, and its inverse
+NUCLEOTIDE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, nucleotide in enumerate(b"ACGT"):
+    NUCLEOTIDE_CODES[[nucleotide, nucleotide + 32]] = code
+NUCLEOTIDES = np.frombuffer(b"ACGTN", dtype=np.uint8)
+
+
+@contextmanager
+def map_fasta(fasta_path):
+    """
+        Context manager returning a read-only memory map of the fasta at
+        fasta_path, or empty bytes if the file is empty
+    """
+    with open(fasta_path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:1] != b">":
+                raise ValueError(f"{fasta_path} is not a fasta file")
+            yield mm
+
+
+def record_spans(contents):
+    """
+        Generator of the records in contents, a fasta file as bytes or
+        a memory map, without copying their sequences
+
+        Yields:
+            name (bytes): sequence name, i.e. the header up to the
+            first whitespace
+
+            span (tuple): start and end offsets of the sequence lines
+    """
+    start = 0
+    while start < len(contents):
+        end = contents.find(b"\n>", start)
+        end = len(contents) if end == -1 else end + 1
+        header_end = contents.find(b"\n", start, end)
+        header_end = end if header_end == -1 else header_end
+        name = (contents[start + 1:header_end].split() or [b""])[0]
+        yield name, (min(header_end + 1, end), end)
+        start = end
+
+
+def record_sequence(contents, span):
+    """
+        Returns the sequence at span (see record_spans()) of contents as
+        a uint8 numpy array without newlines
+    """
+    sequence = contents[span[0]:span[1]].replace(b"\n", b"")
+    return np.frombuffer(sequence.replace(b"\r", b""), dtype=np.uint8)
+
+
+def fasta_records(multi_fasta_path):
+    """
+        Generator of the records in a memory mapped multi fasta
+
+        Parameters:
+            multi_fasta_path (str): path to the multi fasta
+
+        Yields:
+            name (bytes): sequence name, i.e. the header up to the
+            first whitespace
+
+            sequence (numpy array): uint8 sequence without newlines
+    """
+    with map_fasta(multi_fasta_path) as contents:
+        for name, span in record_spans(contents):
+            yield name, record_sequence(contents, span)
+
+
+def variable_sites(multi_fasta_path):
+    """
+        Finds the alignment columns that contain only A, C, G or T (in
+        either case) and at least two distinct bases, i.e. the sites
+        output by 'snp-sites -c'
+
+        Parameters:
+            multi_fasta_path (str): path to the multi fasta
+
+        Returns:
+            positions (numpy array): 0-based positions of the sites
+    """
+    reference = None
+    for name, sequence in fasta_records(multi_fasta_path):
+        codes = NUCLEOTIDE_CODES[sequence]
+        if reference is None:
+            reference = codes
+            acgt = codes < 4
+            variable = np.zeros(len(codes), dtype=bool)
+            continue
+        if len(codes) != len(reference):
+            raise ValueError(f"Sequence '{name.decode()}' is not the same "
+                             "length as the alignment")
+        acgt &= codes < 4
+        variable |= codes != reference
+    if reference is None:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(acgt & variable)
+
+
+def snp_sites(snp_sites_outpath, multi_fasta_path):
+    """
+        Native equivalent of 'snp-sites -c -o snp_sites_outpath
+        multi_fasta_path': writes the variable ACGT-only sites of every
+        sequence, one line per sequence
+
+        Parameters:
+            snp_sites_outpath (str): output path for the snp alignment
+
+            multi_fasta_path (str): path to the multi fasta
+
+        Returns:
+            metadata (dict): the number of snps
+
+            positions (numpy array): 0-based positions of the sites
+    """
+    positions = variable_sites(multi_fasta_path)
+    with open(snp_sites_outpath, "wb") as f:
+        for name, sequence in fasta_records(multi_fasta_path):
+            f.write(b">" + name + b"\n" + sequence[positions].tobytes() +
+                    b"\n")
+    return {"number_of_snps": len(positions)}, positions
+
+
+def write_codes(snp_sites_outpath, names, codes):
+    """
+        Writes a snp alignment, given as a 2D array of nucleotide codes
+        with a row per sequence, in the format of 'snp-sites -c'
+    """
+    with open(snp_sites_outpath, "wb") as f:
+        for name, sequence_codes in zip(names, codes):
+            f.write(b">" + name.encode() + b"\n" +
+                    NUCLEOTIDES[sequence_codes].tobytes() + b"\n")
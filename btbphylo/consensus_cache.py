@@ -0,0 +1,389 @@
+import os
+import json
+import time
+import zlib
+import struct
+import hashlib
+import threading
+from os import path
+
+import numpy as np
+
+"""
+    A managed, content-addressed cache of consensus files. Files are
+    stored by the sha256 of their contents in sharded subdirectories,
+    objects/<sha256[:2]>/<sha256>.fas, of the consensus directory. An
+    index, index.json, maps each sample to the sha256, size and s3 ETag
+    of its consensus file and the time it was last used. Entries whose
+    ETag no longer matches s3 are refreshed, files are checksum
+    verified when read and the least recently used entries are evicted
+    to keep the cache within a size budget.
+
+    Consensus files may optionally be stored in a compact "2bit"
+    encoding (see encode_2bit), which is decoded transparently by
+    ConsensusCache.read().
+"""
+
+INDEX_FILENAME = "index.json"
+ENCODINGS = {"fasta": ".fas", "2bit": ".2bit"}
+
+# 2bit header: magic, mode, header length, line width, sequence length,
+# number of exception runs and whether the file ends with a newline
+TWO_BIT_MAGIC = b"BTB2"
+TWO_BIT_HEADER = struct.Struct("<4sBIIIIB")
+TWO_BIT_PACKED, TWO_BIT_ZLIB = 0, 1
+NUCLEOTIDES = np.frombuffer(b"ACGT", dtype=np.uint8)
+NUCLEOTIDE_CODES = np.full(256, 255, dtype=np.uint8)
+NUCLEOTIDE_CODES[NUCLEOTIDES] = np.arange(4, dtype=np.uint8)
+
+
+class CorruptCacheError(Exception):
+    def __init__(self, sample):
+        super().__init__()
+        self.message = f"Cached consensus for '{sample}' failed checksum"
+
+    def __str__(self):
+        return self.message
+
+
+def encode_2bit(contents):
+    """
+        Losslessly encodes a single record fasta file (bytes). The
+        sequence is packed at 2 bits per nucleotide; runs of any other
+        character (e.g. 'N' or '-') are stored as a sparse list of
+        (start, length, character) and the header line and line
+        wrapping are stored verbatim. Contents that do not fit this
+        layout, e.g. irregular line wrapping, lower case or many short
+        non-ACGT runs, or that contain no sequence are zlib compressed
+        instead.
+    """
+    header, _, body = contents.partition(b"\n")
+    lines = body.split(b"\n")
+    trailing_newline = lines[-1] == b""
+    if trailing_newline:
+        lines.pop()
+    width = len(lines[0]) if lines else 0
+    sequence = np.frombuffer(b"".join(lines), dtype=np.uint8)
+    codes = NUCLEOTIDE_CODES[sequence]
+    exceptions = np.flatnonzero(codes == 255)
+    # a new run starts where the position is not contiguous with, or
+    # the character differs from, the previous exception
+    run_starts = np.ones(len(exceptions), dtype=bool)
+    run_starts[1:] = (np.diff(exceptions) != 1) | \
+        (sequence[exceptions[1:]] != sequence[exceptions[:-1]])
+    starts = exceptions[run_starts]
+    lengths = np.diff(np.append(np.flatnonzero(run_starts),
+                                len(exceptions)))
+    if not header.startswith(b">") or b">" in body or b"\r" in contents \
+            or any(len(line) != width for line in lines[:-1]) \
+            or (lines and not 0 < len(lines[-1]) <= width) \
+            or not len(sequence) or len(starts) > len(sequence) // 64:
+        return TWO_BIT_HEADER.pack(TWO_BIT_MAGIC, TWO_BIT_ZLIB, 0, 0, 0, 0,
+                                   0) + zlib.compress(contents, 6)
+    # pack 4 nucleotides per byte
+    codes = codes.copy()
+    codes[exceptions] = 0
+    codes = np.append(codes, np.zeros(-len(codes) % 4, dtype=np.uint8))
+    codes = codes.reshape(-1, 4)
+    packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | \
+        codes[:, 3]
+    return b"".join([TWO_BIT_HEADER.pack(TWO_BIT_MAGIC, TWO_BIT_PACKED,
+                                         len(header), width, len(sequence),
+                                         len(starts), trailing_newline),
+                     header,
+                     starts.astype("<u4").tobytes(),
+                     lengths.astype("<u4").tobytes(),
+                     sequence[starts].tobytes(),
+                     packed.astype(np.uint8).tobytes()])
+
+
+def decode_2bit(data):
+    """
+        Decodes bytes encoded with encode_2bit()
+    """
+    magic, mode, header_length, width, sequence_length, num_runs, \
+        trailing_newline = TWO_BIT_HEADER.unpack_from(data)
+    if magic != TWO_BIT_MAGIC:
+        raise ValueError("Not a 2bit encoded consensus file")
+    offset = TWO_BIT_HEADER.size
+    if mode == TWO_BIT_ZLIB:
+        return zlib.decompress(data[offset:])
+    header = data[offset:offset+header_length]
+    offset += header_length
+    starts = np.frombuffer(data, dtype="<u4", count=num_runs, offset=offset)
+    offset += 4 * num_runs
+    lengths = np.frombuffer(data, dtype="<u4", count=num_runs, offset=offset)
+    offset += 4 * num_runs
+    characters = np.frombuffer(data, dtype=np.uint8, count=num_runs,
+                               offset=offset)
+    offset += num_runs
+    # unpack 4 nucleotides per byte
+    packed = np.frombuffer(data, dtype=np.uint8, offset=offset)
+    codes = np.stack([packed >> 6, (packed >> 4) & 3, (packed >> 2) & 3,
+                      packed & 3], axis=1).ravel()[:sequence_length]
+    sequence = NUCLEOTIDES[codes]
+    # restore exception runs
+    starts, lengths = starts.astype(np.int64), lengths.astype(np.int64)
+    run_index = np.repeat(np.arange(num_runs), lengths)
+    positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + \
+        np.arange(len(run_index))
+    sequence[positions] = characters[run_index]
+    # restore line wrapping
+    lines = [sequence[i:i+width].tobytes()
+             for i in range(0, sequence_length, width)] if width else []
+    return header + b"\n" + b"\n".join(lines) + \
+        (b"\n" if trailing_newline else b"")
+
+
+def record_lengths(contents):
+    """
+        Returns the length in bytes of a fasta record (contents) and
+        the length of its sequence, i.e. excluding the header line and
+        newlines
+    """
+    header_length = contents.find(b"\n") + 1 or len(contents)
+    return {"fasta_size": len(contents),
+            "sequence_length": len(contents) - header_length -
+            contents.count(b"\n", header_length)}
+
+
+class ConsensusCache:
+    """
+        Consensus cache rooted at consensus_path. max_bytes is the size
+        budget enforced by evict(); None for no limit. New files are
+        stored with encoding, either "fasta" or "2bit". Consensus files
+        left in consensus_path as '<Sample>.fas' by older versions are
+        adopted into the cache the first time they are requested.
+    """
+    def __init__(self, consensus_path, max_bytes=None, encoding="fasta"):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown consensus encoding: '{encoding}'")
+        self.consensus_path = consensus_path
+        self.max_bytes = max_bytes
+        self.encoding = encoding
+        self.index_filepath = path.join(consensus_path, INDEX_FILENAME)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "corrupt": 0,
+                      "adopted": 0, "evicted": 0}
+        os.makedirs(path.join(consensus_path, "tmp"), exist_ok=True)
+        if path.exists(self.index_filepath):
+            with open(self.index_filepath, "r") as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+        # number of samples referring to each file and total file size
+        self.refs = {}
+        self.size_bytes = 0
+        for entry in self.index.values():
+            if entry["sha256"] not in self.refs:
+                self.refs[entry["sha256"]] = 0
+                self.size_bytes += entry["size"]
+            self.refs[entry["sha256"]] += 1
+
+    def __contains__(self, sample):
+        with self.lock:
+            return sample in self.index
+
+    def object_filepath(self, entry):
+        return path.join(self.consensus_path, "objects", entry["sha256"][:2],
+                         entry["sha256"] +
+                         ENCODINGS[entry.get("encoding", "fasta")])
+
+    def temp_filepath(self, sample):
+        """
+            Returns a path in the cache directory to download sample to
+            before it is added with put()
+        """
+        return path.join(self.consensus_path, "tmp", f"{sample}.fas")
+
+    def get(self, sample, etag=None):
+        """
+            Returns the path of the cached consensus for sample or None
+            if it is not cached or, if etag is given, if its ETag
+            differs from etag
+        """
+        with self.lock:
+            entry = self.index.get(sample)
+        if entry is None:
+            legacy_filepath = path.join(self.consensus_path, f"{sample}.fas")
+            if path.exists(legacy_filepath):
+                with self.lock:
+                    self.stats["adopted"] += 1
+                return self.put(sample, etag, legacy_filepath)
+        elif etag is not None and entry["ETag"] not in (None, etag):
+            with self.lock:
+                self.stats["stale"] += 1
+            self.remove(sample)
+            entry = None
+        elif not path.exists(self.object_filepath(entry)):
+            self.remove(sample)
+            entry = None
+        with self.lock:
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            entry["last_used"] = time.time()
+            if entry["ETag"] is None:
+                entry["ETag"] = etag
+        return self.object_filepath(entry)
+
+    def put(self, sample, etag, filepath):
+        """
+            Moves the consensus file at filepath into the cache as the
+            consensus for sample, encoding it if required, and returns
+            its new path
+        """
+        source_filepath = filepath
+        with open(source_filepath, "rb") as f:
+            contents = f.read()
+        if self.encoding == "2bit":
+            data = encode_2bit(contents)
+            filepath = f"{source_filepath}.2bit"
+            with open(filepath, "wb") as f:
+                f.write(data)
+        else:
+            data = contents
+        entry = dict(record_lengths(contents),
+                     sha256=hashlib.sha256(data).hexdigest(), size=len(data),
+                     encoding=self.encoding, ETag=etag,
+                     last_used=time.time())
+        sha256 = entry["sha256"]
+        object_filepath = self.object_filepath(entry)
+        os.makedirs(path.dirname(object_filepath), exist_ok=True)
+        with self.lock:
+            self._remove(sample)
+            os.replace(filepath, object_filepath)
+            if sha256 not in self.refs:
+                self.refs[sha256] = 0
+                self.size_bytes += entry["size"]
+            self.refs[sha256] += 1
+            self.index[sample] = entry
+        if source_filepath != filepath:
+            os.remove(source_filepath)
+        return object_filepath
+
+    def read(self, sample):
+        """
+            Returns the contents of the cached consensus for sample,
+            decoded to fasta. Raises CorruptCacheError, and removes the
+            entry, if the stored file does not match its checksum.
+        """
+        with self.lock:
+            entry = self.index[sample]
+            entry["last_used"] = time.time()
+        with open(self.object_filepath(entry), "rb") as f:
+            contents = f.read()
+        if hashlib.sha256(contents).hexdigest() != entry["sha256"]:
+            with self.lock:
+                self.stats["corrupt"] += 1
+            self.remove(sample)
+            raise CorruptCacheError(sample)
+        if entry.get("encoding", "fasta") == "2bit":
+            return decode_2bit(contents)
+        return contents
+
+    def record(self, sample):
+        """
+            Returns the index entry for sample, including the decoded
+            'fasta_size' and 'sequence_length' of its consensus (which
+            are computed and stored for entries created by older
+            versions), and the path of the cached file as 'filepath'
+        """
+        with self.lock:
+            entry = self.index[sample]
+        if "sequence_length" not in entry:
+            lengths = record_lengths(self.read(sample))
+            with self.lock:
+                entry.update(lengths)
+        return dict(entry, filepath=self.object_filepath(entry))
+
+    def migrate(self, samples=None):
+        """
+            Re-encodes cached consensus files, and adopts any legacy
+            '<Sample>.fas' files, with the cache's encoding. samples
+            limits migration to a subset of samples.
+
+            Returns:
+                num_migrated (int): number of samples re-encoded or
+                adopted
+        """
+        legacy = [filename[:-4] for filename in os.listdir(self.consensus_path)
+                  if filename.endswith(".fas")]
+        num_migrated = 0
+        for sample in legacy:
+            if samples is None or sample in samples:
+                self.get(sample)
+                num_migrated += 1
+        with self.lock:
+            to_migrate = [sample for sample, entry in self.index.items()
+                          if entry.get("encoding", "fasta") != self.encoding
+                          and (samples is None or sample in samples)]
+        for sample in to_migrate:
+            try:
+                contents = self.read(sample)
+            except CorruptCacheError:
+                continue
+            with self.lock:
+                etag = self.index[sample]["ETag"]
+            temp_filepath = self.temp_filepath(sample)
+            with open(temp_filepath, "wb") as f:
+                f.write(contents)
+            self.put(sample, etag, temp_filepath)
+            num_migrated += 1
+        return num_migrated
+
+    def remove(self, sample):
+        """
+            Removes sample from the index. The cached file is deleted
+            unless it is shared with another sample.
+        """
+        with self.lock:
+            self._remove(sample)
+
+    def _remove(self, sample):
+        # must be called holding self.lock
+        entry = self.index.pop(sample, None)
+        if entry is None:
+            return
+        self.refs[entry["sha256"]] -= 1
+        if not self.refs[entry["sha256"]]:
+            del self.refs[entry["sha256"]]
+            self.size_bytes -= entry["size"]
+            object_filepath = self.object_filepath(entry)
+            if path.exists(object_filepath):
+                os.remove(object_filepath)
+
+    def evict(self, keep=()):
+        """
+            Removes the least recently used entries until the cache is
+            within max_bytes. Samples in keep are never evicted.
+        """
+        if self.max_bytes is None:
+            return
+        keep = set(keep)
+        with self.lock:
+            lru = sorted((entry["last_used"], sample) for sample, entry in
+                         self.index.items() if sample not in keep)
+            for _, sample in lru:
+                if self.size_bytes <= self.max_bytes:
+                    break
+                self._remove(sample)
+                self.stats["evicted"] += 1
+
+    def save(self):
+        """
+            Writes the index to disk
+        """
+        with self.lock:
+            with open(f"{self.index_filepath}.tmp", "w") as f:
+                json.dump(self.index, f)
+        os.replace(f"{self.index_filepath}.tmp", self.index_filepath)
+
+    def metadata(self):
+        """
+            Returns cache statistics for metadata.json
+        """
+        with self.lock:
+            return dict(self.stats, number_of_samples=len(self.index),
+                        size_bytes=self.size_bytes)
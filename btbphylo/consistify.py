@@ -108,7 +108,7 @@ def consistify_csvs(wgs_samples_path, cattle_path, movement_path,
         CSVs. Runs consistify(). Saves consistified outputs to CSV
     """
     # load
-    df_wgs = utils.wgs_csv_to_df(wgs_samples_path)
+    df_wgs = utils.load_wgs_samples(wgs_samples_path)
     df_cattle = pd.read_csv(cattle_path, dtype=object)
     df_movement = pd.read_csv(movement_path, dtype=object)
     # process data
@@ -1,4 +1,5 @@
 
+import numpy as np
 import pandas as pd
 
 
@@ -19,6 +20,8 @@ def remove_duplicates(df, **kwargs):
         which of these duplicates to keep. This pattern continues for n
         kwargs. If no more kwargs exist, the
         duplicated sample appearing first in the dataframe is chosen.
+        Each kwarg is applied in turn, with get_indexes_to_remove(), to
+        the samples remaining after the previous kwargs.
 
         Parameters:
             df (pandas DataFrame object): WGS samples
@@ -37,8 +40,8 @@ def remove_duplicates(df, **kwargs):
     if not kwargs:
         raise TypeError("no kwargs provided, provide a column name and value \
                             for dropping duplicates, e.g. pcMapped='min'")
-    # reamining indexes: starts as all indexes
-    remaining_indexes = df.index
+    # remaining samples: starts as all samples
+    remaining = np.ones(len(df), dtype=bool)
     for column_name, value in kwargs.items():
         if column_name not in df.columns:
             raise ValueError(f"Invalid kwarg '{column_name}': must be one of: "
@@ -52,14 +55,13 @@ def remove_duplicates(df, **kwargs):
                 column, must be a value in the '{column_name}' column")
         # get indexes to remove based on column_name and the selected value
         # (min/max)
-        indexes_to_remove = get_indexes_to_remove(df.loc[remaining_indexes],
-                                                  column_name, value)
-        # update the remaining indexes by subtracting the indexes to remove
-        remaining_indexes = remaining_indexes.difference(indexes_to_remove)
-    # drop the indexes to remove - additional .drop_duplicates ensures the first
-    # appearing is kept if not resolved
-    df_deduped = df.drop(df.index.difference(remaining_indexes)).\
-        drop_duplicates(["Submission"])
+        indexes_to_remove = get_indexes_to_remove(df[remaining], column_name,
+                                                  value)
+        # update the remaining samples by removing the indexes to remove
+        remaining &= ~df.index.isin(indexes_to_remove)
+    # drop the indexes to remove - additional .drop_duplicates ensures the
+    # first appearing is kept if not resolved
+    df_deduped = df[remaining].drop_duplicates(["Submission"])
     # metadata
     metadata = {"number_of_duplicate_WGS_submissions": len(df)-len(df_deduped)}
     return metadata, df_deduped
@@ -67,8 +69,8 @@ def remove_duplicates(df, **kwargs):
 
 def get_indexes_to_remove(df, parameter, method):
     """
-        Loops through unique submisions in the df and collects indexes
-        for duplicate submisions which should be excluded.
+        Collects indexes for duplicate submisions which should be
+        excluded, in a single grouped pass over df.
 
         Parameters:
             df (pandas DataFrame object): WGS samples
@@ -88,34 +90,26 @@ def get_indexes_to_remove(df, parameter, method):
             indexes (pandas index object): indexes to remove from
             dataframe
     """
-    indexes = pd.Index([])
-    submission_list = list(df["Submission"])
-    for submission_no in df.Submission.unique():
-        # ensure that only duplicated entries are considered
-        if submission_list.count(submission_no) > 1:
-            # if parameter is numeric: set the threshold value to the max or min
-            # value of that paramater for all samples with a Submission number
-            # of submission_no
-            if pd.api.types.is_numeric_dtype(df[parameter]):
-                if method == "max":
-                    threshold = \
-                        df.loc[df["Submission"] ==
-                               submission_no][parameter].max()
-                elif method == "min":
-                    threshold = \
-                        df.loc[df["Submission"] ==
-                               submission_no][parameter].min()
-            # otherwise: set the threshold to the method parameter
-            elif pd.api.types.is_categorical_dtype(df[parameter]) or \
-                    pd.api.types.is_object_dtype(df[parameter]):
-                threshold = method
-            # ensure at least one entry meets requirement - avoids removing
-            # entire submission
-            if threshold in \
-                    df.loc[(df["Submission"] == submission_no)][parameter].values:
-                # find all indexes for samples with Submission number =
-                # submission_no, where the parameter is not equal to threshold
-                indexes = \
-                    indexes.append(df.loc[(df["Submission"] == submission_no) &
-                                   (df[parameter] != threshold)].index)
-    return indexes
+    submissions = df["Submission"]
+    # ensure that only duplicated entries are considered
+    duplicated = (submissions.duplicated(keep=False) &
+                  submissions.notna()).to_numpy()
+    groups = submissions[duplicated]
+    values = df.loc[duplicated, parameter]
+    # if parameter is numeric: set the threshold value to the max or min
+    # value of that paramater for all samples of the same submission
+    if pd.api.types.is_numeric_dtype(df[parameter]):
+        threshold = values.groupby(groups).transform(method)
+    # otherwise: set the threshold to the method parameter
+    else:
+        threshold = method
+    meets_threshold = (values == threshold).to_numpy()
+    # ensure at least one entry meets requirement - avoids removing
+    # entire submission
+    submission_meets_threshold = pd.Series(meets_threshold, index=groups.index)\
+        .groupby(groups).transform("any").to_numpy(dtype=bool)
+    # indexes of samples of those submissions where the parameter is not
+    # equal to threshold
+    to_remove = np.zeros(len(df), dtype=bool)
+    to_remove[duplicated] = submission_meets_threshold & ~meets_threshold
+    return df.index[to_remove]
@@ -0,0 +1,646 @@
+import os
+import json
+import hashlib
+from os import path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed
+
+import numpy as np
+
+import btbphylo.alignment as alignment
+
+"""
+    A native replacement for 'snp-dists -c'. Each sequence of the snp
+    alignment is encoded as three bitsets packed into uint64 words: the
+    high and low bits of its 2-bit nucleotide code and a mask of the
+    sites that are A, C, G or T. The distance between two sequences is
+    then the popcount of ((hi_a ^ hi_b) | (lo_a ^ lo_b)) & mask_a &
+    mask_b, i.e. the number of sites at which both are ACGT and differ,
+    as counted by snp-dists. Distances are computed in square blocks of
+    the upper triangle by a pool of threads; numpy releases the GIL for
+    the bitwise operations so that blocks are computed concurrently.
+
+    For large matrices, tiled_distances() splits the upper triangle
+    into tiles that are computed by a pool of worker processes, which
+    read the bitsets from a memory-mapped file. Each finished tile is
+    checkpointed to disk so that an interrupted run resumes from the
+    tiles it had already computed.
+
+    clade_distances() computes a matrix per clade rather than one for
+    all sequences, at the cost of the sum of the squared clade sizes
+    instead of the squared number of sequences. cross_clade_minimums()
+    only finds the minimum distance between each pair of clades, with
+    the same pruning as close_pairs().
+
+    For close-pair analyses, close_pairs() only finds the pairs within
+    a maximum distance: pairs are pruned with lower bounds derived from
+    each sequence's distance to a consensus of the alignment, and the
+    remaining pairs stop being counted once they exceed the maximum.
+"""
+
+SNP_DISTS_VERSION = "0.8.2"
+# target size in bytes of a block's temporary arrays, chosen to fit in
+# a CPU's L2 cache
+BLOCK_BYTES = 1 << 18
+# number of words of each pair's bitsets compared between checks of
+# the maximum distance
+EARLY_EXIT_WORDS = 16
+# number of sequences per block of close_pairs(); pairs are compared
+# individually, so blocks need not fit in cache
+CLOSE_PAIRS_BLOCK_SIZE = 256
+# number of sequences per side of a checkpointed tile
+DEFAULT_TILE_SIZE = 1024
+# number of sequences from which snp matrices are checkpointed by default
+CHECKPOINT_MIN_SEQUENCES = 10000
+CHECKPOINT_FILENAME = "checkpoint.json"
+BITSETS_FILENAME = "bitsets.npy"
+
+# bitsets memory mapped by each worker process of tiled_distances()
+_worker_bitsets = None
+
+# masks for a SWAR popcount of uint64 words
+M1 = np.uint64(0x5555555555555555)
+M2 = np.uint64(0x3333333333333333)
+M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+H01 = np.uint64(0x0101010101010101)
+
+
+def popcount(words):
+    """
+        Returns the number of set bits in each element of words, a
+        uint64 numpy array. words is overwritten.
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    # in-place to avoid allocating a temporary array per step
+    temp = words >> np.uint64(1)
+    temp &= M1
+    words -= temp
+    np.right_shift(words, np.uint64(2), out=temp)
+    temp &= M2
+    words &= M2
+    words += temp
+    np.right_shift(words, np.uint64(4), out=temp)
+    words += temp
+    words &= M4
+    words *= H01
+    words >>= np.uint64(56)
+    return words
+
+
+def pack_bits(bits):
+    """
+        Packs a 2D boolean array into rows of little-endian uint64 words
+    """
+    n_words = -(-bits.shape[1] // 64)
+    padded = np.zeros((bits.shape[0], n_words * 64), dtype=bool)
+    padded[:, :bits.shape[1]] = bits
+    return np.packbits(padded, axis=1, bitorder="little").view(np.uint64)
+
+
+def encode_codes(codes):
+    """
+        Encodes a 2D array of nucleotide codes (see
+        alignment.NUCLEOTIDE_CODES), with a row per sequence, as bitsets:
+        high bits, low bits and ACGT mask, each a 2D uint64 numpy array
+        with a row per sequence
+    """
+    acgt = codes < 4
+    return (pack_bits(acgt & ((codes >> 1) == 1)),
+            pack_bits(acgt & ((codes & 1) == 1)),
+            pack_bits(acgt))
+
+
+def encode_alignment(snp_sites_path):
+    """
+        Encodes a snp alignment as bitsets
+
+        Parameters:
+            snp_sites_path (str): path to the snp alignment
+
+        Returns:
+            names (list): sequence names
+
+            bitsets (tuple): see encode_codes()
+    """
+    names, codes = [], []
+    for name, sequence in alignment.fasta_records(snp_sites_path):
+        names.append(name.decode())
+        codes.append(alignment.NUCLEOTIDE_CODES[sequence])
+    if len({len(sequence_codes) for sequence_codes in codes}) > 1:
+        raise ValueError(f"{snp_sites_path} is not aligned")
+    codes = np.array(codes, dtype=np.uint8).reshape(len(names),
+                                                    len(codes[0]) if codes else 0)
+    return names, encode_codes(codes)
+
+
+def default_block_size(n_words):
+    """
+        Returns the number of sequences per block for which a block's
+        temporary arrays, of n_words per sequence, fit in BLOCK_BYTES
+    """
+    return max(4, int((BLOCK_BYTES / 8 / max(n_words, 1)) ** 0.5))
+
+
+def block_distances(bitsets, rows, columns):
+    """
+        Returns the distances between sequences at the indices rows and
+        columns of bitsets as a 2D numpy array
+    """
+    hi, lo, acgt = bitsets
+    differences = hi[rows, None] ^ hi[None, columns]
+    temp = lo[rows, None] ^ lo[None, columns]
+    differences |= temp
+    np.bitwise_and(acgt[rows, None], acgt[None, columns], out=temp)
+    differences &= temp
+    return popcount(differences).sum(axis=2, dtype=np.uint32)
+
+
+def pairwise_distances(bitsets, threads=1, block_size=None, rows=None,
+                       matrix=None):
+    """
+        Computes the symmetric matrix of pairwise snp distances. Only
+        blocks on or above the diagonal are computed and then mirrored.
+
+        Parameters:
+            bitsets (tuple): see encode_codes()
+
+            threads (int): number of threads
+
+            block_size (int): number of sequences per block; None to
+            size blocks to BLOCK_BYTES
+
+            rows (list): optional indices of the sequences for which to
+            compute distances (to every sequence); None for all
+
+            matrix (numpy array): optional matrix to fill in; the
+            distances between sequences not in rows are left unchanged
+
+        Returns:
+            matrix (numpy array): uint32 distance matrix
+    """
+    n_sequences, n_words = bitsets[0].shape
+    block_size = block_size or default_block_size(n_words)
+    if matrix is None:
+        matrix = np.zeros((n_sequences, n_sequences), dtype=np.uint32)
+    rows = np.arange(n_sequences) if rows is None \
+        else np.asarray(rows, dtype=np.int64)
+    others = np.setdiff1d(np.arange(n_sequences), rows)
+    row_blocks = [rows[i:i + block_size]
+                  for i in range(0, len(rows), block_size)]
+    # the upper triangle of rows x rows and all of rows x others
+    blocks = [(row_blocks[i], row_blocks[j])
+              for i in range(len(row_blocks))
+              for j in range(i, len(row_blocks))] + \
+        [(row_block, others[j:j + block_size]) for row_block in row_blocks
+         for j in range(0, len(others), block_size)]
+
+    def compute(block):
+        block_rows, block_columns = block
+        distances = block_distances(bitsets, block_rows, block_columns)
+        matrix[np.ix_(block_rows, block_columns)] = distances
+        matrix[np.ix_(block_columns, block_rows)] = distances.T
+
+    with ThreadPoolExecutor(max_workers=int(threads)) as executor:
+        # consume the iterator so that exceptions are raised
+        list(executor.map(compute, blocks))
+    return matrix
+
+
+def tile_distances(bitsets, rows, columns, block_size=None):
+    """
+        Returns the distances between sequences in the slices rows and
+        columns of bitsets, computed in blocks. Only the upper triangle
+        of a tile on the diagonal is computed.
+    """
+    if rows == columns:
+        return pairwise_distances(tuple(bitset[rows] for bitset in bitsets),
+                                  block_size=block_size)
+    block_size = block_size or default_block_size(bitsets[0].shape[1])
+    rows = np.arange(rows.start, rows.stop)
+    columns = np.arange(columns.start, columns.stop)
+    tile = np.zeros((len(rows), len(columns)), dtype=np.uint32)
+    for i in range(0, len(rows), block_size):
+        for j in range(0, len(columns), block_size):
+            tile[i:i + block_size, j:j + block_size] = block_distances(
+                bitsets, rows[i:i + block_size], columns[j:j + block_size])
+    return tile
+
+
+def _init_worker(bitsets_filepath):
+    global _worker_bitsets
+    _worker_bitsets = tuple(np.load(bitsets_filepath, mmap_mode="r"))
+
+
+def _compute_tile(rows, columns, tile_filepath):
+    tile = tile_distances(_worker_bitsets, rows, columns)
+    # write atomically so that a killed worker leaves no partial tile
+    with open(f"{tile_filepath}.part", "wb") as f:
+        np.save(f, tile)
+    os.replace(f"{tile_filepath}.part", tile_filepath)
+
+
+def tiled_distances(bitsets, checkpoint_path, workers=1,
+                    tile_size=DEFAULT_TILE_SIZE):
+    """
+        Computes the symmetric matrix of pairwise snp distances tile by
+        tile with a pool of worker processes, checkpointing each tile to
+        checkpoint_path. Tiles left by an interrupted run on the same
+        bitsets are reused. checkpoint_path is kept, to be removed with
+        remove_checkpoint() once the matrix has been written.
+
+        Parameters:
+            bitsets (tuple): see encode_codes()
+
+            checkpoint_path (str): directory for checkpointed tiles
+
+            workers (int): number of worker processes
+
+            tile_size (int): number of sequences per side of a tile
+
+        Returns:
+            matrix (numpy array): uint32 distance matrix
+    """
+    stacked = np.stack(bitsets)
+    fingerprint = hashlib.sha256(stacked.tobytes()).hexdigest()
+    checkpoint = {"fingerprint": fingerprint, "tile_size": tile_size}
+    checkpoint_filepath = path.join(checkpoint_path, CHECKPOINT_FILENAME)
+    bitsets_filepath = path.join(checkpoint_path, BITSETS_FILENAME)
+    # discard tiles checkpointed for other bitsets
+    if path.exists(checkpoint_filepath):
+        with open(checkpoint_filepath, "r") as f:
+            if json.load(f) != checkpoint:
+                for filename in os.listdir(checkpoint_path):
+                    os.remove(path.join(checkpoint_path, filename))
+    os.makedirs(checkpoint_path, exist_ok=True)
+    if not path.exists(checkpoint_filepath):
+        np.save(bitsets_filepath, stacked)
+        with open(checkpoint_filepath, "w") as f:
+            json.dump(checkpoint, f)
+    n_sequences = stacked.shape[1]
+    tiles = [(slice(i, min(i + tile_size, n_sequences)),
+              slice(j, min(j + tile_size, n_sequences)),
+              path.join(checkpoint_path, f"tile_{i}_{j}.npy"))
+             for i in range(0, n_sequences, tile_size)
+             for j in range(i, n_sequences, tile_size)]
+    pending = [tile for tile in tiles if not path.exists(tile[2])]
+    print(f"\t\tcomputing {len(pending)} of {len(tiles)} tiles "
+          f"({len(tiles) - len(pending)} checkpointed)")
+    with ProcessPoolExecutor(max_workers=int(workers),
+                             initializer=_init_worker,
+                             initargs=(bitsets_filepath,)) as executor:
+        futures = [executor.submit(_compute_tile, *tile) for tile in pending]
+        for count, future in enumerate(as_completed(futures), 1):
+            future.result()
+            print(f"\t\tcomputed tile: {count} / {len(pending)}", end="\r")
+    print()
+    # assemble the matrix from its tiles
+    matrix = np.zeros((n_sequences, n_sequences), dtype=np.uint32)
+    for rows, columns, tile_filepath in tiles:
+        tile = np.load(tile_filepath)
+        matrix[rows, columns] = tile
+        matrix[columns, rows] = tile.T
+    return matrix
+
+
+def remove_checkpoint(checkpoint_path):
+    """
+        Removes the tiles checkpointed to checkpoint_path by
+        tiled_distances(), if any
+    """
+    if checkpoint_path and path.exists(checkpoint_path):
+        for filename in os.listdir(checkpoint_path):
+            os.remove(path.join(checkpoint_path, filename))
+        os.rmdir(checkpoint_path)
+
+
+def clade_distances(bitsets, clades, threads=1, block_size=None):
+    """
+        Computes a snp matrix per clade. The blocks of every clade's
+        upper triangle, largest clades first, share one pool of threads
+        so that a large clade does not leave the other threads idle.
+
+        Parameters:
+            bitsets (tuple): see encode_codes()
+
+            clades (dict): the indices of each clade's sequences
+
+            threads (int): number of threads
+
+            block_size (int): number of sequences per block; None to
+            size blocks to BLOCK_BYTES
+
+        Returns:
+            matrices (dict): the uint32 snp matrix of each clade
+    """
+    block_size = block_size or default_block_size(bitsets[0].shape[1])
+    clades = {clade: np.asarray(indices, dtype=np.int64)
+              for clade, indices in clades.items()}
+    matrices = {clade: np.zeros((len(indices), len(indices)),
+                                dtype=np.uint32)
+                for clade, indices in clades.items()}
+    blocks = [(clade, np.arange(i, min(i + block_size, len(indices))),
+               np.arange(j, min(j + block_size, len(indices))))
+              for clade, indices in sorted(clades.items(),
+                                           key=lambda item: -len(item[1]))
+              for i in range(0, len(indices), block_size)
+              for j in range(i, len(indices), block_size)]
+
+    def compute(block):
+        clade, rows, columns = block
+        distances = block_distances(bitsets, clades[clade][rows],
+                                    clades[clade][columns])
+        matrices[clade][np.ix_(rows, columns)] = distances
+        matrices[clade][np.ix_(columns, rows)] = distances.T
+
+    with ThreadPoolExecutor(max_workers=int(threads)) as executor:
+        list(executor.map(compute, blocks))
+    return matrices
+
+
+def cross_clade_minimums(bitsets, clades, threads=1, block_size=None,
+                         max_sequences=None):
+    """
+        Returns the minimum snp distance between the sequences of each
+        pair of clades as a square numpy array in the order of clades
+        (see clade_distances()). The diagonal is 0.
+
+        Each pair of clades is searched by a thread of the pool, in
+        blocks of each clade's sequences sorted by their distance to the
+        consensus of the other clade, nearest first. Pairs of sequences
+        whose lower bound (see lower_bounds()), against the consensus of
+        either clade, is no lower than the minimum found so far are
+        skipped and the rest are counted with an early exit (see
+        block_close_pairs()). The bounds rule out few pairs of clades
+        whose diversity is comparable to the distance between them, in
+        which case every pair of sequences in different clades may be
+        counted: about the cost of the full snp matrix. With
+        max_sequences, only the max_sequences sequences of each clade
+        nearest the other clade are searched, for an upper bound on
+        each minimum at a cost of at most max_sequences squared pairs
+        per pair of clades.
+
+        Parameters:
+            bitsets (tuple): see encode_codes()
+
+            clades (dict): the indices of each clade's sequences
+
+            threads (int): number of threads
+
+            block_size (int): number of sequences per block
+
+            max_sequences (int): number of sequences of each clade to
+            search per pair of clades; None for all
+    """
+    block_size = block_size or CLOSE_PAIRS_BLOCK_SIZE
+    indices = [np.asarray(clade_indices, dtype=np.int64)
+               for clade_indices in clades.values()]
+    # distances of every sequence to the consensus of each clade
+    bounds = [lower_bounds(bitsets, reference_bitsets(
+        tuple(bitset[clade_indices] for bitset in bitsets)))
+              for clade_indices in indices]
+    n_masked = bounds[0][1] if bounds else None
+    minimums = np.full((len(indices), len(indices)), np.iinfo(np.uint32).max,
+                       dtype=np.uint32)
+    np.fill_diagonal(minimums, 0)
+
+    def compute(pair):
+        a, b = pair
+        rows = indices[a][np.argsort(bounds[b][0][indices[a]],
+                                     kind="stable")][:max_sequences]
+        columns = indices[b][np.argsort(bounds[a][0][indices[b]],
+                                        kind="stable")][:max_sequences]
+        blocks = sorted(((i, j) for i in range(0, len(rows), block_size)
+                         for j in range(0, len(columns), block_size)),
+                        key=sum)
+        minimum = int(np.iinfo(np.uint32).max)
+        for i, j in blocks:
+            block_rows = rows[i:i + block_size]
+            block_columns = columns[j:j + block_size]
+            candidates = np.ones((len(block_rows), len(block_columns)),
+                                 dtype=bool)
+            for n_differences, _ in (bounds[a], bounds[b]):
+                candidates &= np.maximum(
+                    n_differences[block_rows, None] -
+                    n_differences[None, block_columns] -
+                    n_masked[None, block_columns],
+                    n_differences[None, block_columns] -
+                    n_differences[block_rows, None] -
+                    n_masked[block_rows, None]) < minimum
+            k, m = np.nonzero(candidates)
+            if len(k):
+                _, _, counts = block_close_pairs(
+                    bitsets, block_rows[k], block_columns[m], minimum - 1)
+                if len(counts):
+                    minimum = int(counts.min())
+            if minimum == 0:
+                break
+        return a, b, minimum
+
+    pairs = sorted(((a, b) for a in range(len(indices))
+                    for b in range(a + 1, len(indices))),
+                   key=lambda pair: -len(indices[pair[0]]) *
+                   len(indices[pair[1]]))
+    with ThreadPoolExecutor(max_workers=int(threads)) as executor:
+        for a, b, minimum in executor.map(compute, pairs):
+            minimums[a, b] = minimums[b, a] = minimum
+    return minimums
+
+
+def reference_bitsets(bitsets, chunk_size=1024):
+    """
+        Returns the bitsets (see encode_codes()) of a single sequence
+        holding the most common ACGT base of each site of bitsets. The
+        sequences are unpacked chunk_size at a time.
+    """
+    hi, lo, acgt = bitsets
+    counts = np.zeros((4, hi.shape[1] * 64), dtype=np.int64)
+    for start in range(0, len(hi), chunk_size):
+        unpacked = [np.unpackbits(bitset[start:start + chunk_size].view(
+            np.uint8), axis=1, bitorder="little").astype(bool)
+                    for bitset in bitsets]
+        for code in range(4):
+            counts[code] += (unpacked[2] & (unpacked[0] == code >> 1) &
+                             (unpacked[1] == (code & 1))).sum(axis=0)
+    return encode_codes(counts.argmax(axis=0).astype(np.uint8)[None, :])
+
+
+def lower_bounds(bitsets, reference):
+    """
+        Returns, for each sequence of bitsets, the number of sites at
+        which it is ACGT and differs from reference (see
+        reference_bitsets()) and the number of sites, including padding,
+        at which it is not ACGT. For sequences a and b, with
+        distances to the reference r and non-ACGT sites m, the snp
+        distance is at least max(r_a - r_b - m_b, r_b - r_a - m_a):
+        every site at which a differs from the reference is counted
+        unless b also differs from it or is not ACGT there.
+    """
+    hi, lo, acgt = bitsets
+    differences = hi ^ reference[0]
+    differences |= lo ^ reference[1]
+    differences &= acgt
+    n_differences = popcount(differences).sum(axis=1, dtype=np.int64)
+    n_masked = hi.shape[1] * 64 - popcount(acgt.copy()).sum(axis=1,
+                                                           dtype=np.int64)
+    return n_differences, n_masked
+
+
+def block_close_pairs(bitsets, rows, columns, max_distance,
+                      chunk_words=EARLY_EXIT_WORDS):
+    """
+        Returns the pairs (rows[a], columns[b]) whose snp distance is at
+        most max_distance, and their distances, counting each pair's
+        differences chunk_words words at a time and dropping it as soon
+        as its count exceeds max_distance
+    """
+    hi, lo, acgt = bitsets
+    counts = np.zeros(len(rows), dtype=np.int64)
+    for start in range(0, hi.shape[1], chunk_words):
+        words = slice(start, start + chunk_words)
+        differences = hi[rows, words] ^ hi[columns, words]
+        differences |= lo[rows, words] ^ lo[columns, words]
+        differences &= acgt[rows, words]
+        differences &= acgt[columns, words]
+        counts += popcount(differences).sum(axis=1, dtype=np.int64)
+        close = counts <= max_distance
+        rows, columns, counts = rows[close], columns[close], counts[close]
+    return rows, columns, counts
+
+
+def close_pairs(bitsets, max_distance, threads=1, block_size=None):
+    """
+        Finds the pairs of sequences whose snp distance is at most
+        max_distance. Sequences are sorted by their distance to the
+        most common base of each site, so that pairs ruled out by the
+        lower bounds of lower_bounds() are grouped into blocks that are
+        skipped; the remaining pairs are counted with an early exit.
+
+        Parameters:
+            bitsets (tuple): see encode_codes()
+
+            max_distance (int): maximum snp distance
+
+            threads (int): number of threads
+
+            block_size (int): number of sequences per block
+
+        Returns:
+            pairs (tuple): numpy arrays of the indices, a < b, of the
+            sequences of each close pair and of their distances, sorted
+            by a and b
+
+            metadata (dict): the numbers of pairs, of pairs ruled out by
+            the lower bounds and of close pairs
+    """
+    n_sequences = len(bitsets[0])
+    block_size = block_size or CLOSE_PAIRS_BLOCK_SIZE
+    n_differences, n_masked = lower_bounds(bitsets,
+                                           reference_bitsets(bitsets))
+    order = np.argsort(n_differences, kind="stable")
+    row_blocks = [order[i:i + block_size]
+                  for i in range(0, n_sequences, block_size)]
+
+    def compute(block):
+        i, j = block
+        rows, columns = row_blocks[i], row_blocks[j]
+        bounds = np.maximum(
+            n_differences[rows, None] - n_differences[None, columns] -
+            n_masked[None, columns],
+            n_differences[None, columns] - n_differences[rows, None] -
+            n_masked[rows, None])
+        candidates = bounds <= max_distance
+        if i == j:
+            candidates = np.triu(candidates, 1)
+        a, b = np.nonzero(candidates)
+        if not len(a):
+            return 0, a, b, np.zeros(0, dtype=np.int64)
+        return (len(a),) + block_close_pairs(bitsets, rows[a], columns[b],
+                                             max_distance)
+
+    blocks = [(i, j) for i in range(len(row_blocks))
+              for j in range(i, len(row_blocks))]
+    with ThreadPoolExecutor(max_workers=int(threads)) as executor:
+        results = list(executor.map(compute, blocks))
+    n_compared = sum(result[0] for result in results)
+    a = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                       [result[1] for result in results])
+    b = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                       [result[2] for result in results])
+    pair_distances = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                                    [result[3] for result in results])
+    a, b = np.minimum(a, b), np.maximum(a, b)
+    sort = np.lexsort((b, a))
+    n_pairs = n_sequences * (n_sequences - 1) // 2
+    return (a[sort], b[sort], pair_distances[sort]), \
+        {"number_of_pairs": n_pairs,
+         "number_of_pairs_pruned": n_pairs - n_compared,
+         "number_of_close_pairs": len(a)}
+
+
+def write_edge_list(edge_list_outpath, names, pairs):
+    """
+        Writes close pairs (see close_pairs()) as a csv edge list with
+        columns sample_a, sample_b and distance
+    """
+    with open(edge_list_outpath, "w") as f:
+        f.write("sample_a,sample_b,distance\n")
+        for a, b, distance in zip(*pairs):
+            f.write(f"{names[a]},{names[b]},{distance}\n")
+
+
+def build_edge_list(edge_list_outpath, names, bitsets, max_distance,
+                    threads=1):
+    """
+        Writes the pairs of sequences within max_distance snps of each
+        other to a csv edge list, see close_pairs()
+
+        Returns:
+            metadata (dict): see close_pairs()
+    """
+    pairs, metadata = close_pairs(bitsets, max_distance, threads)
+    write_edge_list(edge_list_outpath, names, pairs)
+    return metadata
+
+
+def write_snp_matrix(snp_dists_outpath, names, matrix):
+    """
+        Writes matrix in the format of 'snp-dists -c'
+    """
+    with open(snp_dists_outpath, "w") as f:
+        f.write(",".join([f"snp-dists {SNP_DISTS_VERSION}"] + names) + "\n")
+        for name, row in zip(names, matrix):
+            f.write(",".join([name] + row.astype(str).tolist()) + "\n")
+
+
+def use_checkpoint(n_sequences, checkpoint=False):
+    """
+        Returns True if the snp matrix of n_sequences sequences is to be
+        checkpointed: if checkpoint is set or the matrix has at least
+        CHECKPOINT_MIN_SEQUENCES sequences
+    """
+    return checkpoint or n_sequences >= CHECKPOINT_MIN_SEQUENCES
+
+
+def distance_matrix(bitsets, threads=1, checkpoint_path=None):
+    """
+        Computes the matrix of pairwise snp distances with threads
+        threads or, if checkpoint_path is given, with threads worker
+        processes checkpointing tiles to checkpoint_path (see
+        tiled_distances())
+    """
+    if checkpoint_path:
+        return tiled_distances(bitsets, checkpoint_path, threads)
+    return pairwise_distances(bitsets, threads)
+
+
+def build_snp_matrix(snp_dists_outpath, snp_sites_outpath, threads=1,
+                     checkpoint_path=None):
+    """
+        Native equivalent of 'snp-dists -c -j threads snp_sites_outpath
+        > snp_dists_outpath'. See distance_matrix() for checkpoint_path.
+    """
+    names, bitsets = encode_alignment(snp_sites_outpath)
+    write_snp_matrix(snp_dists_outpath, names,
+                     distance_matrix(bitsets, threads, checkpoint_path))
+    remove_checkpoint(checkpoint_path)
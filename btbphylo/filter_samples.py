@@ -137,21 +137,49 @@ def filter_columns_categorical(df, **kwargs):
     return df.query(query)
 
 
+def parquet_filters(**kwargs):
+    """
+        Translates filter_df() kwargs into pyarrow filter expressions so
+        that only the partitions and row groups of a parquet sample
+        summary which may contain matching samples are read. Kwargs
+        that are malformed, or 'not_' prefixed (pyarrow excludes missing
+        values where pandas keeps them), are not translated and are
+        left to filter_df().
+    """
+    # "Pass" only samples by default, as in filter_df()
+    if "Outcome" not in kwargs:
+        kwargs = {"Outcome": ["Pass"], **kwargs}
+    filters = []
+    for column_name, value in kwargs.items():
+        if column_name not in utils.WGS_DTYPES:
+            continue
+        if utils.WGS_DTYPES[column_name] == float:
+            if isinstance(value, (list, tuple)) and len(value) == 2 and \
+                    all(isinstance(item, (float, int)) for item in value):
+                filters.extend([(column_name, ">=", value[0]),
+                                (column_name, "<=", value[1])])
+        elif isinstance(value, list) and all(isinstance(item, str) for
+                                             item in value):
+            filters.append((column_name, "in", value))
+    return filters
+
+
 def get_wgs_samples_df(df_samples=None, allow_wipe_out=False,
                        summary_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH,
                        **kwargs):
     """
         Gets all the WGS samples to be included in phylogeny. Parses
-        all_wgs_samples csv file into a pandas DataFrame. Filters the
-        DataFrame arcording to criteria descriped in **kwargs.
+        all_wgs_samples csv file (or parquet dataset) into a pandas
+        DataFrame. Filters the DataFrame arcording to criteria descriped
+        in **kwargs.
     """
-    # pipes the output DataFrame from wgs_csv_to_df() (all wgs samples) into
-    # filter_df() i.e. wgs_csv_to_df() | filter_df() > df
+    # pipes the output DataFrame from load_wgs_samples() (all wgs samples)
+    # into filter_df() i.e. load_wgs_samples() | filter_df() > df
     if df_samples is not None:
         df = df_samples.pipe(filter_df, allow_wipe_out, **kwargs)
     else:
-        df = utils.wgs_csv_to_df(summary_filepath).pipe(filter_df,
-                                                        allow_wipe_out,
-                                                        **kwargs)
+        df = utils.load_wgs_samples(summary_filepath,
+                                    filters=parquet_filters(**kwargs)).\
+            pipe(filter_df, allow_wipe_out, **kwargs)
     metadata = {"number_of_passed_samples": len(df)}
     return df, metadata
@@ -0,0 +1,285 @@
+import os
+import json
+from os import path
+
+import numpy as np
+
+import btbphylo.alignment as alignment
+import btbphylo.distances as distances
+import btbphylo.snp_matrix as snp_matrix
+
+"""
+    Incremental snp matrices. A run with the native engines saves the
+    state of its alignment to a directory:
+
+        state.json          samples, sequence names, consensus ETags and
+                            alignment length
+        base_counts.npy     4 x L counts of A, C, G and T per column
+        invalid_counts.npy  L counts of non-ACGT bases per column
+        positions.npy       0-based positions of the snp sites
+        codes.npy           N x S nucleotide codes at the snp sites
+        distances.npy       N x N snp distances
+
+    The next run updates the state rather than rebuilding it: removed
+    samples are subtracted from the column counts, new samples are
+    added, and only the distances from new samples to all samples are
+    computed. Distances between the samples that are kept are corrected
+    for sites that leave the snp set and for sites that join it; old
+    samples are rescanned only at new sites whose bases they were not
+    already known to share.
+"""
+
+STATE_FILENAME = "state.json"
+STATE_ARRAYS = ("base_counts", "invalid_counts", "positions", "codes",
+                "distances")
+
+
+class IncompatibleStateError(Exception):
+    def __init__(self, reason):
+        super().__init__()
+        self.message = f"Cannot update the previous state: {reason}"
+
+    def __str__(self):
+        return self.message
+
+
+def count_columns(codes, base_counts, invalid_counts, sign=1):
+    """
+        Adds (sign=1) or subtracts (sign=-1) a sequence's nucleotide
+        codes to or from the per-column counts, in-place
+    """
+    for code in range(4):
+        if sign > 0:
+            base_counts[code] += codes == code
+        else:
+            base_counts[code] -= codes == code
+    if sign > 0:
+        invalid_counts += codes == 4
+    else:
+        invalid_counts -= codes == 4
+
+
+def snp_positions(base_counts, invalid_counts):
+    """
+        Returns the positions of the columns that are ACGT-only and
+        variable, i.e. the sites output by 'snp-sites -c'
+    """
+    return np.flatnonzero((invalid_counts == 0) &
+                          ((base_counts > 0).sum(axis=0) > 1))
+
+
+def build_state(multi_fasta_path, samples, etags, threads=1,
+                checkpoint_path=None):
+    """
+        Builds the alignment state from scratch
+
+        Parameters:
+            multi_fasta_path (str): path to the multi fasta
+
+            samples (list): the sample of each record of the multi fasta
+
+            etags (list): the consensus ETag of each sample
+
+            threads (int): number of threads for distances
+
+            checkpoint_path (str): optional directory for checkpointing
+            distances, see distances.distance_matrix()
+
+        Returns:
+            state (dict): alignment state
+    """
+    names, base_counts, invalid_counts = [], None, None
+    with alignment.map_fasta(multi_fasta_path) as contents:
+        spans = list(alignment.record_spans(contents))
+        for name, span in spans:
+            codes = alignment.NUCLEOTIDE_CODES[
+                alignment.record_sequence(contents, span)]
+            if base_counts is None:
+                base_counts = np.zeros((4, len(codes)), dtype=np.uint32)
+                invalid_counts = np.zeros(len(codes), dtype=np.uint32)
+            elif len(codes) != base_counts.shape[1]:
+                raise ValueError(f"Sequence '{name.decode()}' is not the "
+                                 "same length as the alignment")
+            count_columns(codes, base_counts, invalid_counts)
+            names.append(name.decode())
+        if base_counts is None:
+            base_counts = np.zeros((4, 0), dtype=np.uint32)
+            invalid_counts = np.zeros(0, dtype=np.uint32)
+        positions = snp_positions(base_counts, invalid_counts)
+        codes = np.zeros((len(spans), len(positions)), dtype=np.uint8)
+        for i, (_, span) in enumerate(spans):
+            codes[i] = alignment.NUCLEOTIDE_CODES[
+                alignment.record_sequence(contents, span)[positions]]
+    if len(samples) != len(names):
+        raise ValueError("The number of samples does not match the multi "
+                         "fasta")
+    return {"samples": list(samples), "names": names, "etags": list(etags),
+            "alignment_length": base_counts.shape[1],
+            "base_counts": base_counts, "invalid_counts": invalid_counts,
+            "positions": positions, "codes": codes,
+            "distances": distances.distance_matrix(
+                distances.encode_codes(codes), threads, checkpoint_path)}
+
+
+def update_state(state, multi_fasta_path, samples, etags, cache,
+                 threads=1):
+    """
+        Updates a previous run's alignment state to the samples of a
+        new multi fasta. Raises IncompatibleStateError if the state
+        cannot be updated, e.g. if the consensus of a removed or changed
+        sample is no longer cached.
+
+        Parameters:
+            state (dict): previous alignment state, see load_state()
+
+            multi_fasta_path (str): path to the multi fasta
+
+            samples (list): the sample of each record of the multi fasta
+
+            etags (list): the consensus ETag of each sample
+
+            cache (consensus_cache.ConsensusCache object): consensus
+            cache holding the consensus of removed samples
+
+            threads (int): number of threads for distances
+
+        Returns:
+            state (dict): updated alignment state
+
+            metadata (dict): the work saved compared with a full
+            rebuild
+    """
+    previous = {sample: i for i, (sample, etag) in
+                enumerate(zip(state["samples"], state["etags"]))}
+    # samples whose consensus changed are removed and added again
+    kept = [sample in previous and
+            state["etags"][previous[sample]] == etag
+            for sample, etag in zip(samples, etags)]
+    kept_previous = np.array([previous[sample] for sample, is_kept in
+                              zip(samples, kept) if is_kept], dtype=np.int64)
+    removed = sorted(set(range(len(state["samples"]))) - set(kept_previous))
+    base_counts = state["base_counts"].copy()
+    invalid_counts = state["invalid_counts"].copy()
+    # subtract removed samples from the column counts
+    for i in removed:
+        sample = state["samples"][i]
+        if sample not in cache or \
+                cache.index[sample].get("ETag") != state["etags"][i]:
+            raise IncompatibleStateError(f"the consensus of '{sample}' used "
+                                         "by the previous state is not "
+                                         "cached")
+        contents = cache.read(sample)
+        (name, span), = alignment.record_spans(contents)
+        codes = alignment.NUCLEOTIDE_CODES[
+            alignment.record_sequence(contents, span)]
+        if len(codes) != state["alignment_length"]:
+            raise IncompatibleStateError(f"'{sample}' has changed")
+        count_columns(codes, base_counts, invalid_counts, -1)
+    with alignment.map_fasta(multi_fasta_path) as contents:
+        spans = list(alignment.record_spans(contents))
+        if len(spans) != len(samples):
+            raise ValueError("The number of samples does not match the "
+                             "multi fasta")
+        # add new samples to the column counts
+        added = [i for i, is_kept in enumerate(kept) if not is_kept]
+        for i in added:
+            codes = alignment.NUCLEOTIDE_CODES[
+                alignment.record_sequence(contents, spans[i][1])]
+            if len(codes) != state["alignment_length"]:
+                raise IncompatibleStateError("the alignment length has "
+                                             "changed")
+            count_columns(codes, base_counts, invalid_counts)
+        positions = snp_positions(base_counts, invalid_counts)
+        previous_positions = state["positions"]
+        in_previous = np.isin(positions, previous_positions)
+        new_sites = positions[~in_previous]
+        # new sites that were ACGT in every previous sample were
+        # constant, so the bases of kept samples are known; the rest
+        # must be rescanned
+        known = state["invalid_counts"][new_sites] == 0
+        rescan_sites = new_sites[~known]
+        codes = np.zeros((len(spans), len(positions)), dtype=np.uint8)
+        kept_rows = np.flatnonzero(kept)
+        previous_codes = state["codes"][kept_previous]
+        codes[np.ix_(kept_rows, np.flatnonzero(in_previous))] = \
+            previous_codes[:, np.searchsorted(previous_positions,
+                                              positions[in_previous])]
+        codes[np.ix_(kept_rows, np.flatnonzero(~in_previous)[known])] = \
+            state["base_counts"][:, new_sites[known]].argmax(axis=0)
+        rescan_columns = np.flatnonzero(~in_previous)[~known]
+        if len(rescan_sites):
+            for i in kept_rows:
+                codes[i, rescan_columns] = alignment.NUCLEOTIDE_CODES[
+                    alignment.record_sequence(contents,
+                                              spans[i][1])[rescan_sites]]
+        for i in added:
+            codes[i] = alignment.NUCLEOTIDE_CODES[
+                alignment.record_sequence(contents, spans[i][1])[positions]]
+        names = [name.decode() for name, _ in spans]
+    # correct distances between kept samples for sites that left or
+    # joined the snp set
+    left_sites = np.isin(previous_positions, positions, invert=True)
+    kept_distances = state["distances"][np.ix_(kept_previous, kept_previous)]
+    kept_distances -= distances.pairwise_distances(
+        distances.encode_codes(previous_codes[:, left_sites]), threads)
+    kept_distances += distances.pairwise_distances(
+        distances.encode_codes(codes[np.ix_(kept_rows, rescan_columns)]),
+        threads)
+    matrix = np.zeros((len(spans), len(spans)), dtype=np.uint32)
+    matrix[np.ix_(kept_rows, kept_rows)] = kept_distances
+    # compute distances from new samples to all samples
+    distances.pairwise_distances(distances.encode_codes(codes), threads,
+                                 rows=added, matrix=matrix)
+    n_pairs = len(spans) * (len(spans) - 1) // 2
+    n_reused = len(kept_rows) * (len(kept_rows) - 1) // 2
+    metadata = {"samples_kept": len(kept_rows),
+                "samples_added": len(added),
+                "samples_removed": len(removed),
+                "sites_added": len(new_sites),
+                "sites_removed": int(left_sites.sum()),
+                "sites_rescanned": len(rescan_sites),
+                "distances_reused": n_reused,
+                "distances_computed": n_pairs - n_reused,
+                "distances_computed_by_full_rebuild": n_pairs,
+                "sequences_scanned": 2 * len(added) + len(removed) +
+                (len(kept_rows) if len(rescan_sites) else 0),
+                "sequences_scanned_by_full_rebuild": 2 * len(spans)}
+    return {"samples": list(samples), "names": names, "etags": list(etags),
+            "alignment_length": state["alignment_length"],
+            "base_counts": base_counts, "invalid_counts": invalid_counts,
+            "positions": positions, "codes": codes,
+            "distances": matrix}, metadata
+
+
+def write_outputs(state, snp_sites_outpath, snp_dists_outpath,
+                  matrix_format="csv"):
+    """
+        Writes the snp alignment, in the format of 'snp-sites -c', and
+        the snp matrix of state, see snp_matrix.save_matrix()
+    """
+    alignment.write_codes(snp_sites_outpath, state["names"], state["codes"])
+    snp_matrix.save_matrix(snp_dists_outpath, state["names"],
+                           state["distances"], matrix_format)
+
+
+def save_state(state_path, state):
+    """
+        Saves state to the directory state_path
+    """
+    os.makedirs(state_path, exist_ok=True)
+    for name in STATE_ARRAYS:
+        np.save(path.join(state_path, f"{name}.npy"), state[name])
+    with open(path.join(state_path, STATE_FILENAME), "w") as f:
+        json.dump({key: value for key, value in state.items()
+                   if key not in STATE_ARRAYS}, f)
+
+
+def load_state(state_path):
+    """
+        Loads a state saved by save_state()
+    """
+    with open(path.join(state_path, STATE_FILENAME)) as f:
+        state = json.load(f)
+    for name in STATE_ARRAYS:
+        state[name] = np.load(path.join(state_path, f"{name}.npy"))
+    return state
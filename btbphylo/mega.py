@@ -0,0 +1,275 @@
+import os
+import glob
+import warnings
+from os import path
+from concurrent.futures import ThreadPoolExecutor
+
+import btbphylo.utils as utils
+import btbphylo.alignment as alignment
+import btbphylo.neighbour_joining as neighbour_joining
+
+"""
+    Orchestration of megacc maximum parsimony trees. The MEGA analysis
+    options (.mao) are generated at run time from accessory/infer_MP.mao
+    with the requested threads, bootstrap replicates, initial trees and
+    search level.
+
+    The bootstrap replicates of a tree are split into blocks, one per
+    concurrent megacc job, as many jobs as fit in the machine's CPUs
+    for the threads of each; each job runs megacc's own bootstrap test
+    of its block, so a tree costs one megacc process per job rather
+    than per replicate. The first job's tree is the main tree and the
+    support of each of its splits is the mean of the jobs' supports
+    weighted by their numbers of replicates. Supports are read from
+    each job's tree, which labels all of its splits, rather than from
+    a majority-rule consensus; a job's support is 0 only if its search
+    found a tree without the split.
+"""
+
+MAO_TEMPLATE_PATH = \
+    path.join(path.dirname(path.dirname(path.abspath(__file__))),
+              "accessory/infer_MP.mao")
+DEFAULT_THREADS = 4
+DEFAULT_BOOTSTRAPS = 200
+DEFAULT_INITIAL_TREES = 100
+DEFAULT_SEARCH_LEVEL = 1
+MP_TREE_FILENAME = "mp_tree.nwk"
+# megacc needs at least 4 taxa
+MIN_TAXA = 4
+
+
+def write_mao(mao_path, threads=DEFAULT_THREADS, bootstraps=0,
+              initial_trees=DEFAULT_INITIAL_TREES,
+              search_level=DEFAULT_SEARCH_LEVEL,
+              template_path=MAO_TEMPLATE_PATH):
+    """
+        Writes MEGA analysis options for a maximum parsimony search,
+        with a bootstrap test of bootstraps replicates (none if 0), i.e.
+        template_path with the given settings
+    """
+    settings = {"Test of Phylogeny":
+                "Bootstrap method" if bootstraps else "None",
+                "No. of Bootstrap Replications":
+                bootstraps if bootstraps else "Not Applicable",
+                "Number of Threads": threads,
+                "No. of Initial Trees (random addition)": initial_trees,
+                "MP Search level": search_level}
+    with open(template_path, "r") as src, open(mao_path, "w") as dest:
+        for line in src:
+            key, separator, value = line.rstrip("\n").partition("=")
+            if separator and key.strip() in settings:
+                line = f"{key}= " + \
+                    f"{settings[key.strip()]}".ljust(len(value) - 1) + "\n"
+            dest.write(line)
+
+
+def concurrent_jobs(threads=DEFAULT_THREADS, cpus=None):
+    """
+        Returns the number of megacc jobs of threads threads that fit in
+        cpus (all CPUs by default)
+    """
+    cpus = cpus or os.cpu_count() or 1
+    return max(1, cpus // threads)
+
+
+def job_sizes(bootstraps, threads=DEFAULT_THREADS, cpus=None):
+    """
+        Splits bootstrap replicates into blocks, one per megacc job of
+        threads threads, as many jobs as fit in cpus (all CPUs by
+        default)
+
+        Returns:
+            sizes (list): the number of replicates of each job
+    """
+    n_jobs = max(1, min(bootstraps, concurrent_jobs(threads, cpus)))
+    return [bootstraps // n_jobs + (i < bootstraps % n_jobs)
+            for i in range(n_jobs)]
+
+
+def read_trees(job_path):
+    """
+        Returns the trees, in Newick format, written by a megacc job:
+        the equally parsimonious trees found by its search, labelled
+        with bootstrap supports if it ran a bootstrap test
+    """
+    trees = []
+    for filepath in sorted(glob.glob(path.join(job_path, "*.nwk"))):
+        # megacc also writes a consensus tree
+        if "consensus" in path.basename(filepath):
+            continue
+        with open(filepath, "r") as f:
+            trees.extend(f"{tree.strip()};" for tree in f.read().split(";")
+                         if tree.strip())
+    if not trees:
+        raise FileNotFoundError(f"No tree in {job_path}")
+    return trees
+
+
+def run_megacc(job_path, snp_sites_outpath, threads=DEFAULT_THREADS,
+               bootstraps=0, initial_trees=DEFAULT_INITIAL_TREES,
+               search_level=DEFAULT_SEARCH_LEVEL):
+    """
+        Runs a megacc maximum parsimony search, with a bootstrap test of
+        bootstraps replicates, writing its analysis options and output
+        to job_path
+
+        Returns:
+            trees (list): the equally parsimonious trees found
+    """
+    os.makedirs(job_path, exist_ok=True)
+    mao_path = path.join(job_path, "infer_MP.mao")
+    write_mao(mao_path, threads, bootstraps, initial_trees, search_level)
+    utils.run(["megacc", "-a", mao_path, "-d", snp_sites_outpath, "-o",
+               job_path])
+    return read_trees(job_path)
+
+
+def bootstrap_supports(main_tree, job_trees, weights):
+    """
+        Pools the bootstrap supports of megacc jobs that split the
+        replicates of one tree, see the module docstring
+
+        Parameters:
+            main_tree (str): the main tree, in Newick format
+
+            job_trees (list): the tree of each job, in Newick format,
+            labelled with its bootstrap supports
+
+            weights (list): the number of replicates of each job
+
+        Returns:
+            children (list): the main tree, see
+            neighbour_joining.neighbour_joining()
+
+            names (list): leaf names
+
+            supports (list): the percentage of the pooled replicates
+            containing the split of each internal node; None for the
+            root and for splits of single leaves. None if there are no
+            replicates.
+    """
+    children, names, _ = neighbour_joining.parse_newick(main_tree)
+    if not sum(weights):
+        return children, names, None
+    index = {name: i for i, name in enumerate(names)}
+    totals = {}
+    for tree, weight in zip(job_trees, weights):
+        job_children, job_names, labels = neighbour_joining.parse_newick(tree)
+        if sorted(job_names) != sorted(names):
+            raise ValueError("Bootstrap trees have different taxa")
+        job_children = neighbour_joining.relabel(
+            job_children, [index[name] for name in job_names])
+        for split, label in zip(neighbour_joining.splits(job_children,
+                                                         len(names)),
+                                labels):
+            if split is not None and label is not None:
+                totals[split] = totals.get(split, 0) + weight * float(label)
+    return children, names, \
+        [None if split is None else round(totals.get(split, 0) /
+                                          sum(weights))
+         for split in neighbour_joining.splits(children, len(names))]
+
+
+def build_tree(tree_path, snp_sites_outpath, threads=DEFAULT_THREADS,
+               bootstraps=DEFAULT_BOOTSTRAPS,
+               initial_trees=DEFAULT_INITIAL_TREES,
+               search_level=DEFAULT_SEARCH_LEVEL, cpus=None):
+    """
+        Builds a maximum parsimony tree with megacc, see the module
+        docstring, splitting its bootstrap replicates into concurrent
+        jobs written to tree_path/job_<i>, and writes it, labelled with
+        the pooled bootstrap supports, to tree_path/mp_tree.nwk
+
+        Parameters:
+            tree_path (str): output directory
+
+            snp_sites_outpath (str): path to the snp alignment
+
+            threads (int): number of threads per megacc job
+
+            bootstraps (int): number of bootstrap replicates; 0 for none
+
+            initial_trees (int): number of initial trees (random
+            addition)
+
+            search_level (int): MP search level
+
+            cpus (int): number of CPUs to use; None for all
+
+        Returns:
+            metadata (dict): the number of megacc jobs and the bootstrap
+            replicates of each
+    """
+    n_taxa = sum(1 for _ in alignment.fasta_records(snp_sites_outpath))
+    if n_taxa < MIN_TAXA:
+        warnings.warn("Unable to build tree! Need at least 4 taxa for tree \
+            building")
+        return {}
+    os.makedirs(tree_path, exist_ok=True)
+    sizes = job_sizes(bootstraps, threads, cpus)
+    with ThreadPoolExecutor(max_workers=len(sizes)) as executor:
+        job_trees = list(executor.map(
+            lambda job: run_megacc(path.join(tree_path, f"job_{job[0]}"),
+                                   snp_sites_outpath, threads, job[1],
+                                   initial_trees, search_level),
+            enumerate(sizes)))
+    main_trees = job_trees[0]
+    if len(main_trees) > 1:
+        print(f"\t\t{len(main_trees)} equally parsimonious trees: keeping "
+              "the first")
+    children, names, supports = bootstrap_supports(
+        main_trees[0], [trees[0] for trees in job_trees], sizes)
+    with open(path.join(tree_path, MP_TREE_FILENAME), "w") as f:
+        f.write(neighbour_joining.to_newick(children, names, supports) +
+                "\n")
+    return {"megacc_jobs": len(sizes), "bootstraps_per_job": sizes}
+
+
+def build_clade_trees(tree_path, snp_sites_outpath, clades,
+                      threads=DEFAULT_THREADS, bootstraps=DEFAULT_BOOTSTRAPS,
+                      initial_trees=DEFAULT_INITIAL_TREES,
+                      search_level=DEFAULT_SEARCH_LEVEL, cpus=None):
+    """
+        Builds a maximum parsimony tree per clade, see build_tree(),
+        each writing to tree_path/<clade>, running as many clades at a
+        time as fit in cpus. Clades of fewer than 4 samples are skipped.
+
+        Parameters:
+            tree_path (str): output directory
+
+            snp_sites_outpath (str): path to the snp alignment
+
+            clades (dict): the sequence names of each clade
+
+            threads, bootstraps, initial_trees, search_level, cpus: see
+            build_tree()
+
+        Returns:
+            metadata (dict): the clades for which trees were built
+    """
+    clade_of = {name: clade for clade, names in clades.items()
+                for name in names}
+    os.makedirs(tree_path, exist_ok=True)
+    files = {clade: open(path.join(tree_path, f"{clade}.fas"), "wb")
+             for clade, names in clades.items() if len(names) >= MIN_TAXA}
+    try:
+        # split the snp alignment by clade
+        for name, sequence in alignment.fasta_records(snp_sites_outpath):
+            clade = clade_of.get(name.decode())
+            if clade in files:
+                files[clade].write(b">" + name + b"\n" + sequence.tobytes() +
+                                   b"\n")
+    finally:
+        for f in files.values():
+            f.close()
+    # largest clades first, each running one megacc job at a time
+    jobs = sorted(files, key=lambda clade: -len(clades[clade]))
+    with ThreadPoolExecutor(max_workers=concurrent_jobs(threads, cpus)) \
+            as executor:
+        list(executor.map(
+            lambda clade: build_tree(path.join(tree_path, clade),
+                                     path.join(tree_path, f"{clade}.fas"),
+                                     threads, bootstraps, initial_trees,
+                                     search_level, cpus=threads), jobs))
+    return {"megacc_clades": jobs,
+            "megacc_skipped_clades": sorted(set(clades) - set(files))}
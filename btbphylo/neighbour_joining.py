@@ -0,0 +1,330 @@
+import os
+import re
+import warnings
+from os import path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import btbphylo.alignment as alignment
+import btbphylo.distances as distances
+
+"""
+    A native neighbour-joining tree engine, a fast alternative to
+    maximum parsimony with megacc. Trees are built from the snp
+    distances of the snp alignment and written in Newick format.
+
+    Each iteration joins the pair (i, j) minimising
+    q(i, j) = d(i, j) - u(i) - u(j), where u(i) is the sum of the
+    distances from i divided by the number of nodes less 2. As in
+    rapidNJ, the search is pruned with a lower bound per row,
+    min_j d(i, j) - u(i) - max(u), so that only the rows whose bound is
+    below the best q found so far are scanned.
+
+    Bootstrap replicates resample the sites of the snp alignment and are
+    built by a pool of worker processes; the support of each split of
+    the tree is the percentage of replicates containing it.
+"""
+
+DEFAULT_BOOTSTRAPS = 100
+TREE_FILENAME = "nj_tree.nwk"
+# number of rows of q computed at a time
+SEARCH_ROWS = 16
+
+# snp alignment of each worker process of bootstrap_supports()
+_worker_codes = None
+
+
+def neighbour_joining(matrix):
+    """
+        Builds a neighbour-joining tree
+
+        Parameters:
+            matrix (numpy array): square, symmetric distance matrix
+
+        Returns:
+            children (list): the children of each internal node, as
+            (node, branch length) tuples; nodes 0 to N - 1 are the
+            leaves, in the order of matrix, and node N + k is the kth
+            internal node. The last node is the (unrooted) root.
+    """
+    n = len(matrix)
+    if n < 2:
+        return [[(i, 0.0) for i in range(n)]]
+    d = np.array(matrix, dtype=np.float64)
+    np.fill_diagonal(d, np.inf)
+    nodes = list(range(n))
+    active = np.ones(n, dtype=bool)
+    sums = np.where(np.isinf(d), 0, d).sum(axis=1)
+    row_argmin = d.argmin(axis=1)
+    row_min = d[np.arange(n), row_argmin]
+    children = []
+    for m in range(n, 3, -1):
+        u = np.where(active, sums / (m - 2), 0)
+        u_max = u[active].max()
+        # scan rows in order of their lower bounds until no row can
+        # contain a smaller q
+        rows = np.flatnonzero(active)
+        bounds = row_min[rows] - u[rows] - u_max
+        order = np.argsort(bounds, kind="stable")
+        best, i, j = np.inf, -1, -1
+        for start in range(0, len(rows), SEARCH_ROWS):
+            if bounds[order[start]] >= best:
+                break
+            chunk = rows[order[start:start + SEARCH_ROWS]]
+            q = d[chunk]
+            q -= u
+            q -= u[chunk, None]
+            row, column = np.unravel_index(q.argmin(), q.shape)
+            if q[row, column] < best:
+                best, i, j = q[row, column], chunk[row], column
+        i, j = min(i, j), max(i, j)
+        # branch lengths from the new node to i and j
+        length_i = d[i, j] / 2 + (sums[i] - sums[j]) / (2 * (m - 2))
+        length_j = d[i, j] - length_i
+        children.append([(nodes[i], max(length_i, 0.0)),
+                         (nodes[j], max(length_j, 0.0))])
+        # the new node takes the place of i
+        new = (d[i] + d[j] - d[i, j]) / 2
+        new[i] = new[j] = np.inf
+        active[j] = False
+        others = active.copy()
+        others[i] = False
+        sums[others] += new[others] - d[i, others] - d[j, others]
+        d[i], d[:, i] = new, new
+        d[j], d[:, j] = np.inf, np.inf
+        sums[i] = new[others].sum()
+        sums[j] = 0
+        nodes[i] = n + len(children) - 1
+        # rows whose minimum was at i or j are rescanned
+        stale = np.flatnonzero(others & np.isin(row_argmin, (i, j)))
+        row_argmin[stale] = d[stale].argmin(axis=1)
+        row_min[stale] = d[stale, row_argmin[stale]]
+        closer = others & (new < row_min)
+        row_argmin[closer] = i
+        row_min[closer] = new[closer]
+        row_argmin[i] = d[i].argmin()
+        row_min[i] = d[i, row_argmin[i]]
+        row_min[j] = np.inf
+    remaining = np.flatnonzero(active)
+    if len(remaining) == 2:
+        a, b = remaining
+        return children + [[(nodes[a], d[a, b] / 2), (nodes[b], d[a, b] / 2)]]
+    a, b, c = remaining
+    return children + [[(nodes[a], max((d[a, b] + d[a, c] - d[b, c]) / 2, 0.0)),
+                        (nodes[b], max((d[a, b] + d[b, c] - d[a, c]) / 2, 0.0)),
+                        (nodes[c], max((d[a, c] + d[b, c] - d[a, b]) / 2, 0.0))]]
+
+
+def splits(children, n_leaves):
+    """
+        Returns the split of each internal node of a tree, see
+        neighbour_joining(), as the bitmask of the leaves on the side
+        that does not contain leaf 0. Splits of single leaves and of the
+        root are None.
+    """
+    masks = [1 << leaf for leaf in range(n_leaves)]
+    for node_children in children:
+        mask = 0
+        for child, _ in node_children:
+            mask |= masks[child]
+        masks.append(mask)
+    full = (1 << n_leaves) - 1
+    return [None if mask == full or bin(mask).count("1") in (1, n_leaves - 1)
+            else (full ^ mask if mask & 1 else mask)
+            for mask in masks[n_leaves:-1]] + [None]
+
+
+def format_name(name):
+    """
+        Quotes a taxon name if it contains Newick punctuation
+    """
+    if re.search(r"[\s(),:;'\[\]]", name):
+        return "'" + name.replace("'", "''") + "'"
+    return name
+
+
+def to_newick(children, names, supports=None):
+    """
+        Formats a tree, see neighbour_joining(), in Newick format
+
+        Parameters:
+            children (list): the children of each internal node
+
+            names (list): leaf names
+
+            supports (list): optional support of each internal node,
+            written as its label
+    """
+    subtrees = [format_name(name) for name in names]
+    for k, node_children in enumerate(children):
+        label = "" if supports is None or supports[k] is None \
+            else str(supports[k])
+        subtrees.append("(" + ",".join(f"{subtrees[child]}:{length:.6g}"
+                                       for child, length in node_children) +
+                        ")" + label)
+    return subtrees[-1] + ";"
+
+
+def parse_newick(newick):
+    """
+        Parses a tree in Newick format
+
+        Parameters:
+            newick (str): the tree
+
+        Returns:
+            children (list): the children of each internal node, see
+            neighbour_joining(); leaves are numbered in order of
+            appearance and internal nodes in the order they close, so
+            that every child precedes its parent
+
+            names (list): leaf names
+
+            labels (list): the label, e.g. support, of each internal
+            node; None if it has none
+    """
+    tokens = re.findall(r"'(?:[^']|'')*'|\[[^\]]*\]|[(),:;]|[^\s(),:;\[']+",
+                        newick)
+    names, labels, children = [], [], []
+    # children of open nodes, and the last node parsed
+    stack, node = [], None
+    position = 0
+    while position < len(tokens):
+        token = tokens[position]
+        position += 1
+        if token.startswith("["):
+            continue
+        if token == "(":
+            stack.append([])
+            node = None
+        elif token in (",", ")"):
+            if node is None:
+                raise ValueError("Invalid Newick: empty node")
+            stack[-1].append(node)
+            node = None
+            if token == ")":
+                children.append(stack.pop())
+                labels.append(None)
+                node = [("internal", len(children) - 1), 0.0]
+        elif token == ":":
+            node[1] = float(tokens[position])
+            position += 1
+        elif token == ";":
+            break
+        else:
+            name = token[1:-1].replace("''", "'") \
+                if token.startswith("'") else token
+            if node is not None and node[0][0] == "internal":
+                labels[node[0][1]] = name
+            else:
+                names.append(name)
+                node = [("leaf", len(names) - 1), 0.0]
+    if stack or not children:
+        raise ValueError("Invalid Newick: unbalanced parentheses")
+
+    def number(reference):
+        kind, k = reference
+        return k if kind == "leaf" else len(names) + k
+
+    return [[(number(child), length) for child, length in node_children]
+            for node_children in children], names, labels
+
+
+def relabel(children, leaves):
+    """
+        Renumbers the leaves of a tree, see neighbour_joining(), from i
+        to leaves[i]
+    """
+    return [[(leaves[child] if child < len(leaves) else child, length)
+             for child, length in node_children]
+            for node_children in children]
+
+
+def _init_worker(codes):
+    global _worker_codes
+    _worker_codes = codes
+
+
+def _bootstrap_splits(seed):
+    rng = np.random.default_rng(seed)
+    n_leaves, n_sites = _worker_codes.shape
+    # shuffle the leaves so that ties, e.g. between identical sequences,
+    # are broken differently in each replicate
+    leaves = rng.permutation(n_leaves)
+    codes = _worker_codes[np.ix_(leaves, rng.integers(0, n_sites, n_sites))]
+    matrix = distances.pairwise_distances(distances.encode_codes(codes))
+    return set(splits(relabel(neighbour_joining(matrix), leaves),
+                      n_leaves)) - {None}
+
+
+def bootstrap_supports(codes, children, bootstraps=DEFAULT_BOOTSTRAPS,
+                       workers=1, seed=0):
+    """
+        Computes the bootstrap support of each internal node of a tree
+
+        Parameters:
+            codes (numpy array): nucleotide codes of the snp alignment,
+            with a row per leaf
+
+            children (list): the tree, see neighbour_joining()
+
+            bootstraps (int): number of bootstrap replicates
+
+            workers (int): number of worker processes
+
+            seed (int): seed of the first replicate
+
+        Returns:
+            supports (list): the percentage of replicates containing the
+            split of each internal node; None for the root
+    """
+    tree_splits = splits(children, len(codes))
+    counts = dict.fromkeys(tree_splits, 0)
+    with ProcessPoolExecutor(max_workers=int(workers),
+                             initializer=_init_worker,
+                             initargs=(codes,)) as executor:
+        for count, replicate_splits in enumerate(executor.map(
+                _bootstrap_splits, range(seed, seed + bootstraps)), 1):
+            print(f"\t\tbootstrap replicate: {count} / {bootstraps}",
+                  end="\r")
+            for split in replicate_splits:
+                if split in counts:
+                    counts[split] += 1
+    print()
+    return [None if split is None else round(100 * counts[split] / bootstraps)
+            for split in tree_splits]
+
+
+def build_tree(tree_path, snp_sites_outpath, bootstraps=DEFAULT_BOOTSTRAPS,
+               workers=1):
+    """
+        Builds a neighbour-joining tree, with bootstrap supports, from
+        the snp alignment at snp_sites_outpath and writes it to
+        tree_path/nj_tree.nwk
+
+        Parameters:
+            tree_path (str): output directory
+
+            snp_sites_outpath (str): path to the snp alignment
+
+            bootstraps (int): number of bootstrap replicates; 0 for none
+
+            workers (int): number of worker processes for bootstrapping
+    """
+    names, codes = [], []
+    for name, sequence in alignment.fasta_records(snp_sites_outpath):
+        names.append(name.decode())
+        codes.append(alignment.NUCLEOTIDE_CODES[sequence])
+    if len(names) < 3:
+        warnings.warn("Unable to build tree! Need at least 3 taxa for tree \
+            building")
+        return
+    codes = np.array(codes, dtype=np.uint8)
+    children = neighbour_joining(distances.pairwise_distances(
+        distances.encode_codes(codes), workers))
+    supports = bootstrap_supports(codes, children, bootstraps, workers) \
+        if bootstraps else None
+    os.makedirs(tree_path, exist_ok=True)
+    with open(path.join(tree_path, TREE_FILENAME), "w") as f:
+        f.write(to_newick(children, names, supports) + "\n")
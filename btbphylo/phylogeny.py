@@ -1,10 +1,18 @@
+import os
 import re
+import json
+import time
+import errno
 import warnings
+import subprocess
 from os import path
-
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import btbphylo.utils as utils
+import btbphylo.storage as storage
+import btbphylo.consensus_cache as consensus_cache
+import btbphylo.snp_matrix as snp_matrix
+import btbphylo.mega as mega
 
 """
     Performs phylogeny on specified samples: downloads samples, builds
@@ -13,6 +21,13 @@ import btbphylo.utils as utils
 
 warnings.formatwarning = utils.format_warning
 
+DEFAULT_DOWNLOAD_WORKERS = 16
+DEFAULT_DOWNLOAD_RETRIES = 3
+DEFAULT_ASSEMBLY_WORKERS = 8
+# length of the M. bovis AF2122/97 reference (LT708304.1) to which
+# consensus sequences are mapped
+REFERENCE_LENGTH = 4349904
+
 
 class BadS3UriError(Exception):
     def __init__(self, s3_uri):
@@ -23,7 +38,149 @@ class BadS3UriError(Exception):
         return self.message
 
 
-def append_multi_fasta(s3_bucket, s3_key, outfile, sample, consensus_path):
+def preflight_consensus(df, n_workers=DEFAULT_DOWNLOAD_WORKERS):
+    """
+        Resolves the s3 consensus object of every sample in df before
+        any data is downloaded. Rather than a HEAD request per sample,
+        each batch's consensus folder is listed once, concurrently,
+        with a shared storage backend. The listed ETags are used to
+        validate cached consensus files.
+
+        Parameters:
+            df (pandas DataFrame object): dataframe containing s3_uri
+            for consensus sequences of samples to be included in
+            phylogeny
+
+            n_workers (int): maximum number of concurrent listings
+
+        Returns:
+            consensus_objects (dict): 'Bucket', 'Key', 'Size', 'ETag'
+            and 'LastModified' of each consensus object to download,
+            keyed by sample name
+
+            skipped (dict): the reason each sample cannot be included,
+            i.e. a malformed 'ResultLoc' or a missing consensus object,
+            keyed by sample name
+    """
+    skipped = {}
+    required = {}
+    for sample, result_loc in zip(df["Sample"], df["ResultLoc"]):
+        try:
+            # extract the bucket and key of consensus file from s3 uri
+            required[sample] = (extract_s3_bucket(str(result_loc)),
+                                extract_s3_key(str(result_loc), sample))
+        except BadS3UriError as e:
+            skipped[sample] = e.message
+    # list each consensus folder once
+    prefixes = list({(s3_bucket, path.join(path.dirname(s3_key), ""))
+                     for s3_bucket, s3_key in required.values()})
+    store = storage.get_storage(max_pool_connections=n_workers)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        listings = executor.map(
+            lambda prefix: {s3_object["Key"]: s3_object for s3_object in
+                            store.list_objects(*prefix, "/")},
+            prefixes)
+        listings = dict(zip(prefixes, listings))
+    consensus_objects = {}
+    for sample, (s3_bucket, s3_key) in required.items():
+        s3_object = listings[(s3_bucket, path.join(path.dirname(s3_key),
+                                                   ""))].get(s3_key)
+        if s3_object is None:
+            skipped[sample] = utils.NoS3ObjectError(s3_bucket, s3_key).message
+        else:
+            consensus_objects[sample] = dict(s3_object, Bucket=s3_bucket)
+    return consensus_objects, skipped
+
+
+def download_consensus_file(s3_bucket, s3_key, consensus_filepath, store,
+                            retries=DEFAULT_DOWNLOAD_RETRIES):
+    """
+        Downloads a single consensus file, retrying with exponential
+        backoff on failure. Missing objects are not retried. Request
+        level retries are also made by the s3 client; these retries
+        additionally cover failures while streaming the object body.
+    """
+    for attempt in range(retries + 1):
+        try:
+            store.download_file(s3_bucket, s3_key, consensus_filepath)
+            return
+        except utils.NoS3ObjectError as e:
+            raise e
+        except Exception as e:
+            if attempt == retries:
+                raise e
+            time.sleep(0.1 * 2**attempt)
+
+
+def cache_consensus_file(s3_bucket, s3_key, etag, sample, cache, store,
+                         retries=DEFAULT_DOWNLOAD_RETRIES):
+    """
+        Downloads a single consensus file into the consensus cache
+    """
+    temp_filepath = cache.temp_filepath(sample)
+    download_consensus_file(s3_bucket, s3_key, temp_filepath, store, retries)
+    cache.put(sample, etag, temp_filepath)
+
+
+def download_consensus(consensus_objects, cache,
+                       n_workers=DEFAULT_DOWNLOAD_WORKERS,
+                       retries=DEFAULT_DOWNLOAD_RETRIES):
+    """
+        Downloads consensus files that are missing from the cache, or
+        whose ETag has changed in s3, concurrently using a bounded pool
+        of worker threads which share a single storage backend (and
+        connection pool).
+
+        Parameters:
+            consensus_objects (dict): 'Bucket', 'Key' and 'ETag' of
+            each consensus object, keyed by sample name (see
+            preflight_consensus)
+
+            cache (consensus_cache.ConsensusCache object): consensus
+            cache
+
+            n_workers (int): maximum number of concurrent downloads
+
+            retries (int): number of times to retry a failed download
+
+        Returns:
+            errors (dict): error messages for each sample that failed
+            to download, keyed by sample name
+    """
+    # only download samples that are not cached or are out of date
+    consensus_objects = {sample: s3_object for sample, s3_object in
+                         consensus_objects.items()
+                         if cache.get(sample, s3_object["ETag"]) is None}
+    n_workers = max(1, min(int(n_workers), len(consensus_objects) or 1))
+    store = storage.get_storage(max_pool_connections=n_workers)
+    errors = {}
+    num_samples = len(consensus_objects)
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(cache_consensus_file,
+                                   s3_object["Bucket"], s3_object["Key"],
+                                   s3_object["ETag"], sample, cache, store,
+                                   retries): sample
+                   for sample, s3_object in consensus_objects.items()}
+        for count, future in enumerate(as_completed(futures), 1):
+            sample = futures[future]
+            print(f"\t\tdownloading sample: {count} / {num_samples}",
+                  end="\r")
+            try:
+                future.result()
+            except Exception as e:
+                errors[sample] = str(e)
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    print(f"\t\tdownloaded samples: {num_samples-len(errors)} / "
+          f"{num_samples} in {elapsed:.1f}s "
+          f"({(num_samples-len(errors))/elapsed:.1f} samples/s) \n")
+    for sample, message in errors.items():
+        print(f"\t\tfailed to download sample '{sample}': {message}")
+    return errors
+
+
+def append_multi_fasta(s3_bucket, s3_key, outfile, sample, cache,
+                       store=None):
     """
         Appends a multi fasta file with the consensus sequence stored at
         s3_uri
@@ -35,18 +192,32 @@ def append_multi_fasta(s3_bucket, s3_key, outfile, sample, consensus_path):
 
             outfile (file object): file object refering to the multi
             fasta output file
+
+            sample (string): sample name
+
+            cache (consensus_cache.ConsensusCache object): consensus
+            cache
+
+            store (storage backend object): optional shared storage
+            backend (see storage.get_storage)
     """
-    # check if file is already present in the consensus directory
-    consensus_filepath = path.join(consensus_path, sample + '.fas')
-    if not path.exists(consensus_filepath):
-        # dowload consensus file from s3 to tempfile
-        utils.s3_download_file_cli(s3_bucket, s3_key, consensus_filepath)
+    if store is None:
+        store = storage.get_storage()
+    # download if the sample is not already in the cache
+    if sample not in cache:
+        cache_consensus_file(s3_bucket, s3_key, None, sample, cache, store)
+    try:
+        contents = cache.read(sample)
+    except consensus_cache.CorruptCacheError:
+        # download again if the cached file fails its checksum
+        cache_consensus_file(s3_bucket, s3_key, None, sample, cache, store)
+        contents = cache.read(sample)
     # writes to multifasta
-    with open(consensus_filepath, 'rb') as consensus_file:
-        outfile.write(consensus_file.read())
+    outfile.write(contents)
 
 
-def build_multi_fasta(multi_fasta_path, df, consensus_path):
+def build_multi_fasta(multi_fasta_path, df, cache, skipped=None,
+                      reference_length=None):
     """
         Builds the multi fasta constructed from consensus sequences for
         all samples in df
@@ -59,15 +230,34 @@ def build_multi_fasta(multi_fasta_path, df, consensus_path):
             for consensus sequences of samples to be included in
             phylogeny
 
+            cache (consensus_cache.ConsensusCache object): consensus
+            cache
+
+            skipped (dict): samples to leave out of the multi fasta,
+            e.g. those reported by preflight_consensus()
+
+            reference_length (int): if given, samples whose sequence
+            length differs from it are left out, see
+            check_sequence_lengths(); by default every sample is added
+
+        Returns:
+            invalid (dict): the reason each sample was left out of the
+            multi fasta for its sequence length, keyed by sample name
+
         Raises:
             utils.NoS3ObjectError: if the object cannot be found in the
             specified s3 bucket
     """
+    skipped = skipped or {}
+    invalid = {}
+    store = storage.get_storage()
     with open(multi_fasta_path, 'wb') as outfile:
         # loops through all samples to be included in phylogeny
         count = 0
-        num_samples = len(df)
+        num_samples = len(df) - len(skipped)
         for index, sample in df.iterrows():
+            if sample["Sample"] in skipped:
+                continue
             count += 1
             print(f"\t\tadding sample: {count} / {num_samples}", end="\r")
             try:
@@ -75,9 +265,20 @@ def build_multi_fasta(multi_fasta_path, df, consensus_path):
                 s3_bucket = extract_s3_bucket(sample["ResultLoc"])
                 consensus_key = extract_s3_key(sample["ResultLoc"],
                                                sample["Sample"])
+                if reference_length is not None:
+                    # download to read the sequence length before adding
+                    if sample["Sample"] not in cache:
+                        cache_consensus_file(s3_bucket, consensus_key, None,
+                                             sample["Sample"], cache, store)
+                    invalid.update(check_sequence_lengths(
+                        {sample["Sample"]: cache.record(
+                            sample["Sample"])["sequence_length"]},
+                        reference_length))
+                    if sample["Sample"] in invalid:
+                        continue
                 # appends sample's consensus sequence to multifasta
                 append_multi_fasta(s3_bucket, consensus_key, outfile,
-                                   sample["Sample"], consensus_path)
+                                   sample["Sample"], cache, store)
             except utils.NoS3ObjectError as e:
                 # if consensus file can't be found in s3, btb_wgs_samples.csv
                 # must be corrupted
@@ -85,7 +286,144 @@ def build_multi_fasta(multi_fasta_path, df, consensus_path):
                 print(f"\tCheck results objects in row {index} of \
                     btb_wgs_sample.csv")
                 raise e
-        print(f"\t\tadded samples: {count} / {num_samples} \n")
+        print(f"\t\tadded samples: {count - len(invalid)} / {num_samples} "
+              "\n")
+    for sample, reason in invalid.items():
+        print(f"\t\tleft out sample {sample}: {reason}")
+    return invalid
+
+
+def check_sequence_lengths(lengths, reference_length):
+    """
+        Returns the reason each sample is to be left out of the multi
+        fasta for a sequence length, from lengths keyed by sample name,
+        that differs from reference_length
+    """
+    return {sample: f"sequence length {length} differs from reference "
+            f"length {reference_length}"
+            for sample, length in lengths.items()
+            if length != reference_length}
+
+
+def copy_record(fd, offset, record, cache, sample):
+    """
+        Writes a single cached consensus into the open multi fasta file
+        descriptor, fd, at offset. Plain fasta files are copied
+        kernel-side with os.copy_file_range where available and are
+        validated by size only; encoded files are read (and checksum
+        verified) through the cache, decoded and written with
+        os.pwrite.
+    """
+    if record.get("encoding", "fasta") == "fasta":
+        with open(record["filepath"], "rb") as src:
+            size = os.fstat(src.fileno()).st_size
+            if size != record["fasta_size"]:
+                raise consensus_cache.CorruptCacheError(sample)
+            copied = 0
+            try:
+                while copied < size:
+                    n = os.copy_file_range(src.fileno(), fd, size - copied,
+                                           copied, offset + copied)
+                    if not n:
+                        raise consensus_cache.CorruptCacheError(sample)
+                    copied += n
+                return
+            except (AttributeError, OSError) as e:
+                # fall back to pwrite if copy_file_range is unsupported,
+                # e.g. across file systems or on older kernels
+                if isinstance(e, OSError) and e.errno not in \
+                        (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                         errno.EOPNOTSUPP):
+                    raise e
+            contents = os.pread(src.fileno(), size, 0)
+    else:
+        contents = cache.read(sample)
+        if len(contents) != record["fasta_size"]:
+            raise consensus_cache.CorruptCacheError(sample)
+    view = memoryview(contents)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+
+
+def assemble_multi_fasta(multi_fasta_path, df, cache, skipped=None,
+                         n_workers=DEFAULT_ASSEMBLY_WORKERS,
+                         reference_length=REFERENCE_LENGTH):
+    """
+        Builds the multi fasta from cached consensus sequences in
+        parallel. Every record's size is known from the cache index, so
+        its offset in the output is computed in advance and records are
+        copied into place concurrently. Samples whose sequence length
+        differs from reference_length are left out, as are samples that
+        are not in the cache; otherwise the output is byte-identical to
+        build_multi_fasta() with the same reference_length.
+
+        Parameters:
+            multi_fasta_path (str): path for location of multi fasta
+            sequence (appended consensus sequences for all samples)
+
+            df (pandas DataFrame object): samples to be included in
+            phylogeny
+
+            cache (consensus_cache.ConsensusCache object): consensus
+            cache containing every sample in df that is not in skipped
+
+            skipped (dict): samples to leave out of the multi fasta
+
+            n_workers (int): maximum number of concurrent copies
+
+            reference_length (int): sequence length of every sample,
+            see check_sequence_lengths()
+
+        Returns:
+            invalid (dict): the reason each sample was left out of the
+            multi fasta, keyed by sample name
+
+        Raises:
+            consensus_cache.CorruptCacheError: if a cached file does not
+            match its index entry
+    """
+    skipped = skipped or {}
+    start_time = time.perf_counter()
+    invalid = {}
+    records = {}
+    for sample in df["Sample"]:
+        if sample in skipped:
+            continue
+        if sample not in cache:
+            invalid[sample] = "consensus file not in cache"
+            continue
+        records[sample] = cache.record(sample)
+    # validate that all sequences have the same (reference) length
+    mismatched = check_sequence_lengths(
+        {sample: record["sequence_length"]
+         for sample, record in records.items()}, reference_length)
+    for sample in mismatched:
+        del records[sample]
+    invalid.update(mismatched)
+    # compute the offset of each record in the multi fasta
+    offsets = {}
+    total_size = 0
+    for sample, record in records.items():
+        offsets[sample] = total_size
+        total_size += record["fasta_size"]
+    with open(multi_fasta_path, 'wb') as outfile:
+        outfile.truncate(total_size)
+        with ThreadPoolExecutor(max_workers=max(1, int(n_workers))) as \
+                executor:
+            futures = [executor.submit(copy_record, outfile.fileno(),
+                                       offsets[sample], record, cache,
+                                       sample)
+                       for sample, record in records.items()]
+            for future in as_completed(futures):
+                future.result()
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    print(f"\t\tassembled {len(records)} samples, {total_size/1e6:.1f} MB "
+          f"in {elapsed:.1f}s ({total_size/1e6/elapsed:.1f} MB/s) \n")
+    for sample, reason in invalid.items():
+        print(f"\t\tleft out sample {sample}: {reason}")
+    return invalid
 
 
 def extract_s3_bucket(s3_uri):
@@ -150,57 +488,145 @@ def build_snp_matrix(snp_dists_outpath, snp_sites_outpath, threads=1):
     utils.run(cmd, shell=True)
 
 
-def build_tree(tree_path, snp_sites_outpath):
+def snp_sites_to_snp_matrix(snp_dists_outpath, multi_fasta_path, threads=1,
+                            snp_sites_outpath=None, chunk_size=1 << 20):
     """
-        Run mega
+        Runs snp-sites and snp-dists as a pipeline: the snp alignment
+        is streamed from snp-sites' stdout to snp-dists' stdin rather
+        than written to and read back from disk. snp-sites reads the
+        multi fasta twice, so multi_fasta_path must be a regular file.
+
+        Parameters:
+            snp_dists_outpath (str): output path for the snp matrix
+
+            multi_fasta_path (str): path to the multi fasta
+
+            threads (int): number of threads for snp-dists
+
+            snp_sites_outpath (str): optional output path for a copy of
+            the snp alignment, e.g. for building a tree; None to not
+            write the snp alignment
+
+            chunk_size (int): number of bytes relayed per read
+
+        Returns:
+            metadata (dict): the number of snps
     """
-    # count number of taxa
-    with open(snp_sites_outpath, "r") as f:
-        for n_lines, _ in enumerate(f):
-            if n_lines == 7:
-                # if more than 3 samples run mega
-                cmd = \
-                    f'megacc -a accessory/infer_MP.mao -d {snp_sites_outpath} \
-                        -o {tree_path}'
-                utils.run(cmd, shell=True)
-                break
-    if n_lines < 7:
-        warnings.warn("Unable to build tree! Need at least 4 taxa for tree \
-            building")
+    snp_sites_cmd = ["snp-sites", multi_fasta_path, "-c", "-o", "/dev/stdout"]
+    snp_dists_cmd = ["snp-dists", "-c", "-j", str(threads), "/dev/stdin"]
+    head = b""
+    with open(snp_dists_outpath, "wb") as snp_dists_out:
+        snp_sites_ps = subprocess.Popen(snp_sites_cmd, stdout=subprocess.PIPE)
+        snp_dists_ps = subprocess.Popen(snp_dists_cmd, stdin=subprocess.PIPE,
+                                        stdout=snp_dists_out)
+        snp_sites_out = open(snp_sites_outpath, "wb") \
+            if snp_sites_outpath else None
+        try:
+            # relay the snp alignment, teeing to snp_sites_outpath
+            for chunk in iter(lambda: snp_sites_ps.stdout.read(chunk_size),
+                              b""):
+                # keep the header and first sequence line for metadata
+                if head.count(b"\n") < 2:
+                    head += chunk
+                snp_dists_ps.stdin.write(chunk)
+                if snp_sites_out:
+                    snp_sites_out.write(chunk)
+        except BrokenPipeError:
+            # snp-dists exited early: reported by its exit code below
+            pass
+        finally:
+            snp_sites_ps.stdout.close()
+            try:
+                snp_dists_ps.stdin.close()
+            except BrokenPipeError:
+                pass
+            if snp_sites_out:
+                snp_sites_out.close()
+            snp_sites_returncode = snp_sites_ps.wait()
+            snp_dists_returncode = snp_dists_ps.wait()
+    for cmd, returncode in ((snp_sites_cmd, snp_sites_returncode),
+                            (snp_dists_cmd, snp_dists_returncode)):
+        if returncode:
+            raise Exception("""*****
+            %s
+            cmd failed with exit code %i
+          *****""" % (" ".join(cmd), returncode))
+    # read the number of snps for metadata
+    lines = head.split(b"\n")
+    return {"number_of_snps": len(lines[1]) if len(lines) > 2 else 0}
+
+
+def clade_indices(df_wgs, skipped):
+    """
+        Returns the indices of each clade's ('group') samples among the
+        samples of df_wgs that are not skipped, i.e. their sequences in
+        the multi fasta
+    """
+    groups = df_wgs.set_index("Sample")["group"].astype(str)
+    clades = {}
+    for i, sample in enumerate(sample for sample in df_wgs["Sample"]
+                               if sample not in skipped):
+        clades.setdefault(groups[sample], []).append(i)
+    return clades
+
+
+def build_tree(tree_path, snp_sites_outpath, **kwargs):
+    """
+        Run mega, see mega.build_tree() for kwargs
+    """
+    return mega.build_tree(tree_path, snp_sites_outpath, **kwargs)
 
 
 def post_process_snps_csv(snp_dists_outpath):
     """
-        An I/O layer for post_process_snps_df. Changes the sample names
-        in the snp matrix at snp_dists_outpath to be consistent with
-        cattle and movement datasets. This is necessary for serving
-        ViewBovine:
-        Parses snps.csv.
-        Runs post_process_snps_df().
-        Saves post processed snp matrix to the same location as the
-        input snps.csv
+        Changes the sample names in the snp matrix at snp_dists_outpath
+        to be consistent with cattle and movement datasets. This is
+        necessary for serving ViewBovine. The matrix is rewritten line
+        by line: the sample names of the header and the first field of
+        each row are processed with process_sample_name() and the
+        distances are copied through untouched, so that memory use does
+        not grow with the size of the matrix.
+    """
+    outpath = f"{snp_dists_outpath}.part"
+    with open(snp_dists_outpath, "r") as src, open(outpath, "w") as dest:
+        # the first field of the header is the snp-dists version
+        version, *sample_names = src.readline().rstrip("\r\n").split(",")
+        dest.write(",".join([version] + [process_sample_name(sample_name)
+                                         for sample_name in sample_names]) +
+                   "\n")
+        for line in src:
+            sample_name, sep, distances = line.partition(",")
+            dest.write(process_sample_name(sample_name) + sep + distances)
+    # overwrite input snps.csv
+    os.replace(outpath, snp_dists_outpath)
+
+
+def post_process_snp_matrix(matrix_path):
+    """
+        Changes the sample names of the binary snp matrix at
+        matrix_path, see btbphylo.snp_matrix, to be consistent with
+        cattle and movement datasets. Only the sample index is
+        rewritten.
     """
-    # load snps.csv
-    snp_matrix = pd.read_csv(snp_dists_outpath, index_col=0)
-    # process sample names
-    processed_snp_matrix = post_process_snps_df(snp_matrix)
-    # overwrite input snps.csv with processed snp_matrix
-    processed_snp_matrix.to_csv(snp_dists_outpath)
+    with open(snp_matrix.samples_path(matrix_path), "r") as f:
+        names = json.load(f)["names"]
+    snp_matrix.write_names(matrix_path,
+                           [process_sample_name(name) for name in names])
 
 
-def post_process_snps_df(snp_matrix):
+def post_process_snps_df(df_snps):
     """
-        Changes the sample names in the snp_matrix dataframe to be
+        Changes the sample names in the df_snps dataframe to be
         consistent with cattle and movement datasets
     """
     # create copy of input dataframe
-    processed_snp_matrix = snp_matrix.copy(deep=True)
+    df_processed_snps = df_snps.copy(deep=True)
     # extracts sample names and maps to new sample names
-    new_sample_names = snp_matrix.index.map(process_sample_name)
+    new_sample_names = df_snps.index.map(process_sample_name)
     # updates the output dataframe with new sample names
-    processed_snp_matrix.index = new_sample_names
-    processed_snp_matrix.columns = new_sample_names
-    return processed_snp_matrix
+    df_processed_snps.index = new_sample_names
+    df_processed_snps.columns = new_sample_names
+    return df_processed_snps
 
 
 def process_sample_name(sample_name):
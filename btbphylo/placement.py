@@ -0,0 +1,573 @@
+import os
+from os import path
+
+import numpy as np
+
+import btbphylo.alignment as alignment
+import btbphylo.distances as distances
+import btbphylo.neighbour_joining as neighbour_joining
+
+"""
+    Incremental trees. Rather than rebuilding the phylogeny, the tree of
+    a previous run, in Newick format, is updated to the samples of the
+    snp alignment: samples that are no longer in the alignment are
+    pruned and new samples are placed, one at a time, on the branch
+    where they fit best.
+
+    With parsimony placement, each branch is given the Fitch state sets
+    of its two sides, from a post-order (down) and a pre-order (up) pass
+    over the tree, and a sample is placed on the branch whose sets
+    differ from its bases at the fewest sites, i.e. the branch that adds
+    the fewest changes to the tree. The passes are made once; after each
+    placement only the sets that change, around the path from the new
+    branch to the root, are updated. With distance placement, a sample
+    is placed next to the sample at the smallest snp distance.
+
+    Optionally, subtrees within spr_radius branches of each placed
+    sample are pruned and regrafted (SPR) within the same radius if that
+    lowers their cost, cleaning up placements made before their
+    neighbours were placed. Each move updates the sets in the same way.
+
+    The tree is held as a dict of per-node lists, indexed by node:
+    children, parent (-1 for the root), length (of the branch to the
+    parent), name (None for internal nodes) and label (e.g. bootstrap
+    support, None for leaves), along with its root. Pruned nodes are
+    left in the lists but are no longer reachable from the root.
+"""
+
+PLACED_TREE_FILENAME = "placed_tree.nwk"
+PLACEMENT_METHODS = ("parsimony", "distance")
+DEFAULT_SPR_RADIUS = 0
+# Fitch state set of each nucleotide code: A, C, G, T and N (any)
+STATE_SETS = np.array([1, 2, 4, 8, 15], dtype=np.uint8)
+ANY_STATE = 15
+# a tree needs at least 3 samples of the previous tree to be updated
+MIN_TAXA = 3
+
+
+class IncompatibleTreeError(Exception):
+    def __init__(self, reason):
+        super().__init__()
+        self.message = f"Cannot update the previous tree: {reason}"
+
+    def __str__(self):
+        return self.message
+
+
+def from_newick(newick):
+    """
+        Parses a tree in Newick format, see neighbour_joining.parse_newick(),
+        into a tree dict
+    """
+    children, names, labels = neighbour_joining.parse_newick(newick)
+    n_nodes = len(names) + len(children)
+    tree = {"children": [[] for _ in names] +
+            [[child for child, _ in node_children]
+             for node_children in children],
+            "parent": [-1] * n_nodes, "length": [0.0] * n_nodes,
+            "name": names + [None] * len(children),
+            "label": [None] * len(names) + labels,
+            "root": n_nodes - 1}
+    for k, node_children in enumerate(children):
+        for child, length in node_children:
+            tree["parent"][child] = len(names) + k
+            tree["length"][child] = length
+    return tree
+
+
+def preorder(tree, node=None):
+    """
+        Returns the nodes of the subtree at node (the whole tree by
+        default) with every node before its children
+    """
+    order, stack = [], [tree["root"] if node is None else node]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        stack.extend(reversed(tree["children"][node]))
+    return order
+
+
+def leaves(tree):
+    """
+        Returns the leaves of tree
+    """
+    return [node for node in preorder(tree) if not tree["children"][node]]
+
+
+def to_newick(tree):
+    """
+        Formats tree in Newick format, see neighbour_joining.to_newick()
+    """
+    order = preorder(tree)[::-1]
+    tree_leaves = [node for node in order if not tree["children"][node]]
+    internal = [node for node in order if tree["children"][node]]
+    number = {node: i for i, node in enumerate(tree_leaves + internal)}
+    children = [[(number[child], tree["length"][child])
+                 for child in tree["children"][node]] for node in internal]
+    return neighbour_joining.to_newick(
+        children, [tree["name"][node] for node in tree_leaves],
+        [tree["label"][node] for node in internal])
+
+
+def add_node(tree, name=None):
+    """
+        Adds a detached node to tree and returns it
+    """
+    tree["children"].append([])
+    tree["parent"].append(-1)
+    tree["length"].append(0.0)
+    tree["name"].append(name)
+    tree["label"].append(None)
+    return len(tree["parent"]) - 1
+
+
+def prune(tree, node):
+    """
+        Detaches the subtree at node from tree, in-place. A parent left
+        with a single child is spliced out.
+    """
+    parent = tree["parent"][node]
+    if parent < 0:
+        raise ValueError("Cannot prune the root")
+    tree["parent"][node] = -1
+    tree["children"][parent].remove(node)
+    if not tree["children"][parent]:
+        prune(tree, parent)
+    elif len(tree["children"][parent]) == 1:
+        # splice out the parent
+        child, = tree["children"][parent]
+        tree["children"][parent] = []
+        grandparent = tree["parent"][parent]
+        tree["parent"][child] = grandparent
+        if grandparent < 0:
+            tree["root"] = child
+            tree["length"][child] = 0.0
+        else:
+            siblings = tree["children"][grandparent]
+            siblings[siblings.index(parent)] = child
+            tree["length"][child] += tree["length"][parent]
+            tree["parent"][parent] = -1
+
+
+def graft(tree, node, edge, length, joint=None):
+    """
+        Attaches the detached node to the branch above edge, in-place,
+        halving the branch with an internal node
+
+        Parameters:
+            tree (dict): the tree
+
+            node (int): the node to attach
+
+            edge (int): the node below the branch; the root to attach
+            node above it, as a new root
+
+            length (float): length of the branch to node
+
+            joint (int): a detached internal node to reuse as the joint;
+            a new node by default
+    """
+    parent = tree["parent"][edge]
+    if joint is None:
+        joint = add_node(tree)
+    tree["parent"][joint] = parent
+    if parent < 0:
+        tree["root"] = joint
+        tree["length"][joint] = 0.0
+    else:
+        siblings = tree["children"][parent]
+        siblings[siblings.index(edge)] = joint
+        tree["length"][joint] = tree["length"][edge] / 2
+        tree["length"][edge] /= 2
+    tree["children"][joint] = [edge, node]
+    tree["parent"][edge] = tree["parent"][node] = joint
+    tree["length"][node] = length
+
+
+def neighbourhood(tree, node, radius):
+    """
+        Returns the nodes within radius branches of node
+    """
+    depths = {node: 0}
+    queue = [node]
+    for current in queue:
+        if depths[current] == radius:
+            continue
+        parent = tree["parent"][current]
+        for neighbour in tree["children"][current] + \
+                ([parent] if parent >= 0 else []):
+            if neighbour not in depths:
+                depths[neighbour] = depths[current] + 1
+                queue.append(neighbour)
+    return list(depths)
+
+
+def combine(a, b):
+    """
+        Combines Fitch state sets: their intersection where it is not
+        empty and their union elsewhere
+
+        Returns:
+            sets (numpy array): the combined state sets
+
+            changes (numpy array): True where the intersection is empty
+    """
+    both = a & b
+    changes = both == 0
+    return np.where(changes, a | b, both), changes
+
+
+def children_down_sets(tree, down, node):
+    """
+        Returns the Fitch state sets below the internal node, from the
+        down sets of its children, and the number of changes between them
+    """
+    children = tree["children"][node]
+    sets, score = down[children[0]], 0
+    for child in children[1:]:
+        sets, changes = combine(sets, down[child])
+        score += int(changes.sum())
+    return sets, score
+
+
+def children_up_sets(tree, down, up, node):
+    """
+        Sets the Fitch state sets above each child of node, in-place, from
+        the sets above node and the down sets of the child's siblings
+    """
+    children = tree["children"][node]
+    # the sets above each child combine the sets above node with those
+    # of the child's siblings, before and after it
+    before = [up[node]]
+    for child in children[:-1]:
+        before.append(combine(before[-1], down[child])[0])
+    after = np.full(down.shape[1], ANY_STATE, dtype=np.uint8)
+    for i in range(len(children) - 1, -1, -1):
+        up[children[i]] = combine(before[i], after)[0]
+        after = combine(after, down[children[i]])[0]
+
+
+def down_sets(tree, leaf_sets, node=None, down=None):
+    """
+        Computes the Fitch state sets of the subtree below each node, in
+        post-order, and the parsimony score of the subtree at node (the
+        whole tree by default)
+
+        Parameters:
+            tree (dict): the tree
+
+            leaf_sets (dict): the state sets of each leaf, a numpy array
+            with an element per site
+
+            node (int): root of the subtree
+
+            down (numpy array): array to fill, with at least a row per
+            node; a new array by default
+
+        Returns:
+            down (numpy array): the state sets of each node, with a row
+            per node
+
+            score (int): parsimony score
+    """
+    if down is None:
+        n_sites = len(next(iter(leaf_sets.values())))
+        down = np.zeros((len(tree["parent"]), n_sites), dtype=np.uint8)
+    score = 0
+    for current in reversed(preorder(tree, node)):
+        if not tree["children"][current]:
+            down[current] = leaf_sets[current]
+            continue
+        down[current], changes = children_down_sets(tree, down, current)
+        score += changes
+    return down, score
+
+
+def up_sets(tree, down, up=None):
+    """
+        Computes the Fitch state sets of the rest of the tree above each
+        node, in pre-order, from the down sets
+
+        Returns:
+            up (numpy array): the state sets of each node, with a row per
+            node; any state for the root
+    """
+    if up is None:
+        up = np.zeros_like(down)
+    up[tree["root"]] = ANY_STATE
+    for node in preorder(tree):
+        children_up_sets(tree, down, up, node)
+    return up
+
+
+def placement_costs(tree, down, up, sets, edges, block_size=1024):
+    """
+        Returns the number of sites at which sets differ from the Fitch
+        state sets of each branch of edges, i.e. the number of changes
+        added by attaching sets to the branch, block_size branches at a
+        time
+    """
+    edges = np.asarray(edges, dtype=np.int64)
+    costs = np.zeros(len(edges), dtype=np.int64)
+    for start in range(0, len(edges), block_size):
+        block = edges[start:start + block_size]
+        branch_sets, _ = combine(down[block], up[block])
+        costs[start:start + block_size] = \
+            ((branch_sets & sets) == 0).sum(axis=1)
+    return costs
+
+
+class FitchSets:
+    """
+        Fitch down and up state sets of a tree, computed once and kept up
+        to date, in-place, as subtrees are grafted and pruned: the down
+        sets of the path from the changed node towards the root and the
+        up sets of the subtrees hanging off it, as far as they change
+    """
+    def __init__(self, tree, leaf_sets, capacity=0):
+        self.tree = tree
+        self.leaf_sets = leaf_sets
+        n_sites = len(next(iter(leaf_sets.values())))
+        # rows for nodes added later, e.g. by placing new samples
+        n_rows = max(capacity, len(tree["parent"]))
+        self.down = np.zeros((n_rows, n_sites), dtype=np.uint8)
+        self.up = np.zeros((n_rows, n_sites), dtype=np.uint8)
+        down_sets(tree, leaf_sets, down=self.down)
+        up_sets(tree, self.down, self.up)
+
+    def reserve(self):
+        """
+            Grows the set arrays to a row per node of the tree
+        """
+        n_nodes = len(self.tree["parent"])
+        if n_nodes <= len(self.down):
+            return
+        n_rows = max(n_nodes, 2 * len(self.down))
+        for name in ("down", "up"):
+            sets = getattr(self, name)
+            grown = np.zeros((n_rows, sets.shape[1]), dtype=np.uint8)
+            grown[:len(sets)] = sets
+            setattr(self, name, grown)
+
+    def update(self, node):
+        """
+            Updates the sets after the children of node changed
+        """
+        tree = self.tree
+        # down sets, from node towards the root while they change
+        path, current = [], node
+        while current >= 0:
+            sets, _ = children_down_sets(tree, self.down, current)
+            if current != node and np.array_equal(sets, self.down[current]):
+                break
+            self.down[current] = sets
+            path.append(current)
+            current = tree["parent"][current]
+        self.update_up(path)
+
+    def update_up(self, path):
+        """
+            Updates the up sets after the down sets of path, a node and
+            its ancestors, changed: below the parent of the top of path,
+            down the path and into the subtrees whose up sets change
+        """
+        tree = self.tree
+        start = tree["parent"][path[-1]]
+        if start < 0:
+            start = path[-1]
+            self.up[start] = ANY_STATE
+        on_path = set(path)
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            children = tree["children"][node]
+            previous = self.up[children]
+            children_up_sets(tree, self.down, self.up, node)
+            for child, sets in zip(children, previous):
+                if tree["children"][child] and \
+                        (child in on_path or
+                         not np.array_equal(sets, self.up[child])):
+                    stack.append(child)
+
+    def graft(self, node, edge, length, joint=None):
+        """
+            Grafts the detached node to the branch above edge, see graft(),
+            and updates the sets
+        """
+        graft(self.tree, node, edge, length, joint)
+        self.reserve()
+        if not self.tree["children"][node]:
+            self.down[node] = self.leaf_sets[node]
+        self.update(self.tree["parent"][node])
+
+    def prune(self, node):
+        """
+            Prunes the subtree at node, whose parent has at least two
+            children, see prune(), and updates the sets. The sets of the
+            subtree are left as they were.
+        """
+        tree = self.tree
+        parent = tree["parent"][node]
+        grandparent = tree["parent"][parent]
+        prune(tree, node)
+        if tree["children"][parent]:
+            self.update(parent)
+        elif grandparent >= 0:
+            # the parent was spliced out
+            self.update(grandparent)
+        else:
+            # the parent's other child is the new root
+            self.update_up([tree["root"]])
+
+    def costs(self, sets, edges):
+        """
+            Returns the number of changes added by attaching sets to each
+            branch of edges, see placement_costs()
+        """
+        return placement_costs(self.tree, self.down, self.up, sets, edges)
+
+
+def place_parsimony(fitch, node):
+    """
+        Attaches the detached leaf node to the branch of the tree of
+        fitch, a FitchSets, that adds the fewest changes, in-place
+    """
+    # branches below the root
+    edges = preorder(fitch.tree)[1:]
+    costs = fitch.costs(fitch.leaf_sets[node], edges)
+    best = int(costs.argmin())
+    fitch.graft(node, edges[best], float(costs[best]))
+
+
+def place_distance(tree, node, nearest, distance):
+    """
+        Attaches the detached leaf node next to the leaf nearest, at
+        distance from it, in-place
+    """
+    graft(tree, node, nearest,
+          max(distance - tree["length"][nearest] / 2, 0.0))
+
+
+def regraft(fitch, node, radius):
+    """
+        Prunes the subtree at node and regrafts it to the branch within
+        radius branches of its position that adds the fewest changes, if
+        that is fewer than at its position. Only subtrees whose parent
+        is binary are moved. The tree and sets of fitch, a FitchSets, are
+        updated in-place, only within the neighbourhood of node.
+
+        Returns:
+            moved (bool): True if the subtree was moved
+    """
+    tree = fitch.tree
+    parent = tree["parent"][node]
+    if parent < 0 or len(tree["children"][parent]) != 2:
+        return False
+    sibling, = [child for child in tree["children"][parent]
+                if child != node]
+    lengths = tree["length"][parent], tree["length"][sibling]
+    fitch.prune(node)
+    edges = neighbourhood(tree, sibling, radius)
+    # the cost at its position is that of the sibling's branch
+    costs = fitch.costs(fitch.down[node], edges)
+    best = int(costs.argmin())
+    if costs[best] >= costs[0]:
+        best = 0
+    # the parent is reused as the joint of the regrafted subtree
+    fitch.graft(node, edges[best], tree["length"][node], joint=parent)
+    if best == 0:
+        tree["length"][parent], tree["length"][sibling] = lengths
+    return best != 0
+
+
+def update_tree(previous_tree_path, tree_path, snp_sites_outpath,
+                method="parsimony", spr_radius=DEFAULT_SPR_RADIUS):
+    """
+        Updates the tree of a previous run to the samples of the snp
+        alignment and writes it to tree_path/placed_tree.nwk. Raises
+        IncompatibleTreeError if the tree cannot be updated, e.g. if it
+        has fewer than 3 samples left.
+
+        Parameters:
+            previous_tree_path (str): path to the previous tree, in
+            Newick format
+
+            tree_path (str): output directory
+
+            snp_sites_outpath (str): path to the snp alignment
+
+            method (str): "parsimony" or "distance" placement
+
+            spr_radius (int): radius of the SPR clean-up around placed
+            samples; 0 for none
+
+        Returns:
+            metadata (dict): the samples placed and pruned, the SPR moves
+            made and the parsimony score of the tree
+    """
+    if method not in PLACEMENT_METHODS:
+        raise ValueError(f"Invalid placement method: {method}")
+    try:
+        with open(previous_tree_path, "r") as f:
+            tree = from_newick(f.read())
+    except (OSError, ValueError) as e:
+        raise IncompatibleTreeError(str(e)) from e
+    names, codes = [], []
+    for name, sequence in alignment.fasta_records(snp_sites_outpath):
+        names.append(name.decode())
+        codes.append(alignment.NUCLEOTIDE_CODES[sequence])
+    codes = np.array(codes, dtype=np.uint8)
+    index = {name: i for i, name in enumerate(names)}
+    # prune samples that are no longer in the snp alignment
+    previous_leaves = leaves(tree)
+    pruned = [node for node in previous_leaves
+              if tree["name"][node] not in index]
+    if len(previous_leaves) - len(pruned) < MIN_TAXA:
+        raise IncompatibleTreeError(f"fewer than {MIN_TAXA} of its samples "
+                                    "are in the snp alignment")
+    for node in pruned:
+        prune(tree, node)
+    leaf_sets = {node: STATE_SETS[codes[index[tree["name"][node]]]]
+                 for node in leaves(tree)}
+    # place new samples in the order of the snp alignment
+    in_tree = {tree["name"][node]: node for node in leaf_sets}
+    new = [i for i, name in enumerate(names) if name not in in_tree]
+    bitsets = distances.encode_codes(codes) if method == "distance" \
+        else None
+    # the Fitch sets are computed once, with rows for the nodes to add
+    fitch = FitchSets(tree, leaf_sets,
+                      len(tree["parent"]) + 2 * len(new)) \
+        if method == "parsimony" else None
+    placed = []
+    for count, i in enumerate(new, 1):
+        print(f"\t\tplacing sample: {count} / {len(new)}", end="\r")
+        node = add_node(tree, names[i])
+        leaf_sets[node] = STATE_SETS[codes[i]]
+        if method == "parsimony":
+            place_parsimony(fitch, node)
+        else:
+            columns = np.array([index[name] for name in in_tree],
+                               dtype=np.int64)
+            row = distances.block_distances(bitsets, np.array([i]),
+                                            columns)[0]
+            nearest = int(row.argmin())
+            place_distance(tree, node, list(in_tree.values())[nearest],
+                           float(row[nearest]))
+        in_tree[names[i]] = node
+        placed.append(node)
+    print()
+    # SPR clean-up around placed samples
+    spr_moves = 0
+    if spr_radius:
+        fitch = fitch or FitchSets(tree, leaf_sets)
+        for node in placed:
+            for neighbour in neighbourhood(tree, node, spr_radius):
+                if tree["parent"][neighbour] >= 0:
+                    spr_moves += regraft(fitch, neighbour, spr_radius)
+    os.makedirs(tree_path, exist_ok=True)
+    with open(path.join(tree_path, PLACED_TREE_FILENAME), "w") as f:
+        f.write(to_newick(tree) + "\n")
+    return {"samples_placed": len(placed), "samples_pruned": len(pruned),
+            "spr_moves": spr_moves,
+            "parsimony_score": down_sets(tree, leaf_sets)[1]}
@@ -0,0 +1,240 @@
+import os
+import csv
+import json
+from os import path
+
+import numpy as np
+
+import btbphylo.distances as distances
+
+"""
+    A compact binary snp matrix. The matrix is symmetric with a zero
+    diagonal, so only its strict upper triangle is stored, row by row,
+    as a flat uint16 .npy array of N(N-1)/2 distances: snps.npy. Sample
+    names are held in a sidecar, snps_samples.json:
+
+        {"names": [<name>, ...]}
+
+    SnpMatrix memory maps the array so that the row of one sample, or a
+    submatrix of a few samples, is read without loading the whole
+    matrix. snps.csv, in the format of 'snp-dists -c', can be exported
+    from it.
+"""
+
+MATRIX_FILENAME = "snps.npy"
+DTYPE = np.uint16
+CLADE_INDEX_FILENAME = "index.json"
+CROSS_CLADE_FILENAME = "cross_clade_minimums.csv"
+
+
+def samples_path(matrix_path):
+    """
+        Returns the path of the sample-index sidecar of the binary snp
+        matrix at matrix_path
+    """
+    return f"{path.splitext(matrix_path)[0]}_samples.json"
+
+
+def row_offsets(n_samples):
+    """
+        Returns the offset into the flat upper triangle of the first
+        element of each row, i.e. of the distance from sample i to
+        sample i + 1
+    """
+    i = np.arange(n_samples, dtype=np.int64)
+    return i * n_samples - i * (i + 1) // 2
+
+
+def to_dtype(values):
+    """
+        Casts distances to DTYPE; raises ValueError if any does not fit
+    """
+    if len(values) and values.max() > np.iinfo(DTYPE).max:
+        raise ValueError(f"snp distance {values.max()} is too large for "
+                         f"{np.dtype(DTYPE).name}")
+    return values.astype(DTYPE)
+
+
+def write_names(matrix_path, names):
+    """
+        Writes the sample-index sidecar of the binary snp matrix at
+        matrix_path
+    """
+    with open(f"{samples_path(matrix_path)}.part", "w") as f:
+        json.dump({"names": list(names)}, f)
+    os.replace(f"{samples_path(matrix_path)}.part", samples_path(matrix_path))
+
+
+def write_triangle(matrix_path, names, matrix):
+    """
+        Writes the upper triangle of a dense snp matrix, and its sample
+        index, to matrix_path
+
+        Parameters:
+            matrix_path (str): output path of the .npy array
+
+            names (list): sample names in the order of matrix
+
+            matrix (numpy array): square, symmetric snp matrix
+    """
+    offsets = row_offsets(len(names))
+    triangle = np.lib.format.open_memmap(
+        matrix_path, mode="w+", dtype=DTYPE,
+        shape=(len(names) * (len(names) - 1) // 2,))
+    for i, offset in enumerate(offsets):
+        triangle[offset:offset + len(names) - i - 1] = \
+            to_dtype(np.asarray(matrix[i, i + 1:]))
+    triangle.flush()
+    del triangle
+    write_names(matrix_path, names)
+
+
+def csv_to_triangle(matrix_path, snp_dists_outpath):
+    """
+        Converts snps.csv, as output by 'snp-dists -c', into a binary snp
+        matrix at matrix_path, one row at a time
+    """
+    with open(snp_dists_outpath, "r", newline="") as f:
+        reader = csv.reader(f)
+        names = next(reader)[1:]
+        offsets = row_offsets(len(names))
+        triangle = np.lib.format.open_memmap(
+            matrix_path, mode="w+", dtype=DTYPE,
+            shape=(len(names) * (len(names) - 1) // 2,))
+        for i, row in enumerate(reader):
+            triangle[offsets[i]:offsets[i] + len(names) - i - 1] = \
+                to_dtype(np.array(row[i + 2:], dtype=np.int64))
+        triangle.flush()
+        del triangle
+    write_names(matrix_path, names)
+
+
+def save_matrix(snp_dists_outpath, names, matrix, matrix_format="csv"):
+    """
+        Saves a dense snp matrix to snp_dists_outpath, in the format of
+        'snp-dists -c', if matrix_format is "csv", or as a binary snp
+        matrix alongside it (snps.npy) if matrix_format is "npy"
+    """
+    if matrix_format == "npy":
+        write_triangle(matrix_filepath(snp_dists_outpath), names, matrix)
+    else:
+        distances.write_snp_matrix(snp_dists_outpath, names, matrix)
+
+
+def save_clade_matrices(clades_path, clade_names, matrices,
+                        matrix_format="csv", minimums=None):
+    """
+        Saves a snp matrix per clade to clades_path, as <clade>.csv or
+        <clade>.npy (see save_matrix()), with an index, index.json:
+
+            {"matrix_format": ..., "clades": {<clade>: {"file": ...,
+                                                       "samples": ...}}}
+
+        Parameters:
+            clades_path (str): output directory
+
+            clade_names (dict): the sample names of each clade
+
+            matrices (dict): the snp matrix of each clade
+
+            matrix_format (str): "csv" or "npy"
+
+            minimums (numpy array): optional minimum distances between
+            clades, in the order of clade_names, saved to
+            cross_clade_minimums.csv
+    """
+    os.makedirs(clades_path, exist_ok=True)
+    index = {"matrix_format": matrix_format, "clades": {}}
+    for clade, names in clade_names.items():
+        filename = f"{clade}.{matrix_format}"
+        if matrix_format == "npy":
+            write_triangle(path.join(clades_path, filename), names,
+                           matrices[clade])
+        else:
+            distances.write_snp_matrix(path.join(clades_path, filename),
+                                       names, matrices[clade])
+        index["clades"][clade] = {"file": filename, "samples": len(names)}
+    if minimums is not None:
+        with open(path.join(clades_path, CROSS_CLADE_FILENAME), "w") as f:
+            f.write(",".join(["clade"] + list(clade_names)) + "\n")
+            for clade, row in zip(clade_names, minimums):
+                f.write(",".join([clade] + row.astype(str).tolist()) + "\n")
+    with open(path.join(clades_path, CLADE_INDEX_FILENAME), "w") as f:
+        json.dump(index, f, indent=2)
+
+
+def matrix_filepath(snp_dists_outpath):
+    """
+        Returns the path of the binary snp matrix that stands in for the
+        snps.csv at snp_dists_outpath
+    """
+    return path.join(path.dirname(snp_dists_outpath), MATRIX_FILENAME)
+
+
+class SnpMatrix:
+    """
+        Read-only, memory mapped binary snp matrix
+    """
+    def __init__(self, matrix_path):
+        self.matrix_path = matrix_path
+        self.triangle = np.load(matrix_path, mmap_mode="r")
+        with open(samples_path(matrix_path), "r") as f:
+            self.names = json.load(f)["names"]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.offsets = row_offsets(len(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def indices(self, samples):
+        """
+            Returns the matrix indices of samples
+        """
+        try:
+            return np.array([self.index[sample] for sample in samples],
+                            dtype=np.int64)
+        except KeyError as e:
+            raise KeyError(f"{e.args[0]} is not in the snp matrix") from None
+
+    def row(self, sample):
+        """
+            Returns the snp distances from sample to every sample, in the
+            order of names, as a numpy array
+        """
+        i = self.indices([sample])[0]
+        row = np.zeros(len(self), dtype=DTYPE)
+        # distances to earlier samples are in their rows at column i
+        row[:i] = self.triangle[self.offsets[:i] + i - np.arange(i) - 1]
+        row[i + 1:] = self.triangle[self.offsets[i]:
+                                    self.offsets[i] + len(self) - i - 1]
+        return row
+
+    def submatrix(self, samples):
+        """
+            Returns the snp distances between samples as a square numpy
+            array
+        """
+        indices = self.indices(samples)
+        rows = np.minimum.outer(indices, indices)
+        columns = np.maximum.outer(indices, indices)
+        diagonal = rows == columns
+        offsets = self.offsets[rows] + columns - rows - 1
+        offsets[diagonal] = 0
+        submatrix = np.asarray(self.triangle[offsets.ravel()]
+                               if len(self.triangle) else
+                               np.zeros(offsets.size, dtype=DTYPE))
+        submatrix = submatrix.reshape(offsets.shape)
+        submatrix[diagonal] = 0
+        return submatrix
+
+    def to_csv(self, snp_dists_outpath):
+        """
+            Exports the matrix in the format of 'snp-dists -c', one row
+            at a time
+        """
+        with open(snp_dists_outpath, "w") as f:
+            f.write(",".join([f"snp-dists {distances.SNP_DISTS_VERSION}"] +
+                             self.names) + "\n")
+            for name in self.names:
+                f.write(",".join([name] + self.row(name).astype(str).tolist())
+                        + "\n")
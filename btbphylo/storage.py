@@ -0,0 +1,201 @@
+import os
+import shutil
+import threading
+import time
+from os import path
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+
+import btbphylo.utils as utils
+
+"""
+    Object storage backends. S3Storage reads from and writes to s3;
+    LocalStorage is a stand-in that serves the same buckets and keys
+    from a local directory, optionally with injected latency and
+    bandwidth so that ingestion and downloads can be benchmarked
+    offline. The backend is chosen by URI, either with the --storage
+    option or the BTBPHYLO_STORAGE environment variable:
+
+        s3://                                       (default)
+        file:///path/to/root?latency=0.05&bandwidth=20e6
+
+    where the objects of bucket 'b' at key 'k' are held at
+    /path/to/root/b/k, latency is in seconds per request and bandwidth
+    is in bytes per second per request.
+"""
+
+DEFAULT_STORAGE_URI = "s3://"
+
+_storage_uri = os.environ.get("BTBPHYLO_STORAGE", DEFAULT_STORAGE_URI)
+
+
+class BadStorageUriError(Exception):
+    def __init__(self, storage_uri):
+        super().__init__()
+        self.message = f"Unsupported storage uri: '{storage_uri}'"
+
+    def __str__(self):
+        return self.message
+
+
+class S3Storage:
+    """
+        Storage backend for s3. A single boto3 client, with a
+        connection pool of max_pool_connections, is shared by all
+        requests.
+    """
+    def __init__(self, max_pool_connections=10):
+        self.client = utils.s3_client(max_pool_connections=max_pool_connections)
+
+    def list_objects(self, bucket, prefix, delimiter=""):
+        return utils.list_s3_object_metadata(bucket, prefix, delimiter,
+                                             self.client)
+
+    def list_prefixes(self, bucket, prefix):
+        return utils.list_s3_objects(bucket, prefix, self.client)
+
+    def get_object(self, bucket, key):
+        return utils.s3_get_object(bucket, key, self.client)
+
+    def download_file(self, bucket, key, dest):
+        utils.s3_download_file(bucket, key, dest, self.client)
+
+    def upload_file(self, file, bucket, key):
+        self.client.upload_file(file, bucket, key)
+
+
+class LocalStorage:
+    """
+        Storage backend serving objects from root_path/<bucket>/<key>.
+        Every request sleeps for latency seconds and, if bandwidth is
+        set, for a further nbytes/bandwidth seconds. The sleeps release
+        the GIL, so concurrent requests overlap as they would against
+        s3. ETags are derived from the file size and modification time
+        rather than an md5 of the contents.
+    """
+    def __init__(self, root_path, latency=0, bandwidth=None):
+        self.root_path = root_path
+        self.latency = float(latency)
+        self.bandwidth = float(bandwidth) if bandwidth else None
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "bytes": 0}
+
+    def _throttle(self, nbytes=0):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes"] += nbytes
+        delay = self.latency
+        if self.bandwidth:
+            delay += nbytes / self.bandwidth
+        if delay:
+            time.sleep(delay)
+
+    def _filepath(self, bucket, key):
+        return path.join(self.root_path, bucket, key)
+
+    def _object_metadata(self, bucket, key):
+        stat = os.stat(self._filepath(bucket, key))
+        return {"Key": key, "Size": stat.st_size,
+                "ETag": f"{stat.st_size:x}-{stat.st_mtime_ns:x}",
+                "LastModified": datetime.fromtimestamp(stat.st_mtime,
+                                                       tz=timezone.utc)}
+
+    def list_objects(self, bucket, prefix, delimiter=""):
+        self._throttle()
+        # only walk the deepest directory contained in prefix
+        base = prefix.rsplit("/", 1)[0] if "/" in prefix else ""
+        base_path = self._filepath(bucket, base)
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(base_path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                key = path.relpath(path.join(dirpath, filename),
+                                   path.join(self.root_path, bucket))
+                if key.startswith(prefix):
+                    keys.append(key)
+            if delimiter == "/":
+                break
+        return [self._object_metadata(bucket, key) for key in keys]
+
+    def list_prefixes(self, bucket, prefix):
+        self._throttle()
+        base = prefix.rsplit("/", 1)[0] if "/" in prefix else ""
+        base_path = self._filepath(bucket, base)
+        if not path.isdir(base_path):
+            return []
+        return [sub_prefix for sub_prefix in
+                (path.join(base, name, "").lstrip("/") for name in
+                 sorted(os.listdir(base_path))
+                 if path.isdir(path.join(base_path, name)))
+                if sub_prefix.startswith(prefix)]
+
+    def get_object(self, bucket, key):
+        filepath = self._filepath(bucket, key)
+        if not path.isfile(filepath):
+            self._throttle()
+            raise utils.NoS3ObjectError(bucket, key)
+        with open(filepath, "rb") as f:
+            contents = f.read()
+        self._throttle(len(contents))
+        return contents
+
+    def download_file(self, bucket, key, dest):
+        filepath = self._filepath(bucket, key)
+        if not path.isfile(filepath):
+            self._throttle()
+            raise utils.NoS3ObjectError(bucket, key)
+        self._throttle(path.getsize(filepath))
+        shutil.copyfile(filepath, f"{dest}.part")
+        os.replace(f"{dest}.part", dest)
+
+    def upload_file(self, file, bucket, key):
+        self._throttle(path.getsize(file))
+        filepath = self._filepath(bucket, key)
+        os.makedirs(path.dirname(filepath), exist_ok=True)
+        shutil.copyfile(file, filepath)
+
+
+def parse_storage_uri(storage_uri):
+    """
+        Validates storage_uri and returns its scheme, path and query
+        parameters. Raises BadStorageUriError for unsupported schemes.
+    """
+    parsed = urlparse(storage_uri if "://" in storage_uri
+                      else f"{storage_uri}://")
+    if parsed.scheme not in ("s3", "file"):
+        raise BadStorageUriError(storage_uri)
+    if parsed.scheme == "file" and not parsed.path:
+        raise BadStorageUriError(storage_uri)
+    params = {key: values[-1] for key, values in
+              parse_qs(parsed.query).items()}
+    if not set(params).issubset({"latency", "bandwidth"}):
+        raise BadStorageUriError(storage_uri)
+    return parsed.scheme, parsed.path, params
+
+
+def set_storage(storage_uri):
+    """
+        Sets the storage backend returned by get_storage()
+    """
+    global _storage_uri
+    parse_storage_uri(storage_uri)
+    _storage_uri = storage_uri
+
+
+def get_storage_uri():
+    """
+        Returns the configured storage uri
+    """
+    return _storage_uri
+
+
+def get_storage(max_pool_connections=10):
+    """
+        Returns a storage backend for the configured storage uri. For
+        s3 a new client is created with a connection pool of
+        max_pool_connections.
+    """
+    scheme, root_path, params = parse_storage_uri(_storage_uri)
+    if scheme == "file":
+        return LocalStorage(root_path, **params)
+    return S3Storage(max_pool_connections)
@@ -1,45 +1,133 @@
-import tempfile
+import io
+import json
+import time
 from os import path
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
 
 import btbphylo.utils as utils
+import btbphylo.storage as storage
 
 """
     Updates the a local csv file containing metadata for all wgs samples
     in s3-csu-001
 """
 
+DEFAULT_DOWNLOAD_WORKERS = 16
+DEFAULT_FINALOUT_PREFIXES = ["v3-2"]
 
-def get_finalout_s3_keys(bucket="s3-csu-003", prefix="v3-2"):
+
+def get_finalout_s3_objects(bucket="s3-csu-003",
+                            prefixes=DEFAULT_FINALOUT_PREFIXES,
+                            n_workers=DEFAULT_DOWNLOAD_WORKERS):
     """
-        Returns a list of s3 keys for all FinalOut.csv files stored under the
-        given prefix.
+        Returns metadata for all FinalOut.csv files stored under the
+        given prefixes. The sub-prefixes (batch folders) directly
+        beneath each prefix are listed first and then paginated
+        concurrently by a pool of worker threads which share a single
+        storage backend (see storage.get_storage). Keys are filtered
+        in-process.
+
+        Parameters:
+            bucket (str): s3 bucket containing btb-seq results
+
+            prefixes (list): top level prefixes, e.g. one per btb-seq
+            pipeline version
+
+            n_workers (int): maximum number of concurrent listings
+
+        Returns:
+            finalout_objects (list): a dictionary for each FinalOut.csv
+            object containing its 'Key', 'Size', 'ETag' and
+            'LastModified', sorted by key
     """
-    cmd = \
-        f'aws s3 ls s3://{bucket}/{prefix}/ --recursive | grep -e \
-            ".*FinalOut.*"'
-    # direct output of cmd subprocess into finalout_s3_data
-    finalout_s3_data = utils.run(cmd, shell=True, capture_output=True)
-    # extract s3 key from output of cmd
-    return list(map(extract_s3_key, finalout_s3_data.split("\n")))
+    store = storage.get_storage(max_pool_connections=n_workers)
+    # list objects directly beneath each prefix and collect the batch
+    # sub-prefixes
+    listings = []
+    sub_prefixes = []
+    for prefix in prefixes:
+        prefix = path.join(prefix, "")
+        listings.append(store.list_objects(bucket, prefix, "/"))
+        sub_prefixes.extend(store.list_prefixes(bucket, prefix))
+    # recursively list each sub-prefix concurrently
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        listings.extend(executor.map(
+            lambda sub_prefix: store.list_objects(bucket, sub_prefix),
+            sub_prefixes))
+    return sorted((s3_object for listing in listings for s3_object in listing
+                   if "FinalOut" in s3_object["Key"]),
+                  key=lambda s3_object: s3_object["Key"])
 
 
-def extract_s3_key(final_out_s3_object):
+def get_finalout_s3_keys(bucket="s3-csu-003",
+                         prefixes=DEFAULT_FINALOUT_PREFIXES,
+                         n_workers=DEFAULT_DOWNLOAD_WORKERS):
     """
-        Extracts the s3 key from s3 metadata of a single FinalOut.csv file
+        Returns a list of s3 keys for all FinalOut.csv files stored under
+        the given prefixes.
     """
-    return final_out_s3_object.split(" ")[-1]
+    return [s3_object["Key"] for s3_object in
+            get_finalout_s3_objects(bucket, prefixes, n_workers)]
 
 
-def finalout_s3_to_df(s3_key, s3_bucket="s3-csu-003"):
+def finalout_s3_to_df(s3_key, s3_bucket="s3-csu-003", store=None):
+    """
+        Downloads a FinalOut.csv file into memory and parses it into a
+        pandas dataframe
     """
-        Downloads FinalOut.csv files and writes to pandas dataframe
+    if store is None:
+        store = storage.get_storage()
+    finalout_bytes = store.get_object(s3_bucket, s3_key)
+    return utils.finalout_csv_to_df(io.BytesIO(finalout_bytes))
+
+
+def download_finalouts(s3_keys, s3_bucket="s3-csu-003",
+                       n_workers=DEFAULT_DOWNLOAD_WORKERS):
     """
-    with tempfile.TemporaryDirectory() as temp_dirname:
-        finalout_path = path.join(temp_dirname, "FinalOut.csv")
-        utils.s3_download_file_cli(s3_bucket, s3_key, finalout_path)
-        return utils.finalout_csv_to_df(finalout_path)
+        Downloads and parses FinalOut.csv files concurrently using a
+        bounded pool of worker threads which share a single storage
+        backend (and connection pool).
+
+        Parameters:
+            s3_keys (list): s3 keys of FinalOut.csv files
+
+            s3_bucket (str): s3 bucket containing the FinalOut.csv
+            files
+
+            n_workers (int): maximum number of concurrent downloads
+
+        Returns:
+            finalout_dfs (list): pandas DataFrame objects for each
+            successfully downloaded key, in the same order as s3_keys
+
+            errors (dict): error messages for each key that failed to
+            download or parse, keyed by s3 key
+    """
+    n_workers = max(1, min(int(n_workers), len(s3_keys) or 1))
+    store = storage.get_storage(max_pool_connections=n_workers)
+    finalout_dfs = {}
+    errors = {}
+    num_batches = len(s3_keys)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(finalout_s3_to_df, key, s3_bucket,
+                                   store): key for key in s3_keys}
+        for count, future in enumerate(as_completed(futures), 1):
+            key = futures[future]
+            print(f"\t\tdownloading batch summary: {count} / {num_batches}",
+                  end="\r")
+            try:
+                finalout_dfs[key] = future.result()
+            except Exception as e:
+                errors[key] = str(e)
+    print(f"\t\tdownloaded batch summaries: "
+          f"{num_batches-len(errors)} / {num_batches} \n")
+    for key, message in errors.items():
+        print(f"\t\tfailed to download batch summary '{key}': {message}")
+    return [finalout_dfs[key] for key in s3_keys if key in finalout_dfs], \
+        errors
 
 
 def get_df_wgs(summary_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH):
@@ -48,35 +136,151 @@ def get_df_wgs(summary_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH):
         if local copy of summary csv does not exist.
     """
     if path.exists(summary_filepath):
-        return utils.wgs_csv_to_df(summary_filepath)
+        return utils.load_wgs_samples(summary_filepath)
     # if running for the first time (i.e. no btb_wgs_samples.csv),
     # create new empty dataframe
     else:
-        column_names = ["Sample", "GenomeCov", "MeanDepth", "NumRawReads",
-                        "pcMapped", "Outcome", "flag", "group", "CSSTested",
-                        "matches", "mismatches", "noCoverage", "anomalous",
-                        "Ncount", "ResultLoc", "ID", "TotalReads", "Abundance",
-                        "Submission"]
-        return pd.DataFrame(columns=column_names)
+        return pd.DataFrame(columns=list(utils.WGS_DTYPES))
 
 
-def new_final_out_keys(df_summary):
+def get_manifest_filepath(summary_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH):
     """
-        Returns a list of s3_keys for FinalOut.csv files not currently
-        in the 'all_wgs_samples' .csv file, i.e. new data.
+        Returns the path of the ingestion manifest that accompanies the
+        summary csv, e.g. 'all_wgs_samples_manifest.json'
+    """
+    return f"{path.splitext(summary_filepath)[0]}_manifest.json"
+
+
+def load_manifest(manifest_filepath):
+    """
+        Reads the ingestion manifest: a json file recording the ETag and
+        LastModified of every ingested FinalOut.csv (keyed by s3 key)
+        and the most recent s3 listing. Returns an empty manifest if the
+        file does not exist or is empty.
+    """
+    manifest = {"listed_at": None, "prefixes": [], "listing": [],
+                "ingested": {}}
+    if path.exists(manifest_filepath) and path.getsize(manifest_filepath):
+        with open(manifest_filepath) as f:
+            manifest.update(json.load(f))
+    # manifests of earlier versions record an unused LastModified
+    # watermark
+    manifest.pop("watermark", None)
+    return manifest
+
+
+def save_manifest(manifest, manifest_filepath):
+    """
+        Saves the ingestion manifest to json
+    """
+    with open(manifest_filepath, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def list_finalout_objects(manifest, prefixes=DEFAULT_FINALOUT_PREFIXES,
+                          n_workers=DEFAULT_DOWNLOAD_WORKERS, listing_ttl=0):
+    """
+        Returns metadata for all FinalOut.csv files under prefixes (see
+        get_finalout_s3_objects). If the listing cached in manifest is
+        for the same prefixes and is younger than listing_ttl seconds,
+        s3 is skipped entirely and the cached listing is returned.
+        Otherwise s3 is listed and the listing is cached in manifest.
+        LastModified is returned as an ISO 8601 string.
+    """
+    now = datetime.now(timezone.utc)
+    if listing_ttl > 0 and manifest["listed_at"] and \
+            sorted(manifest["prefixes"]) == sorted(prefixes) and \
+            (now - datetime.fromisoformat(manifest["listed_at"])).\
+            total_seconds() < listing_ttl:
+        return manifest["listing"]
+    finalout_objects = [dict(s3_object,
+                             LastModified=s3_object["LastModified"].isoformat())
+                        for s3_object in
+                        get_finalout_s3_objects(prefixes=prefixes,
+                                                n_workers=n_workers)]
+    manifest.update({"listed_at": now.isoformat(), "prefixes": list(prefixes),
+                     "listing": finalout_objects})
+    return finalout_objects
+
+
+def result_loc(s3_key, s3_bucket="s3-csu-003"):
+    """
+        Returns the 'ResultLoc' of the batch containing the FinalOut.csv
+        at s3_key, i.e. its s3 uri with the filename stripped
+    """
+    prefix = "/".join(s3_key.split("/")[:-1])
+    return f"s3://{s3_bucket}/{prefix}/"
+
+
+def seed_manifest(manifest, df_summary, finalout_objects):
+    """
+        Records every FinalOut.csv whose batch is already summarised in
+        df_summary as ingested. Used on the first run with a manifest,
+        i.e. when all_wgs_samples.csv pre-dates the manifest.
     """
-    # get list of all FinalOut.csv s3 keys
-    s3_keys = get_finalout_s3_keys()
-    new_keys = []
     old_result_loc = set(df_summary["ResultLoc"])
-    for key in s3_keys:
-        prefix = "/".join(key.split("/")[:-1])
-        result_loc = f"s3://s3-csu-003/{prefix}/"
-        # if data not already summarised in df_summary, i.e. new data
-        if result_loc not in old_result_loc:
-            # add the s3 key to new_keys
+    ingested = [s3_object for s3_object in finalout_objects
+                if result_loc(s3_object["Key"]) in old_result_loc]
+    update_manifest(manifest, ingested)
+
+
+def update_manifest(manifest, ingested_objects):
+    """
+        Records the ETag and LastModified of ingested_objects in
+        manifest
+    """
+    for s3_object in ingested_objects:
+        manifest["ingested"][s3_object["Key"]] = \
+            {"ETag": s3_object["ETag"],
+             "LastModified": s3_object["LastModified"]}
+
+
+def new_final_out_keys(finalout_objects, manifest):
+    """
+        Compares a listing of FinalOut.csv objects against the manifest
+        and returns the s3 keys of data that needs ingesting.
+
+        Objects that are already recorded are compared by ETag to
+        detect batches that have been reprocessed in place, whatever
+        their LastModified, so that a reprocessed batch that failed to
+        ingest, and keeps its old ETag in the manifest, is compared
+        again on the next run. Every object must therefore be listed,
+        not only those newer than the last ingested.
+
+        Parameters:
+            finalout_objects (list): metadata for FinalOut.csv objects
+            (see list_finalout_objects)
+
+            manifest (dict): ingestion manifest (see load_manifest)
+
+        Returns:
+            new_keys (list): s3 keys for FinalOut.csv files not yet
+            ingested, i.e. new data
+
+            changed_keys (list): s3 keys for FinalOut.csv files that
+            have been ingested but whose ETag has since changed
+    """
+    new_keys = []
+    changed_keys = []
+    for s3_object in finalout_objects:
+        key = s3_object["Key"]
+        ingested = manifest["ingested"].get(key)
+        if ingested is None:
             new_keys.append(key)
-    return new_keys
+        elif s3_object["ETag"] != ingested["ETag"]:
+            changed_keys.append(key)
+    return new_keys, changed_keys
+
+
+def drop_batches(df_summary, s3_keys, s3_bucket="s3-csu-003"):
+    """
+        Removes samples from df_summary that belong to the batches of
+        the FinalOut.csv files at s3_keys
+    """
+    if not s3_keys:
+        return df_summary
+    result_locs = [result_loc(key, s3_bucket) for key in s3_keys]
+    return df_summary.loc[~df_summary["ResultLoc"].isin(result_locs)]
 
 
 def add_submission_col(df):
@@ -87,10 +291,13 @@ def add_submission_col(df):
     return df
 
 
-def append_df_wgs(df_summary, new_keys, itteration=0):
+def append_df_wgs(df_summary, new_keys, n_workers=DEFAULT_DOWNLOAD_WORKERS,
+                  reprocessed_keys=()):
     """
         Appends new FinalOut.csv data (with additional submission
-        number) to the df_wgs.
+        number) to the df_wgs. All new FinalOut.csv files are
+        downloaded first and then merged into df_summary with a single
+        concatenation.
 
         Parameters:
             df_summary (pandas DataFrame object): a dataframe read from
@@ -100,27 +307,36 @@ def append_df_wgs(df_summary, new_keys, itteration=0):
             all new data, i.e. data not currently summarised in
             wgs_samples.csv
 
-            itteration (int): the current itteration for reccursive
-            count
+            n_workers (int): maximum number of concurrent downloads
+
+            reprocessed_keys (list): a list of s3 keys for FinalOut.csv
+            files of batches already summarised in df_summary that have
+            since been reprocessed. Existing samples from these batches
+            are replaced if the new FinalOut.csv downloads successfully
 
         Returns:
             df_summary (pandas DataFrame object): an updated dataframe
             with new wgs sample metadata added
+
+            metadata (dict): the total number of samples and, if any
+            downloads failed, the error message for each failed key
     """
-    df_summary.reset_index(inplace=True, drop=True)
-    # if not yet on last itteration (last new_key element)
-    num_batches = len(new_keys)
-    if itteration < num_batches:
-        print(f"\t\tdownloading batch summary: {itteration+1} / {num_batches}",
-              end="\r")
-        # read FinalOut.csv for current key
-        finalout_df = finalout_s3_to_df(new_keys[itteration]).\
-            pipe(add_submission_col)
-        # append to df_summary
-        df_summary, _ = append_df_wgs(pd.concat([df_summary, finalout_df]),
-                                      new_keys, itteration+1)
-    else:
-        print(f"\t\tdownloaded batch summaries: \
-            {num_batches} / {num_batches} \n")
+    start_time = time.perf_counter()
+    finalout_dfs, errors = download_finalouts([*new_keys, *reprocessed_keys],
+                                              n_workers=n_workers)
+    # remove stale samples from reprocessed batches
+    df_summary = drop_batches(df_summary, [key for key in reprocessed_keys
+                                           if key not in errors])
+    new_dfs = [finalout_df.pipe(add_submission_col)
+               for finalout_df in finalout_dfs]
+    num_new_samples = sum(len(new_df) for new_df in new_dfs)
+    # append all new data to df_summary in one go
+    df_summary = pd.concat([df_summary, *new_dfs], ignore_index=True)
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    print(f"\t\tappended {num_new_samples} samples from {len(new_dfs)} "
+          f"batches in {elapsed:.1f}s ({len(new_dfs)/elapsed:.1f} batches/s, "
+          f"{num_new_samples/elapsed:.1f} samples/s) \n")
     metadata = {"total_number_of_wgs_samples": len(df_summary)}
+    if errors:
+        metadata["failed_batch_summaries"] = errors
     return df_summary, metadata
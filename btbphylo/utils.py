@@ -1,4 +1,6 @@
 import subprocess
+import os
+import shutil
 from os import path
 import re
 import itertools
@@ -8,6 +10,7 @@ import threading
 
 import boto3
 import botocore
+from botocore.config import Config
 import pandas as pd
 
 
@@ -19,6 +22,20 @@ DEFAULT_WGS_SAMPLES_FILEPATH = \
     path.join(path.dirname(path.dirname(path.abspath(__file__))),
               "all_wgs_samples.csv")
 
+# column names and dtypes of the sample summary; 'Sample' is unique to
+# each row so is not stored as a category
+WGS_DTYPES = {"Sample": object, "GenomeCov": float, "MeanDepth": float,
+              "NumRawReads": float, "pcMapped": float, "Outcome": "category",
+              "flag": "category", "group": "category", "CSSTested": float,
+              "matches": float, "mismatches": float, "noCoverage": float,
+              "anomalous": float, "Ncount": float, "ResultLoc": "category",
+              "ID": "category", "TotalReads": float, "Abundance": float,
+              "Submission": object}
+
+# parquet partitioning schemes for the sample summary: by clade or by
+# ingestion batch
+PARQUET_PARTITIONS = {"group": "group", "batch": "ResultLoc"}
+
 
 class InvalidDtype(Exception):
     def __init__(self,
@@ -76,17 +93,7 @@ def wgs_csv_to_df(summary_filepath):
         Read sample summary CSV and returns the data in a pandas
         dataframe.
     """
-    df = pd.read_csv(summary_filepath, comment="#",
-                     dtype={"Sample": "category", "GenomeCov": float,
-                            "MeanDepth": float, "NumRawReads": float,
-                            "pcMapped": float, "Outcome": "category",
-                            "flag": "category", "group": "category",
-                            "CSSTested": float, "matches": float,
-                            "mismatches": float, "noCoverage": float,
-                            "anomalous": float, "Ncount": float,
-                            "ResultLoc": "category", "ID": "category",
-                            "TotalReads": float, "Abundance": float,
-                            "Submission": object})
+    df = pd.read_csv(summary_filepath, comment="#", dtype=WGS_DTYPES)
     return df
 
 
@@ -95,18 +102,52 @@ def finalout_csv_to_df(finalout_filepath):
         Reads finalout CSV and returns the data in a pandas dataframe.
     """
     df = pd.read_csv(finalout_filepath, comment="#",
-                     dtype={"Sample": "category", "GenomeCov": float,
-                            "MeanDepth": float, "NumRawReads": float,
-                            "pcMapped": float, "Outcome": "category",
-                            "flag": "category", "group": "category",
-                            "CSSTested": float, "matches": float,
-                            "mismatches": float, "noCoverage": float,
-                            "anomalous": float, "Ncount": float,
-                            "ResultLoc": "category", "ID": "category",
-                            "TotalReads": float, "Abundance": float})
+                     dtype={column: dtype for column, dtype in
+                            WGS_DTYPES.items() if column != "Submission"})
     return df
 
 
+def is_parquet(summary_filepath):
+    """
+        Returns true if the sample summary at summary_filepath is a
+        parquet dataset, i.e. has a '.parquet' extension
+    """
+    return path.splitext(summary_filepath.rstrip("/"))[1] == ".parquet"
+
+
+def wgs_parquet_to_df(summary_filepath, columns=None, filters=None):
+    """
+        Reads a sample summary parquet dataset and returns the data in a
+        pandas dataframe, in the order it was saved. Only the columns
+        in columns (all if None) are read and only the partitions and
+        row groups that can match filters (pyarrow filter expressions,
+        e.g. [("Outcome", "in", ["Pass"])]) are scanned. Requires
+        pyarrow.
+    """
+    # pyarrow is an optional dependency
+    import pyarrow.dataset as ds
+    # partition values are read as strings, not dictionaries, as pyarrow
+    # cannot combine dictionary partitions with a null partition
+    df = pd.read_parquet(summary_filepath, engine="pyarrow", columns=columns,
+                         filters=filters or None,
+                         partitioning=ds.partitioning(flavor="hive"))
+    # restore column order and dtypes, partition columns are read last
+    df = df[[column for column in WGS_DTYPES if column in df.columns]]
+    return df.astype({column: WGS_DTYPES[column] for column in df.columns}).\
+        sort_index().reset_index(drop=True)
+
+
+def load_wgs_samples(summary_filepath, columns=None, filters=None):
+    """
+        Loads the sample summary from csv or, if summary_filepath has a
+        '.parquet' extension, from a parquet dataset. columns and
+        filters only apply to parquet (see wgs_parquet_to_df).
+    """
+    if is_parquet(summary_filepath):
+        return wgs_parquet_to_df(summary_filepath, columns, filters)
+    return wgs_csv_to_df(summary_filepath)
+
+
 def extract_submission_no(sample_name):
     """
         Extracts submision number from sample name using regex.
@@ -191,17 +232,20 @@ def s3_download_folder(bucket, key, dest):
         raise NoS3ObjectError(bucket, key)
 
 
-# TODO: remove if unused
-def s3_download_file(bucket, key, dest):
+def s3_download_file(bucket, key, dest, client=None):
     """
-        Downloads s3 folder at the key-bucket pair (strings) to dest
-        path (string) using boto3
+        Downloads s3 object at the key-bucket pair (strings) to dest
+        path (string) using boto3. The object is streamed from a single
+        GET request, i.e. without a preceding HEAD request, into a
+        temporary file which is renamed to dest once complete. Raises
+        NoS3ObjectError if the object does not exist.
     """
-    if s3_object_exists(bucket, key):
-        s3 = boto3.client('s3')
-        s3.download_file(bucket, key, dest)
-    else:
-        raise NoS3ObjectError(bucket, key)
+    body = s3_get_object_body(bucket, key, client)
+    temp_dest = f"{dest}.part"
+    with open(temp_dest, "wb") as f:
+        for chunk in body.iter_chunks(chunk_size=1024*1024):
+            f.write(chunk)
+    os.replace(temp_dest, dest)
 
 
 def s3_download_file_cli(bucket, key, dest):
@@ -216,20 +260,79 @@ def s3_download_file_cli(bucket, key, dest):
         raise NoS3ObjectError(bucket, key)
 
 
+def s3_client(max_pool_connections=10):
+    """
+        Returns a boto3 s3 client created from its own session. The
+        connection pool is sized to max_pool_connections so that a
+        single client can be shared between that many worker threads
+        (boto3 clients are thread safe, sessions are not).
+    """
+    config = Config(max_pool_connections=max_pool_connections,
+                    retries={"max_attempts": 5, "mode": "standard"})
+    return boto3.session.Session().client("s3", config=config)
+
+
+def s3_get_object_body(bucket, key, client=None):
+    """
+        Returns a streaming body for the s3 object at the key-bucket
+        pair (strings) from a single GET request. Raises
+        NoS3ObjectError if the object does not exist.
+    """
+    if client is None:
+        client = s3_client()
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+            raise NoS3ObjectError(bucket, key)
+        raise e
+    return response["Body"]
+
+
+def s3_get_object(bucket, key, client=None):
+    """
+        Returns the contents (bytes) of the s3 object at the key-bucket
+        pair (strings) with a single GET request. Raises
+        NoS3ObjectError if the object does not exist.
+    """
+    return s3_get_object_body(bucket, key, client).read()
+
+
 def s3_upload_file(file, bucket, key):
     s3_client = boto3.client('s3')
     s3_client.upload_file(file, bucket, key)
 
 
-# TODO: remove if unused
-def list_s3_objects(bucket, prefix):
+def list_s3_objects(bucket, prefix, client=None):
     """
-        Return a list of s3 objects with the common prefix (argument)
+        Return a list of s3 objects with the common prefix (argument),
+        i.e. the 'sub-folders' directly beneath prefix. Paginates so
+        that prefixes with more than 1000 entries are listed in full.
     """
-    s3_client = boto3.client('s3')
-    response = s3_client.list_objects_v2(Bucket=bucket, Delimiter='/',
-                                         Prefix=prefix)
-    return [i['Prefix'] for i in response['CommonPrefixes']]
+    if client is None:
+        client = s3_client()
+    paginator = client.get_paginator("list_objects_v2")
+    return [common_prefix['Prefix'] for page in
+            paginator.paginate(Bucket=bucket, Delimiter='/', Prefix=prefix)
+            for common_prefix in page.get('CommonPrefixes', [])]
+
+
+def list_s3_object_metadata(bucket, prefix, delimiter="", client=None):
+    """
+        Returns a list of dictionaries containing the Key, Size, ETag
+        and LastModified of every object under prefix, using the
+        list_objects_v2 paginator. If delimiter is '/' only objects
+        directly beneath prefix are listed.
+    """
+    if client is None:
+        client = s3_client()
+    paginator = client.get_paginator("list_objects_v2")
+    return [{"Key": s3_object["Key"], "Size": s3_object["Size"],
+             "ETag": s3_object["ETag"].strip('"'),
+             "LastModified": s3_object["LastModified"]} for page in
+            paginator.paginate(Bucket=bucket, Delimiter=delimiter,
+                               Prefix=prefix)
+            for s3_object in page.get("Contents", [])]
 
 
 def df_to_csv(df_wgs, summary_filepath=DEFAULT_WGS_SAMPLES_FILEPATH):
@@ -237,3 +340,47 @@ def df_to_csv(df_wgs, summary_filepath=DEFAULT_WGS_SAMPLES_FILEPATH):
         Save df_wgs to csv
     """
     df_wgs.to_csv(summary_filepath, index=False)
+
+
+def df_to_parquet(df_wgs, summary_filepath, partition_by="group"):
+    """
+        Save df_wgs to a parquet dataset partitioned by clade
+        (partition_by="group") or by ingestion batch
+        (partition_by="batch"). The row order is stored in the index so
+        that it survives partitioning. The dataset is written to a
+        temporary directory and then swapped in place of any existing
+        dataset. Requires pyarrow.
+    """
+    summary_filepath = summary_filepath.rstrip("/")
+    temp_filepath = f"{summary_filepath}.tmp"
+    shutil.rmtree(temp_filepath, ignore_errors=True)
+    df_wgs.reset_index(drop=True).\
+        to_parquet(temp_filepath, engine="pyarrow", index=True,
+                   partition_cols=[PARQUET_PARTITIONS[partition_by]])
+    shutil.rmtree(summary_filepath, ignore_errors=True)
+    os.rename(temp_filepath, summary_filepath)
+
+
+def save_wgs_samples(df_wgs, summary_filepath=DEFAULT_WGS_SAMPLES_FILEPATH,
+                     partition_by="group"):
+    """
+        Saves the sample summary to csv or, if summary_filepath has a
+        '.parquet' extension, to a parquet dataset (see df_to_parquet)
+    """
+    if is_parquet(summary_filepath):
+        df_to_parquet(df_wgs, summary_filepath, partition_by)
+    else:
+        df_to_csv(df_wgs, summary_filepath)
+
+
+def export_wgs_samples_csv(summary_filepath, csv_filepath):
+    """
+        Copies the sample summary to csv_filepath, e.g. for the results
+        metadata folder. A parquet dataset is converted to csv, unless
+        csv_filepath is already newer than the dataset.
+    """
+    if not is_parquet(summary_filepath):
+        shutil.copy(summary_filepath, csv_filepath)
+    elif not path.exists(csv_filepath) or \
+            path.getmtime(csv_filepath) < path.getmtime(summary_filepath):
+        df_to_csv(wgs_parquet_to_df(summary_filepath), csv_filepath)
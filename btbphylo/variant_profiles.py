@@ -0,0 +1,282 @@
+import os
+import json
+import struct
+import hashlib
+from os import path
+
+import numpy as np
+
+import btbphylo.alignment as alignment
+import btbphylo.consensus_cache as consensus_cache
+
+"""
+    Per-sample variant profiles. A consensus genome differs from the
+    reference at only a few hundred to a few thousand positions, so
+    each sample is reduced, once per consensus file, to the positions
+    and alleles at which it has an A, C, G or T that differs from the
+    reference, and a run-length mask of its other (N, gap, ambiguous)
+    positions. Profiles are appended to a single data file,
+    profiles.bin, indexed by profiles.json:
+
+        {"reference": <sha256 of the reference>,
+         "entries": {<Sample>: {"offset": ..., "size": ...,
+                                "source": <ETag or sha256 of the
+                                           cached consensus>}}}
+
+    snp sites and the snp alignment are then derived from the profiles
+    with sparse operations on the union of variant positions rather
+    than by scanning whole genomes.
+"""
+
+INDEX_FILENAME = "profiles.json"
+DATA_FILENAME = "profiles.bin"
+
+# profile header: magic, sequence length, name length, number of
+# variants and number of masked runs
+PROFILE_MAGIC = b"BTBV"
+PROFILE_HEADER = struct.Struct("<4sIIII")
+
+
+def load_reference(reference_path):
+    """
+        Returns the nucleotide codes (see alignment.NUCLEOTIDE_CODES) of
+        the first sequence of the fasta at reference_path
+    """
+    for _, sequence in alignment.fasta_records(reference_path):
+        return alignment.NUCLEOTIDE_CODES[sequence]
+    raise ValueError(f"{reference_path} contains no sequences")
+
+
+def build_profile(contents, reference):
+    """
+        Builds the variant profile of a consensus sequence
+
+        Parameters:
+            contents (bytes): fasta record of the consensus sequence
+
+            reference (numpy array): nucleotide codes of the reference
+
+        Returns:
+            profile (dict): sequence name, sequence length, variant
+            positions and alleles (nucleotide codes) and the starts
+            and lengths of masked runs
+    """
+    (name, span), = alignment.record_spans(contents)
+    codes = alignment.NUCLEOTIDE_CODES[
+        alignment.record_sequence(contents, span)]
+    if len(codes) != len(reference):
+        raise ValueError(f"sequence length {len(codes)} does not match "
+                         f"the reference length {len(reference)}")
+    positions = np.flatnonzero((codes < 4) & (codes != reference))
+    # starts and ends of runs of non-ACGT bases
+    edges = np.diff(np.concatenate(([0], codes == 4, [0])).astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    return {"name": name.decode(), "length": len(codes),
+            "positions": positions.astype(np.uint32),
+            "alleles": codes[positions],
+            "mask_starts": starts.astype(np.uint32),
+            "mask_lengths": (np.flatnonzero(edges == -1) - starts
+                             ).astype(np.uint32)}
+
+
+def encode_profile(profile):
+    """
+        Serialises a profile to bytes
+    """
+    name = profile["name"].encode()
+    return PROFILE_HEADER.pack(PROFILE_MAGIC, profile["length"], len(name),
+                               len(profile["positions"]),
+                               len(profile["mask_starts"])) + name + \
+        profile["positions"].astype("<u4").tobytes() + \
+        profile["alleles"].astype(np.uint8).tobytes() + \
+        profile["mask_starts"].astype("<u4").tobytes() + \
+        profile["mask_lengths"].astype("<u4").tobytes()
+
+
+def decode_profile(data):
+    """
+        Deserialises a profile serialised by encode_profile()
+    """
+    magic, length, name_length, n_variants, n_runs = \
+        PROFILE_HEADER.unpack_from(data)
+    if magic != PROFILE_MAGIC:
+        raise ValueError("Not a variant profile")
+    offset = PROFILE_HEADER.size + name_length
+    profile = {"name": bytes(data[PROFILE_HEADER.size:offset]).decode(),
+               "length": length}
+    for key, dtype, count in (("positions", "<u4", n_variants),
+                              ("alleles", np.uint8, n_variants),
+                              ("mask_starts", "<u4", n_runs),
+                              ("mask_lengths", "<u4", n_runs)):
+        profile[key] = np.frombuffer(data, dtype=dtype, count=count,
+                                     offset=offset)
+        offset += profile[key].nbytes
+    return profile
+
+
+class ProfileStore:
+    """
+        Store of the variant profiles, against reference, of samples in
+        a consensus cache, held in profile_path. Profiles built against
+        a different reference are discarded.
+    """
+    def __init__(self, profile_path, reference):
+        self.profile_path = profile_path
+        self.reference = reference
+        self.index_filepath = path.join(profile_path, INDEX_FILENAME)
+        self.data_filepath = path.join(profile_path, DATA_FILENAME)
+        reference_sha256 = hashlib.sha256(reference.tobytes()).hexdigest()
+        os.makedirs(profile_path, exist_ok=True)
+        self.index = {"reference": reference_sha256, "entries": {}}
+        if path.exists(self.index_filepath):
+            with open(self.index_filepath, "r") as f:
+                index = json.load(f)
+            if index["reference"] == reference_sha256:
+                self.index = index
+        if not self.index["entries"] and path.exists(self.data_filepath):
+            os.remove(self.data_filepath)
+        self.stats = {"built": 0, "reused": 0}
+
+    @property
+    def entries(self):
+        return self.index["entries"]
+
+    def get(self, sample):
+        """
+            Returns the profile of sample
+        """
+        entry = self.entries[sample]
+        with open(self.data_filepath, "rb") as f:
+            f.seek(entry["offset"])
+            return decode_profile(f.read(entry["size"]))
+
+    def put(self, sample, source, profile):
+        """
+            Appends the profile of sample, built from the cached
+            consensus identified by source, to the store
+        """
+        data = encode_profile(profile)
+        with open(self.data_filepath, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        self.entries[sample] = {"offset": offset, "size": len(data),
+                                "source": source}
+
+    def update(self, samples, cache):
+        """
+            Builds profiles for those of samples whose profile is
+            missing or was built from a different consensus
+
+            Parameters:
+                samples (list): samples in cache
+
+                cache (consensus_cache.ConsensusCache object): consensus
+                cache
+
+            Returns:
+                invalid (dict): the reason a profile could not be built
+                for each sample that failed
+        """
+        invalid = {}
+        for count, sample in enumerate(samples, 1):
+            print(f"\t\tprofiling sample: {count} / {len(samples)}", end="\r")
+            entry = cache.index[sample]
+            source = entry.get("ETag") or entry["sha256"]
+            if self.entries.get(sample, {}).get("source") == source:
+                self.stats["reused"] += 1
+                continue
+            try:
+                self.put(sample, source,
+                         build_profile(cache.read(sample), self.reference))
+                self.stats["built"] += 1
+            except (ValueError, consensus_cache.CorruptCacheError) as e:
+                invalid[sample] = str(e)
+        print()
+        return invalid
+
+    def save(self, samples=None):
+        """
+            Saves the index. If samples is given, profiles of other
+            samples are dropped and the data file is rewritten once
+            more than half of it is unused.
+        """
+        if samples is not None:
+            samples = set(samples)
+            for sample in list(self.entries):
+                if sample not in samples:
+                    del self.entries[sample]
+            used = sum(entry["size"] for entry in self.entries.values())
+            if path.exists(self.data_filepath) and \
+                    used < path.getsize(self.data_filepath) / 2:
+                self.compact()
+        with open(f"{self.index_filepath}.part", "w") as f:
+            json.dump(self.index, f)
+        os.replace(f"{self.index_filepath}.part", self.index_filepath)
+
+    def compact(self):
+        """
+            Rewrites the data file without unused profiles
+        """
+        data_filepath = f"{self.data_filepath}.part"
+        with open(self.data_filepath, "rb") as src, \
+                open(data_filepath, "wb") as dest:
+            for entry in self.entries.values():
+                src.seek(entry["offset"])
+                data = src.read(entry["size"])
+                entry["offset"] = dest.tell()
+                dest.write(data)
+        os.replace(data_filepath, self.data_filepath)
+
+
+def snp_sites(profiles):
+    """
+        Finds the sites that 'snp-sites -c' would output for the
+        alignment of the profiled sequences: candidate sites are the
+        union of variant positions, less those masked in any sample and
+        those at which every sample has the same allele
+
+        Parameters:
+            profiles (list): variant profiles
+
+        Returns:
+            positions (numpy array): 0-based positions of the sites
+    """
+    if not profiles:
+        return np.zeros(0, dtype=np.int64)
+    candidates, inverse = np.unique(
+        np.concatenate([profile["positions"] for profile in profiles]),
+        return_inverse=True)
+    candidates = candidates.astype(np.int64)
+    alleles = np.concatenate([profile["alleles"] for profile in profiles])
+    # candidates masked in any sample
+    masked = np.zeros(len(candidates), dtype=bool)
+    for profile in profiles:
+        if not len(profile["mask_starts"]):
+            continue
+        run = np.searchsorted(profile["mask_starts"], candidates,
+                              side="right") - 1
+        masked |= (run >= 0) & (candidates < (
+            profile["mask_starts"][np.maximum(run, 0)].astype(np.int64) +
+            profile["mask_lengths"][np.maximum(run, 0)]))
+    # candidates at which some sample has the reference allele or the
+    # samples have more than one allele
+    n_variants = np.bincount(inverse, minlength=len(candidates))
+    n_alleles = np.bincount(np.unique(inverse * 4 + alleles) // 4,
+                            minlength=len(candidates))
+    variable = (n_variants < len(profiles)) | (n_alleles > 1)
+    return candidates[~masked & variable]
+
+
+def snp_codes(profiles, reference, positions):
+    """
+        Returns the nucleotide codes of each profiled sequence at
+        positions, as a 2D numpy array with a row per sequence
+    """
+    codes = np.tile(reference[positions], (len(profiles), 1))
+    for i, profile in enumerate(profiles):
+        columns = np.searchsorted(positions, profile["positions"])
+        found = columns < len(positions)
+        found[found] = positions[columns[found]] == \
+            profile["positions"][found]
+        codes[i, columns[found]] = profile["alleles"][found]
+    return codes
@@ -9,6 +9,7 @@ setup(name=NAME,
       license="MIT",
       url="https://github.com/APHA-CSU/btb-phylo",
       install_requires=['pandas', 'boto3'], 
+      extras_require={'parquet': ['pyarrow']},
       packages = find_packages())
 
 # remove build and metadata
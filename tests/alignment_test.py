@@ -0,0 +1,57 @@
+import shutil
+import unittest
+import tempfile
+import subprocess
+from os import path
+
+import numpy.testing as nptesting
+
+from btbphylo import alignment
+
+
+class TestAlignment(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.multi_fasta_path = path.join(self.temp_dir.name, "multi_fasta.fas")
+        # columns 3, 4 and 9 are variable and ACGT-only; column 8
+        # contains N and -; "C" is part lowercase and "A" is wrapped
+        with open(self.multi_fasta_path, "wb") as f:
+            f.write(b">A desc\nACGTA\nCGTAC\n"
+                    b">B\nACGAACGTNC\n"
+                    b">C\naCGTTCGT-C\n"
+                    b">D\r\nACGTACGTAG\r\n")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_fasta_records(self):
+        records = list(alignment.fasta_records(self.multi_fasta_path))
+        self.assertEqual([name for name, _ in records], [b"A", b"B", b"C", b"D"])
+        self.assertEqual(records[0][1].tobytes(), b"ACGTACGTAC")
+        self.assertEqual(records[3][1].tobytes(), b"ACGTACGTAG")
+
+    def test_snp_sites(self):
+        snp_sites_outpath = path.join(self.temp_dir.name, "snps.fas")
+        metadata, positions = alignment.snp_sites(snp_sites_outpath, self.multi_fasta_path)
+        self.assertDictEqual(metadata, {"number_of_snps": 3})
+        nptesting.assert_array_equal(positions, [3, 4, 9])
+        with open(snp_sites_outpath, "rb") as f:
+            self.assertEqual(f.read(), b">A\nTAC\n>B\nAAC\n>C\nTTC\n>D\nTAG\n")
+        # test unaligned sequences
+        with open(self.multi_fasta_path, "ab") as f:
+            f.write(b">E\nACGT\n")
+        with self.assertRaises(ValueError):
+            alignment.snp_sites(snp_sites_outpath, self.multi_fasta_path)
+
+    @unittest.skipUnless(shutil.which("snp-sites"), "snp-sites is not installed")
+    def test_snp_sites_equivalence(self):
+        # lowercase and \r are normalised differently by snp-sites
+        with open(self.multi_fasta_path, "wb") as f:
+            f.write(b">A\nACGTACGTAC\n>B\nACGAACGTNC\n>C\nACGTTCGT-C\n>D\nACGTACGTAG\n")
+        native_outpath = path.join(self.temp_dir.name, "native.fas")
+        snp_sites_outpath = path.join(self.temp_dir.name, "snps.fas")
+        alignment.snp_sites(native_outpath, self.multi_fasta_path)
+        subprocess.run(["snp-sites", "-c", "-o", snp_sites_outpath, self.multi_fasta_path],
+                       check=True)
+        with open(native_outpath, "rb") as native, open(snp_sites_outpath, "rb") as snp_sites:
+            self.assertEqual(native.read(), snp_sites.read())
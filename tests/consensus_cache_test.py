@@ -0,0 +1,132 @@
+import os
+import time
+import unittest
+import tempfile
+from os import path
+
+from btbphylo import consensus_cache
+
+
+class TestConsensusCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.consensus_path = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def add(self, cache, sample, etag, contents):
+        filepath = cache.temp_filepath(sample)
+        with open(filepath, "w") as f:
+            f.write(contents)
+        return cache.put(sample, etag, filepath)
+
+    def test_get_put_read(self):
+        cache = consensus_cache.ConsensusCache(self.consensus_path)
+        self.assertIsNone(cache.get("A", "a"))
+        filepath = self.add(cache, "A", "a", ">A\nACGT\n")
+        # test sharded, content addressed layout
+        self.assertEqual(path.relpath(filepath, self.consensus_path),
+                         path.join("objects", path.basename(filepath)[:2], path.basename(filepath)))
+        self.assertFalse(path.exists(cache.temp_filepath("A")))
+        self.assertEqual(cache.get("A", "a"), filepath)
+        self.assertEqual(cache.read("A"), b">A\nACGT\n")
+        # test a changed ETag is a miss and removes the stale entry
+        self.assertIsNone(cache.get("A", "b"))
+        self.assertNotIn("A", cache)
+        self.assertFalse(path.exists(filepath))
+        self.assertEqual(cache.stats["hits"], 1)
+        self.assertEqual(cache.stats["misses"], 2)
+        self.assertEqual(cache.stats["stale"], 1)
+        # test the index persists
+        self.add(cache, "A", "b", ">A\nACGA\n")
+        cache.save()
+        self.assertEqual(consensus_cache.ConsensusCache(self.consensus_path).read("A"),
+                         b">A\nACGA\n")
+
+    def test_checksum(self):
+        cache = consensus_cache.ConsensusCache(self.consensus_path)
+        filepath = self.add(cache, "A", "a", ">A\nACGT\n")
+        with open(filepath, "a") as f:
+            f.write("N")
+        with self.assertRaises(consensus_cache.CorruptCacheError):
+            cache.read("A")
+        self.assertNotIn("A", cache)
+        self.assertEqual(cache.stats["corrupt"], 1)
+
+    def test_shared_contents(self):
+        cache = consensus_cache.ConsensusCache(self.consensus_path)
+        filepath = self.add(cache, "A", "a", ">X\nACGT\n")
+        self.assertEqual(self.add(cache, "B", "b", ">X\nACGT\n"), filepath)
+        self.assertEqual(cache.metadata()["size_bytes"], 8)
+        # the file is kept until no sample refers to it
+        cache.remove("A")
+        self.assertTrue(path.exists(filepath))
+        cache.remove("B")
+        self.assertFalse(path.exists(filepath))
+        self.assertEqual(cache.metadata()["size_bytes"], 0)
+        # re-adding identical contents for the same sample
+        filepath = self.add(cache, "A", "a", ">X\nACGT\n")
+        filepath = self.add(cache, "A", "a", ">X\nACGT\n")
+        self.assertTrue(path.exists(filepath))
+
+    def test_evict(self):
+        cache = consensus_cache.ConsensusCache(self.consensus_path, max_bytes=22)
+        for sample in ["A", "B", "C", "D"]:
+            self.add(cache, sample, sample, f">{sample}\nACGTACG\n")
+            time.sleep(0.01)
+        # "A" is used most recently
+        cache.get("A", "A")
+        cache.evict(keep=["B"])
+        # 11 bytes each: "C" and "D" are evicted
+        self.assertEqual(sorted(cache.index), ["A", "B"])
+        self.assertEqual(cache.stats["evicted"], 2)
+        self.assertEqual(sum(len(filenames) for _, _, filenames in
+                             os.walk(path.join(self.consensus_path, "objects"))), 2)
+
+    def test_adopt_legacy(self):
+        with open(path.join(self.consensus_path, "A.fas"), "w") as f:
+            f.write(">A\nACGT\n")
+        cache = consensus_cache.ConsensusCache(self.consensus_path)
+        filepath = cache.get("A", "a")
+        self.assertFalse(path.exists(path.join(self.consensus_path, "A.fas")))
+        self.assertEqual(cache.read("A"), b">A\nACGT\n")
+        self.assertEqual(cache.get("A", "a"), filepath)
+        self.assertEqual(cache.stats["adopted"], 1)
+
+    def test_2bit_round_trip(self):
+        test_input = [b">A\nACGTNNNNNACGT--ACGTACGTAC\nGTACGTACGTACGTACGTACGTACGTACGTAC\nACGT\n",
+                      b">A\n" + b"ACGT" * 1000 + b"N" * 100 + b"-" + b"ACGT" * 1000,
+                      b">A\nACGT\nACG\n",
+                      b">A\nACG\nACGT\n",
+                      b">A\nacgt\n",
+                      b">A\nRYKM\n",
+                      b">A\r\nACGT\r\n",
+                      b">A\n>B\nACGT\n",
+                      b">A\n",
+                      b">A",
+                      b""]
+        for contents in test_input:
+            self.assertEqual(consensus_cache.decode_2bit(consensus_cache.encode_2bit(contents)), contents)
+        # test compaction of a long sequence
+        contents = b">A\n" + b"\n".join([b"ACGT" * 20] * 1000) + b"\n"
+        self.assertLess(len(consensus_cache.encode_2bit(contents)), len(contents) / 4)
+        with self.assertRaises(ValueError):
+            consensus_cache.decode_2bit(b"foo" * 10)
+
+    def test_migrate(self):
+        with open(path.join(self.consensus_path, "A.fas"), "w") as f:
+            f.write(">A\nACGT\n")
+        cache = consensus_cache.ConsensusCache(self.consensus_path)
+        self.add(cache, "B", "b", ">B\nACGA\n")
+        cache.save()
+        cache = consensus_cache.ConsensusCache(self.consensus_path, encoding="2bit")
+        self.assertEqual(cache.migrate(), 2)
+        self.assertEqual({entry["encoding"] for entry in cache.index.values()}, {"2bit"})
+        self.assertEqual(cache.index["B"]["ETag"], "b")
+        # test cached files are decoded transparently
+        self.assertEqual(cache.read("A"), b">A\nACGT\n")
+        self.assertEqual(cache.read("B"), b">B\nACGA\n")
+        self.assertEqual(cache.migrate(), 0)
+        with self.assertRaises(ValueError):
+            consensus_cache.ConsensusCache(self.consensus_path, encoding="foo")
@@ -1,6 +1,7 @@
 import unittest
 from unittest import mock
 
+import numpy as np
 import pandas as pd
 import numpy.testing as nptesting
 
@@ -58,6 +59,66 @@ class TestDeDuplicate(unittest.TestCase):
             de_duplicate.remove_duplicates(pd.DataFrame({"Submission": pd.Series(["1"], dtype="object"),
                                            "foo": pd.Series([1], dtype=float)}))
 
+    def test_remove_duplicates_rules(self):
+        # test normal operation
+        # test input
+        test_df = pd.DataFrame({"Submission": pd.Series(["A", "A", "B", "B", "C", "D", "D", "D"], dtype="object"),
+                                "foo": pd.Series([1, 2, 3, 3, 5, 6, 6, 5], dtype=float),
+                                "bar": pd.Series([1, 2, 4, 3, 5, 7, 6, 1], dtype=float)})
+        # test output
+        desired_df_output = pd.DataFrame({"Submission": ["A", "B", "C", "D"], "foo": [2, 3, 5, 6],
+                                          "bar": [2, 3, 5, 6]})
+        desired_metadata_output = {"number_of_duplicate_WGS_submissions": 4}
+        # assert output
+        metadata, df_output = de_duplicate.remove_duplicates(test_df, foo="max", bar="min")
+        nptesting.assert_array_equal(df_output.values, desired_df_output.values)
+        nptesting.assert_array_equal(df_output.index, [1, 3, 4, 6])
+        self.assertDictEqual(metadata, desired_metadata_output)
+
+        # test defaulting to first sample
+        test_df = pd.DataFrame({"Submission": pd.Series(["A", "A"], dtype="object"),
+                                "foo": pd.Series([1, 1], dtype=float)})
+        # test output
+        desired_df_output = pd.DataFrame({"Submission": ["A"], "foo": [1]})
+        desired_metadata_output = {"number_of_duplicate_WGS_submissions": 1}
+        metadata, df_output = de_duplicate.remove_duplicates(test_df, foo="max")
+        nptesting.assert_array_equal(df_output.values, desired_df_output.values)
+        self.assertDictEqual(metadata, desired_metadata_output)
+
+        # test categorical columns and missing values
+        test_df = pd.DataFrame({"Submission": pd.Series(["A", "A", None, "B", None, "B"], dtype="object"),
+                                "Outcome": pd.Series(["Fail", "Pass", "Pass", "Fail", "Pass", "Fail"],
+                                                     dtype="object"),
+                                "pcMapped": pd.Series([0.9, None, 0.5, None, 0.9, 0.1], dtype=float)})
+        metadata, df_output = de_duplicate.remove_duplicates(test_df, Outcome="Pass", pcMapped="max")
+        nptesting.assert_array_equal(df_output.index, [1, 2, 5])
+
+    def test_priority_chain(self):
+        # remove_duplicates keeps the same samples as applying the rules
+        # of each kwarg in turn with get_indexes_to_remove
+        rng = np.random.default_rng(0)
+        kwargs = {"Outcome": "Pass", "flag": "BritishbTB", "pcMapped": "max", "Ncount": "min"}
+        for _ in range(50):
+            n_rows = rng.integers(1, 50)
+            test_df = pd.DataFrame({"Submission": pd.Series(rng.integers(0, 10, n_rows)).astype(str),
+                                    "Outcome": rng.choice(["Pass", "Fail"], n_rows),
+                                    "flag": pd.Series(rng.choice(["BritishbTB", "nonbTB"], n_rows),
+                                                      dtype="category"),
+                                    "pcMapped": np.where(rng.random(n_rows) < 0.2, np.nan,
+                                                         rng.integers(0, 4, n_rows) / 4),
+                                    "Ncount": rng.integers(0, 3, n_rows)},
+                                   index=rng.permutation(n_rows) + 10)
+            test_kwargs = {column_name: value for column_name, value in kwargs.items()
+                           if column_name in ("pcMapped", "Ncount") or value in list(test_df[column_name])}
+            remaining_indexes = test_df.index
+            for column_name, value in test_kwargs.items():
+                remaining_indexes = remaining_indexes.difference(
+                    de_duplicate.get_indexes_to_remove(test_df.loc[remaining_indexes], column_name, value))
+            desired_df_output = test_df.drop(test_df.index.difference(remaining_indexes)).\
+                drop_duplicates(["Submission"])
+            _, df_output = de_duplicate.remove_duplicates(test_df, **test_kwargs)
+            pd.testing.assert_frame_equal(df_output, desired_df_output)
+
     def test_get_indexes_to_remove(self):
         # test max
         test_df = pd.DataFrame({"Submission": pd.Series(["1", "1", "2", "2", "3"], dtype="object"),
@@ -83,9 +144,17 @@ class TestDeDuplicate(unittest.TestCase):
         test_df = pd.DataFrame({"Submission": pd.Series(["1"], dtype="object"),
                                 "Outcome": pd.Series(["Fail"], dtype="object")})
         pd.testing.assert_index_equal(de_duplicate.get_indexes_to_remove(test_df, "Outcome", "Pass"),
-                                      pd.Index([]), check_order=False)
+                                      pd.Index([], dtype="int64"), check_order=False)
         # test when no duplicate entry meets criteria
         test_df = pd.DataFrame({"Submission": pd.Series(["1", "1"], dtype="object"),
                                 "Outcome": pd.Series(["Fail", "Fail"], dtype="object")})
         pd.testing.assert_index_equal(de_duplicate.get_indexes_to_remove(test_df, "Outcome", "Pass"),
-                                      pd.Index([]), check_order=False)
+                                      pd.Index([], dtype="int64"), check_order=False)
+        # test the dtype of the index of df is kept
+        test_df = pd.DataFrame({"Submission": ["1", "1", "2"], "pcMapped": [0.1, 0.2, 0.3]},
+                               index=pd.Index(["a", "b", "c"]))
+        pd.testing.assert_index_equal(de_duplicate.get_indexes_to_remove(test_df, "pcMapped", "max"),
+                                      pd.Index(["a"]))
+        test_df = test_df.set_index(pd.Index([0.5, 1.5, 2.5]))
+        pd.testing.assert_index_equal(de_duplicate.get_indexes_to_remove(test_df.iloc[2:], "pcMapped", "max"),
+                                      pd.Index([], dtype="float64"))
@@ -0,0 +1,171 @@
+import shutil
+import unittest
+import tempfile
+import subprocess
+from os import path
+from unittest import mock
+
+import numpy as np
+import numpy.testing as nptesting
+
+from btbphylo import distances
+
+
+class TestDistances(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.snp_sites_path = path.join(self.temp_dir.name, "snps.fas")
+        self.snp_dists_path = path.join(self.temp_dir.name, "snps.csv")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_popcount(self):
+        words = np.array([0, 1, 0xff, 2**63, 2**64 - 1, 0x5555555555555555], dtype=np.uint64)
+        nptesting.assert_array_equal(distances.popcount(words.copy()),
+                                     [bin(int(word)).count("1") for word in words])
+
+    def test_build_snp_matrix(self):
+        # sites that are not ACGT in either sequence are not counted
+        with open(self.snp_sites_path, "wb") as f:
+            f.write(b">A\nACGTA\n>B\nAGGTN\n>C\nTG-AA\n>D\nacgta\n")
+        distances.build_snp_matrix(self.snp_dists_path, self.snp_sites_path)
+        with open(self.snp_dists_path) as f:
+            self.assertEqual(f.read(), "snp-dists 0.8.2,A,B,C,D\n"
+                                       "A,0,1,3,0\n"
+                                       "B,1,0,2,1\n"
+                                       "C,3,2,0,3\n"
+                                       "D,0,1,3,0\n")
+
+    def test_pairwise_distances(self):
+        rng = np.random.default_rng(0)
+        codes = rng.integers(0, 5, (50, 300)).astype(np.uint8)
+        with open(self.snp_sites_path, "wb") as f:
+            for i, sequence in enumerate(np.frombuffer(b"ACGTN", dtype=np.uint8)[codes]):
+                f.write(f">{i}\n".encode() + sequence.tobytes() + b"\n")
+        acgt = codes < 4
+        expected = ((codes[:, None] != codes[None, :]) & acgt[:, None] & acgt[None, :]).sum(axis=2)
+        names, bitsets = distances.encode_alignment(self.snp_sites_path)
+        self.assertEqual(names, [str(i) for i in range(50)])
+        # test blocks that do and do not divide the number of sequences
+        for threads, block_size in [(1, None), (3, 7), (2, 50), (4, 64)]:
+            nptesting.assert_array_equal(distances.pairwise_distances(bitsets, threads, block_size),
+                                         expected)
+
+    def test_clade_distances(self):
+        rng = np.random.default_rng(0)
+        bitsets = distances.encode_codes(rng.integers(0, 5, (40, 200)).astype(np.uint8))
+        matrix = distances.pairwise_distances(bitsets)
+        clades = {"B1-11": list(range(0, 40, 3)), "B6-11": [1, 2, 4, 5, 7, 8, 10, 11, 13],
+                  "B3-11": [i for i in range(14, 40) if i % 3], "B4-11": []}
+        for threads, block_size in [(1, None), (3, 4)]:
+            matrices = distances.clade_distances(bitsets, clades, threads, block_size)
+            for clade, indices in clades.items():
+                nptesting.assert_array_equal(matrices[clade], matrix[np.ix_(indices, indices)])
+        minimums = distances.cross_clade_minimums(bitsets, dict(list(clades.items())[:3]), 2, 4)
+        self.assertEqual(minimums[0, 0], 0)
+        self.assertEqual(minimums[0, 1], matrix[np.ix_(clades["B1-11"], clades["B6-11"])].min())
+        self.assertEqual(minimums[2, 1], matrix[np.ix_(clades["B3-11"], clades["B6-11"])].min())
+        # test well-separated clades
+        codes = np.tile(rng.integers(0, 4, 500), (60, 1))
+        for k in range(3):
+            codes[20 * k:20 * (k + 1), 100 * k:100 * k + 50] = \
+                (codes[20 * k:20 * (k + 1), 100 * k:100 * k + 50] + 1) % 4
+        mutations = rng.random(codes.shape) < 0.02
+        codes[mutations] = rng.integers(0, 5, mutations.sum())
+        bitsets = distances.encode_codes(codes.astype(np.uint8))
+        matrix = distances.pairwise_distances(bitsets)
+        clades = {"B1-11": list(range(0, 20)), "B6-11": list(range(20, 40)),
+                  "B3-11": list(range(40, 60))}
+        for threads, block_size in [(1, None), (2, 3)]:
+            minimums = distances.cross_clade_minimums(bitsets, clades, threads, block_size)
+            for a, b in [(0, 1), (0, 2), (1, 2)]:
+                expected = matrix[np.ix_(clades[list(clades)[a]], clades[list(clades)[b]])].min()
+                self.assertEqual(minimums[a, b], expected)
+                self.assertEqual(minimums[b, a], expected)
+        # test searching a sample of each clade, for an upper bound
+        sampled = distances.cross_clade_minimums(bitsets, clades, 2, 3, max_sequences=5)
+        self.assertTrue((sampled >= minimums).all())
+        nptesting.assert_array_equal(
+            distances.cross_clade_minimums(bitsets, clades, max_sequences=20), minimums)
+
+    def test_close_pairs(self):
+        rng = np.random.default_rng(0)
+        # two clusters of near identical sequences with masked runs
+        codes = np.tile(rng.integers(0, 4, 1500), (40, 1))
+        codes[20:, :100] = (codes[20:, :100] + 1) % 4
+        for sequence in codes:
+            sequence[rng.choice(1500, 10, replace=False)] = rng.integers(0, 5, 10)
+        bitsets = distances.encode_codes(codes.astype(np.uint8))
+        matrix = distances.pairwise_distances(bitsets)
+        for max_distance, threads, block_size in [(0, 1, None), (15, 2, 7), (120, 1, 16), (2000, 3, 40)]:
+            (a, b, pair_distances), metadata = distances.close_pairs(bitsets, max_distance, threads,
+                                                                     block_size)
+            expected_a, expected_b = np.nonzero(np.triu(matrix <= max_distance, 1))
+            nptesting.assert_array_equal(a, expected_a)
+            nptesting.assert_array_equal(b, expected_b)
+            nptesting.assert_array_equal(pair_distances, matrix[expected_a, expected_b])
+            self.assertEqual(metadata["number_of_close_pairs"], len(expected_a))
+        # test pairs between clusters are pruned by the lower bounds
+        self.assertGreater(distances.close_pairs(bitsets, 15)[1]["number_of_pairs_pruned"], 0)
+        names = [str(i) for i in range(40)]
+        distances.build_edge_list(self.snp_dists_path, names, bitsets, 15)
+        with open(self.snp_dists_path, "r") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], "sample_a,sample_b,distance")
+        self.assertEqual(lines[1], f"0,1,{matrix[0, 1]}")
+
+    def test_tiled_distances(self):
+        rng = np.random.default_rng(0)
+        bitsets = distances.encode_codes(rng.integers(0, 5, (30, 100)).astype(np.uint8))
+        expected = distances.pairwise_distances(bitsets)
+        checkpoint_path = path.join(self.temp_dir.name, "tiles")
+        # test checkpointed tiles are kept until removed
+        nptesting.assert_array_equal(distances.tiled_distances(bitsets, checkpoint_path, 2, 8),
+                                     expected)
+        self.assertTrue(path.exists(path.join(checkpoint_path, "tile_8_16.npy")))
+        # test a resumed run reuses checkpointed tiles
+        np.save(path.join(checkpoint_path, "tile_8_16.npy"), np.full((8, 8), 999, dtype=np.uint32))
+        matrix = distances.tiled_distances(bitsets, checkpoint_path, 2, 8)
+        self.assertTrue((matrix[8:16, 16:24] == 999).all())
+        self.assertTrue((matrix[16:24, 8:16] == 999).all())
+        # test tiles checkpointed for other bitsets are discarded
+        bitsets = tuple(bitset[::-1].copy() for bitset in bitsets)
+        nptesting.assert_array_equal(distances.tiled_distances(bitsets, checkpoint_path, 1, 8),
+                                     expected[::-1, ::-1])
+        distances.remove_checkpoint(checkpoint_path)
+        self.assertFalse(path.exists(checkpoint_path))
+        distances.remove_checkpoint(checkpoint_path)
+
+    def test_distance_matrix(self):
+        rng = np.random.default_rng(0)
+        with open(self.snp_sites_path, "wb") as f:
+            for i, sequence in enumerate(rng.integers(0, 4, (20, 50))):
+                f.write(f">{i}\n".encode() + np.frombuffer(b"ACGT", dtype=np.uint8)[sequence].tobytes() +
+                        b"\n")
+        expected = distances.pairwise_distances(distances.encode_alignment(self.snp_sites_path)[1])
+        # test small matrices are only checkpointed when asked
+        self.assertFalse(distances.use_checkpoint(20))
+        self.assertTrue(distances.use_checkpoint(20, checkpoint=True))
+        self.assertTrue(distances.use_checkpoint(distances.CHECKPOINT_MIN_SEQUENCES))
+        # test checkpointed tiles are removed once the matrix is written
+        checkpoint_path = path.join(self.temp_dir.name, "tiles")
+        with mock.patch("btbphylo.distances.tiled_distances", wraps=distances.tiled_distances) as \
+                mock_tiled_distances:
+            distances.build_snp_matrix(self.snp_dists_path, self.snp_sites_path, 2, checkpoint_path)
+            mock_tiled_distances.assert_called_once()
+            distances.build_snp_matrix(self.snp_dists_path, self.snp_sites_path, 2)
+            mock_tiled_distances.assert_called_once()
+        self.assertFalse(path.exists(checkpoint_path))
+        with open(self.snp_dists_path) as f:
+            self.assertEqual(f.readlines()[1].strip(), ",".join(["0"] + expected[0].astype(str).tolist()))
+
+    @unittest.skipUnless(shutil.which("snp-dists"), "snp-dists is not installed")
+    def test_snp_dists_equivalence(self):
+        with open(self.snp_sites_path, "wb") as f:
+            f.write(b">A\nACGTA\n>B\nAGGTC\n>C\nTGCAA\n>D\nACGTA\n")
+        distances.build_snp_matrix(self.snp_dists_path, self.snp_sites_path)
+        ps = subprocess.run(["snp-dists", "-c", self.snp_sites_path], check=True,
+                            capture_output=True)
+        with open(self.snp_dists_path, "rb") as f:
+            self.assertEqual(f.read().split(b"\n", 1)[1], ps.stdout.split(b"\n", 1)[1])
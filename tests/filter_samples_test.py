@@ -179,3 +179,16 @@ class TestFilterSamples(unittest.TestCase):
         # invalid kwarg type: must be list of strings
         with self.assertRaises(ValueError):
             filter_samples.filter_columns_categorical(test_df, column_A=[1, 2, 3])
+
+    def test_parquet_filters(self):
+        # test default "Pass" only filter
+        self.assertEqual(filter_samples.parquet_filters(), [("Outcome", "in", ["Pass"])])
+        # test categorical and numerical filters
+        self.assertEqual(filter_samples.parquet_filters(Outcome=["Pass", "Fail"], group=["B6-84"],
+                                                        Ncount=(0, 100.5)),
+                         [("Outcome", "in", ["Pass", "Fail"]), ("group", "in", ["B6-84"]),
+                          ("Ncount", ">=", 0), ("Ncount", "<=", 100.5)])
+        # test 'not_' prefixed, malformed and unknown kwargs are left to filter_df
+        self.assertEqual(filter_samples.parquet_filters(not_Submission=["A"], pcMapped=(1, 2, 3),
+                                                        group="B6-84", foo=["bar"]),
+                         [("Outcome", "in", ["Pass"])])
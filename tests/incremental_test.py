@@ -0,0 +1,90 @@
+import unittest
+import tempfile
+from os import path
+
+import numpy as np
+import numpy.testing as nptesting
+
+from btbphylo import incremental
+from btbphylo import consensus_cache
+
+
+class TestIncremental(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.multi_fasta_path = path.join(self.temp_dir.name, "multi_fasta.fas")
+        self.cache = consensus_cache.ConsensusCache(path.join(self.temp_dir.name, "consensus"))
+        # 30 random sequences, each with 8 snps and 3 Ns relative to
+        # a reference
+        rng = np.random.default_rng(0)
+        reference = rng.integers(0, 4, 200)
+        self.sequences = {}
+        for i in range(30):
+            sequence = reference.copy()
+            sequence[rng.choice(200, 8, replace=False)] = rng.integers(0, 4, 8)
+            sequence[rng.choice(200, 3, replace=False)] = 4
+            self.sequences[f"S{i}"] = b">S%d\n" % i + \
+                np.frombuffer(b"ACGTN", dtype=np.uint8)[sequence].tobytes() + b"\n"
+            with open(self.cache.temp_filepath(f"S{i}"), "wb") as f:
+                f.write(self.sequences[f"S{i}"])
+            self.cache.put(f"S{i}", f"etag_{i}", self.cache.temp_filepath(f"S{i}"))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def build(self, samples, etags=None):
+        with open(self.multi_fasta_path, "wb") as f:
+            for sample in samples:
+                f.write(self.sequences[sample])
+        etags = etags or [f"etag_{sample[1:]}" for sample in samples]
+        return samples, etags, incremental.build_state(self.multi_fasta_path, samples, etags)
+
+    def assertStateEqual(self, state, expected):
+        self.assertEqual(state["names"], expected["names"])
+        for name in incremental.STATE_ARRAYS:
+            nptesting.assert_array_equal(state[name], expected[name])
+
+    def test_build_state(self):
+        _, _, state = self.build(["S0", "S1"])
+        # the distance is the number of sites at which both are ACGT
+        # and differ
+        sequences = [np.frombuffer(self.sequences[sample].split(b"\n")[1], dtype=np.uint8)
+                     for sample in ["S0", "S1"]]
+        acgt = np.isin(sequences[0], list(b"ACGT")) & np.isin(sequences[1], list(b"ACGT"))
+        self.assertEqual(state["distances"][0, 1], (acgt & (sequences[0] != sequences[1])).sum())
+        nptesting.assert_array_equal(state["positions"],
+                                     np.flatnonzero(acgt & (sequences[0] != sequences[1])))
+        self.assertEqual(state["names"], ["S0", "S1"])
+
+    def test_update_state(self):
+        _, _, state = self.build([f"S{i}" for i in range(20)])
+        # remove 5 samples, add 8 and reorder
+        samples = [f"S{i}" for i in range(27, 4, -1)]
+        state, metadata = incremental.update_state(state, self.multi_fasta_path,
+                                                   *self.build(samples)[:2], self.cache)
+        _, _, expected = self.build(samples)
+        self.assertStateEqual(state, expected)
+        self.assertEqual(metadata["samples_kept"], 15)
+        self.assertEqual(metadata["samples_added"], 8)
+        self.assertEqual(metadata["samples_removed"], 5)
+        self.assertEqual(metadata["distances_reused"], 105)
+        self.assertEqual(metadata["distances_computed"] + 105, 23 * 22 // 2)
+        # test state round trip
+        incremental.save_state(path.join(self.temp_dir.name, "state"), state)
+        self.assertStateEqual(incremental.load_state(path.join(self.temp_dir.name, "state")),
+                              expected)
+
+    def test_update_state_incompatible(self):
+        _, _, state = self.build(["S0", "S1", "S2"])
+        # the consensus of "S0" has changed since the previous state
+        samples, etags, _ = self.build(["S1", "S2"])
+        self.cache.index["S0"]["ETag"] = "foo"
+        with self.assertRaises(incremental.IncompatibleStateError):
+            incremental.update_state(state, self.multi_fasta_path, samples, etags, self.cache)
+        # a changed sample is replaced
+        self.cache.index["S0"]["ETag"] = "etag_0"
+        samples, etags, expected = self.build(["S0", "S1", "S2"], ["etag_0", "foo", "etag_2"])
+        state, metadata = incremental.update_state(state, self.multi_fasta_path, samples, etags,
+                                                   self.cache)
+        self.assertStateEqual(state, expected)
+        self.assertEqual(metadata["samples_added"], 1)
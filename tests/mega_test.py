@@ -0,0 +1,112 @@
+import unittest
+import tempfile
+from os import path
+from unittest import mock
+
+from btbphylo import mega
+from btbphylo import neighbour_joining
+
+
+class TestMega(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.snp_sites_path = path.join(self.temp_dir.name, "snps.fas")
+        with open(self.snp_sites_path, "w") as f:
+            for i in range(6):
+                f.write(f">sample_{i}\nACGT\n")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_write_mao(self):
+        mao_path = path.join(self.temp_dir.name, "infer_MP.mao")
+        mega.write_mao(mao_path, 2, initial_trees=10, search_level=3)
+        with open(mega.MAO_TEMPLATE_PATH) as f:
+            expected = f.readlines()
+        with open(mao_path) as f:
+            actual = f.readlines()
+        self.assertEqual(len(actual), len(expected))
+        changed = {line.partition("=")[0].strip(): line.partition("=")[2].strip()
+                   for line, template_line in zip(actual, expected) if line != template_line}
+        self.assertEqual(changed, {"Test of Phylogeny": "None",
+                                   "No. of Bootstrap Replications": "Not Applicable",
+                                   "Number of Threads": "2",
+                                   "No. of Initial Trees (random addition)": "10",
+                                   "MP Search level": "3"})
+        mega.write_mao(mao_path, 2, 50)
+        with open(mao_path) as f:
+            settings = {line.partition("=")[0].strip(): line.partition("=")[2].strip()
+                        for line in f}
+        self.assertEqual(settings["Test of Phylogeny"], "Bootstrap method")
+        self.assertEqual(settings["No. of Bootstrap Replications"], "50")
+
+    def test_concurrent_jobs(self):
+        self.assertEqual(mega.concurrent_jobs(4, 16), 4)
+        self.assertEqual(mega.concurrent_jobs(4, 2), 1)
+        self.assertEqual(mega.concurrent_jobs(1, 8), 8)
+        self.assertEqual(mega.job_sizes(200, 4, 16), [50, 50, 50, 50])
+        self.assertEqual(mega.job_sizes(10, 1, 3), [4, 3, 3])
+        self.assertEqual(mega.job_sizes(2, 1, 8), [1, 1])
+        self.assertEqual(mega.job_sizes(0, 1, 8), [0])
+
+    def test_bootstrap_supports(self):
+        main_tree = "(a:1,b:1,((c:1,d:1):1,(e:1,f:1):1):1);"
+        job_trees = [
+            # (c, d), (e, f) and (c, d, e, f)
+            "(((d,c)100,(f,e)40)80,b,a);",
+            # (c, d) and (c, d, e, f), but not (e, f)
+            "(a,b,((c,d)90,e,f)70);"]
+        children, names, supports = mega.bootstrap_supports(main_tree, job_trees, [1, 3])
+        self.assertEqual(names, list("abcdef"))
+        # supports weighted by the replicates of each job; (e, f) is only
+        # in the tree of the first job
+        split_supports = dict(zip(neighbour_joining.splits(children, 6), supports))
+        self.assertEqual(split_supports[0b001100], 92)
+        self.assertEqual(split_supports[0b110000], 10)
+        self.assertEqual(split_supports[0b111100], 72)
+        self.assertIsNone(supports[-1])
+        # a split in 45% of the replicates of one job and 65% of another is
+        # in 55% of the pooled replicates
+        children, _, supports = mega.bootstrap_supports(
+            "((a,b),c,(d,e,f));", ["((a,b)45,c,(d,e,f)45);", "((a,b)65,c,(d,e,f)65);"], [20, 20])
+        self.assertEqual(dict(zip(neighbour_joining.splits(children, 6), supports))[0b000011 ^ 0b111111], 55)
+        self.assertIsNone(mega.bootstrap_supports(main_tree, [main_tree], [0])[2])
+        # test different taxa
+        with self.assertRaises(ValueError):
+            mega.bootstrap_supports(main_tree, ["(a,b,(c,d,g));"], [1])
+
+    def test_build_tree(self):
+        def megacc(cmd):
+            # write a tree, labelled with bootstrap supports, to the output directory
+            with open(path.join(cmd[-1], "infer_MP.nwk"), "w") as f:
+                f.write("((sample_0:1,sample_1:1)100:1,sample_2:1,(sample_3:1,sample_4:1,sample_5:1)80:1);\n")
+
+        with mock.patch("btbphylo.mega.utils.run", side_effect=megacc) as mock_run:
+            metadata = mega.build_tree(self.temp_dir.name, self.snp_sites_path, 2, 10, cpus=4)
+            self.assertEqual(metadata, {"megacc_jobs": 2, "bootstraps_per_job": [5, 5]})
+            # one megacc job per block of replicates, not per replicate
+            self.assertEqual(mock_run.call_count, 2)
+            for i in range(2):
+                with open(path.join(self.temp_dir.name, f"job_{i}", "infer_MP.mao")) as f:
+                    self.assertIn("No. of Bootstrap Replications               = 5 ",
+                                  f.read())
+            with open(path.join(self.temp_dir.name, mega.MP_TREE_FILENAME)) as f:
+                self.assertEqual(neighbour_joining.parse_newick(f.read())[2], ["100", "80", None])
+            # test a single job runs all the replicates
+            mock_run.reset_mock()
+            metadata = mega.build_tree(self.temp_dir.name, self.snp_sites_path, 4, 200, cpus=4)
+            self.assertEqual(metadata, {"megacc_jobs": 1, "bootstraps_per_job": [200]})
+            mock_run.assert_called_once()
+            # test per clade trees
+            mock_run.reset_mock()
+            metadata = mega.build_clade_trees(self.temp_dir.name, self.snp_sites_path,
+                                              {"B1-11": [f"sample_{i}" for i in range(4)],
+                                               "B6-11": ["sample_4", "sample_5"]}, 2, 0, cpus=4)
+            self.assertEqual(metadata, {"megacc_clades": ["B1-11"], "megacc_skipped_clades": ["B6-11"]})
+            mock_run.assert_called_once()
+            with open(path.join(self.temp_dir.name, "B1-11.fas")) as f:
+                self.assertEqual(f.read().count(">"), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
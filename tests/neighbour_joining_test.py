@@ -0,0 +1,94 @@
+import unittest
+import tempfile
+from os import path
+
+import numpy as np
+import numpy.testing as nptesting
+
+from btbphylo import alignment
+from btbphylo import neighbour_joining
+
+
+def patristic_distances(children, n_leaves):
+    """
+        Returns the path lengths between the leaves of a tree
+    """
+    edges = {}
+    for k, node_children in enumerate(children):
+        for child, length in node_children:
+            edges.setdefault(n_leaves + k, []).append((child, length))
+            edges.setdefault(child, []).append((n_leaves + k, length))
+    matrix = np.zeros((n_leaves, n_leaves))
+    for leaf in range(n_leaves):
+        lengths, stack = {leaf: 0.0}, [leaf]
+        while stack:
+            node = stack.pop()
+            for neighbour, length in edges.get(node, []):
+                if neighbour not in lengths:
+                    lengths[neighbour] = lengths[node] + length
+                    stack.append(neighbour)
+        matrix[leaf] = [lengths[other] for other in range(n_leaves)]
+    return matrix
+
+
+class TestNeighbourJoining(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_neighbour_joining(self):
+        # neighbour-joining recovers the tree of an additive matrix
+        rng = np.random.default_rng(0)
+        for _ in range(20):
+            n_leaves = rng.integers(3, 30)
+            nodes, children = list(range(n_leaves)), []
+            while len(nodes) > 3:
+                a, b = sorted(rng.choice(len(nodes), 2, replace=False))
+                children.append([(nodes[a], rng.uniform(0.5, 5)), (nodes[b], rng.uniform(0.5, 5))])
+                nodes = nodes[:a] + nodes[a + 1:b] + nodes[b + 1:] + [n_leaves + len(children) - 1]
+            children.append([(node, rng.uniform(0.5, 5)) for node in nodes])
+            matrix = patristic_distances(children, n_leaves)
+            nptesting.assert_allclose(
+                patristic_distances(neighbour_joining.neighbour_joining(matrix), n_leaves), matrix)
+        # test the example of Saitou and Nei (1987) as given on wikipedia
+        children = neighbour_joining.neighbour_joining(np.array([[0, 5, 9, 9, 8],
+                                                                 [5, 0, 10, 10, 9],
+                                                                 [9, 10, 0, 8, 7],
+                                                                 [9, 10, 8, 0, 3],
+                                                                 [8, 9, 7, 3, 0]]))
+        self.assertEqual(children[0], [(0, 2), (1, 3)])
+        self.assertEqual(neighbour_joining.to_newick(children, list("abcde")),
+                         "((a:2,b:3):3,c:4,(d:2,e:1):2);")
+        self.assertEqual(neighbour_joining.splits(children, 5), [0b11100, 0b11000, None])
+
+    def test_to_newick(self):
+        children = [[(0, 1.5), (1, 0.25)], [(3, 1), (2, 2)]]
+        self.assertEqual(neighbour_joining.to_newick(children, ["a", "b c", "d"], [80, None]),
+                         "((a:1.5,'b c':0.25)80:1,d:2);")
+
+    def test_build_tree(self):
+        # two clusters of identical sequences
+        snp_sites_path = path.join(self.temp_dir.name, "snps.fas")
+        with open(snp_sites_path, "w") as f:
+            for i, sequence in enumerate(["AAAAAAAAAA", "AAAAAAAAAC", "AAAAAAAAAG",
+                                          "CCCCCCCCCA", "CCCCCCCCCC", "CCCCCCCCCG"]):
+                f.write(f">{i}\n{sequence}\n")
+        neighbour_joining.build_tree(self.temp_dir.name, snp_sites_path, 10, 2)
+        with open(path.join(self.temp_dir.name, "nj_tree.nwk")) as f:
+            newick = f.read()
+        self.assertTrue(newick.endswith(";\n"))
+        codes = np.array([alignment.NUCLEOTIDE_CODES[sequence]
+                          for _, sequence in alignment.fasta_records(snp_sites_path)])
+        children = neighbour_joining.neighbour_joining((codes[:, None] != codes[None, :]).sum(axis=2))
+        splits = neighbour_joining.splits(children, 6)
+        supports = neighbour_joining.bootstrap_supports(codes, children, 10, 2)
+        # the split between clusters has full support
+        self.assertEqual(supports[splits.index(0b111000)], 100)
+        self.assertIsNone(supports[-1])
+        self.assertIn("100:", newick)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,7 @@
+import os
 import unittest
+import tempfile
+from os import path
 from unittest import mock
 
 import pandas as pd
@@ -8,36 +11,208 @@ from btbphylo import phylogeny
 
 
 class TestPhylogeny(unittest.TestCase):
-    @mock.patch("btbphylo.phylogeny.utils.s3_download_file_cli")
+    @mock.patch("btbphylo.phylogeny.storage.get_storage")
+    @mock.patch("btbphylo.phylogeny.cache_consensus_file")
     @mock.patch("btbphylo.phylogeny.extract_s3_bucket")
     @mock.patch("btbphylo.phylogeny.extract_s3_key")
-    def test_build_multi_fasta(self, _, mock_extract_s3_bucket, mock_extract_s3_key):
+    def test_build_multi_fasta(self, mock_extract_s3_key, mock_extract_s3_bucket,
+                               mock_cache_consensus_file, _):
         mock_extract_s3_bucket.return_value = "foo_bucket"
         mock_extract_s3_key.return_value = "foo_key"
         # test dataframe for input - 4 rows imitating 4 samples
         test_df = pd.DataFrame({"Sample": ["A", "B", "C", "D"],
                                 "ResultLoc": ["1", "2", "3", "4"]})
+        # mock a consensus cache containing samples "A" and "C" where
+        # the cached consensus of sample "C" fails its checksum
+        cached = {"A", "C"}
+        mock_cache_consensus_file.side_effect = lambda *args: cached.add(args[3])
+        mock_cache = mock.MagicMock()
+        mock_cache.__contains__.side_effect = lambda sample: sample in cached
+        mock_cache.read.side_effect = ["AAA\nAAA", "TTT\nTTT",
+                                       phylogeny.consensus_cache.CorruptCacheError("C"),
+                                       "CCC\nCCC", "GGG\nGGG"]
         mock_open = mock.mock_open()
-        # mock open.read() to return 4 mock consensus sequences
-        mock_open().read.side_effect = ["AAA\nAAA", "TTT\nTTT", "CCC\nCCC", "GGG\nGGG"]
         # run build_multi_fasta() with test_df and a patched open
         with mock.patch("builtins.open", mock_open):
-            phylogeny.build_multi_fasta("foo", test_df, 'bar')
-        # calls to open to test against: 1 call for the output
-        # multifasta ("foo") and 4 calls for each consensus sequence
-        open_calls = [mock.call("foo", "wb"),
-                      mock.call(mock.ANY, "rb"),
-                      mock.call(mock.ANY, "rb"),
-                      mock.call(mock.ANY, "rb"),
-                      mock.call(mock.ANY, "rb")]
-        # assert that open was called with open_calls
-        mock_open.assert_has_calls(open_calls, any_order=True)
+            invalid = phylogeny.build_multi_fasta("foo", test_df, mock_cache)
+        # assert that the multi fasta ("foo") was opened for writing
+        mock_open.assert_called_once_with("foo", "wb")
+        # assert that missing and corrupt samples were downloaded
+        self.assertEqual([call.args[3] for call in mock_cache_consensus_file.call_args_list],
+                         ["B", "C", "D"])
         # assert that open.write() was called with mock consensus sequences
         write_calls = [mock.call("AAA\nAAA"),
                        mock.call("TTT\nTTT"),
                        mock.call("CCC\nCCC"),
                        mock.call("GGG\nGGG")]
         mock_open().write.assert_has_calls(write_calls)
+        # assert that lengths are not checked by default
+        self.assertDictEqual(invalid, {})
+        mock_cache.record.assert_not_called()
+
+    @mock.patch("btbphylo.phylogeny.storage.get_storage")
+    @mock.patch("btbphylo.phylogeny.append_multi_fasta")
+    @mock.patch("btbphylo.phylogeny.extract_s3_bucket")
+    @mock.patch("btbphylo.phylogeny.extract_s3_key")
+    def test_build_multi_fasta_lengths(self, _, __, mock_append_multi_fasta, ___):
+        mock_cache = mock.MagicMock()
+        mock_cache.__contains__.return_value = True
+
+        def build(lengths, reference_length):
+            mock_append_multi_fasta.reset_mock()
+            mock_cache.record.side_effect = lambda sample: {"sequence_length": lengths[sample]}
+            test_df = pd.DataFrame({"Sample": list(lengths), "ResultLoc": list(lengths)})
+            with mock.patch("builtins.open", mock.mock_open()):
+                invalid = phylogeny.build_multi_fasta("foo", test_df, mock_cache,
+                                                      reference_length=reference_length)
+            return invalid, [call.args[3] for call in mock_append_multi_fasta.call_args_list]
+
+        # test equally common lengths, in either order
+        for lengths in ({"A": 9, "B": 9, "C": 11, "D": 11}, {"C": 11, "D": 11, "A": 9, "B": 9}):
+            invalid, added = build(lengths, 11)
+            self.assertEqual(sorted(invalid), ["A", "B"])
+            self.assertEqual(invalid["A"], "sequence length 9 differs from reference length 11")
+            self.assertEqual(sorted(added), ["C", "D"])
+        # test a few samples, most of the wrong length
+        invalid, added = build({"A": 9, "B": 11, "C": 9}, 11)
+        self.assertEqual(sorted(invalid), ["A", "C"])
+        self.assertEqual(added, ["B"])
+        invalid, added = build({"A": 9}, 11)
+        self.assertEqual(sorted(invalid), ["A"])
+        self.assertEqual(added, [])
+
+    @mock.patch("btbphylo.phylogeny.utils.s3_client")
+    @mock.patch("btbphylo.phylogeny.utils.list_s3_object_metadata")
+    def test_preflight_consensus(self, mock_list_s3_object_metadata, _):
+        # batch "1" is missing the consensus of sample "B"
+        mock_list_s3_object_metadata.side_effect = lambda bucket, prefix, *_: \
+            [{"Key": f"{prefix}{sample}_consensus.fas", "Size": 1, "ETag": sample,
+              "LastModified": None} for sample in ("A", "D")]
+        test_df = pd.DataFrame({"Sample": ["A", "B", "C", "D"],
+                                "ResultLoc": ["s3://s3-csu-003/1",
+                                              "s3://s3-csu-003/1",
+                                              "foo", "s3://s3-csu-003/2"]})
+        consensus_objects, skipped = \
+            phylogeny.preflight_consensus(test_df, n_workers=2)
+        # each consensus folder is listed exactly once
+        mock_list_s3_object_metadata.assert_has_calls(
+            [mock.call("s3-csu-003", "1/consensus/", "/", mock.ANY),
+             mock.call("s3-csu-003", "2/consensus/", "/", mock.ANY)], any_order=True)
+        self.assertEqual(mock_list_s3_object_metadata.call_count, 2)
+        self.assertEqual(sorted(consensus_objects), ["A", "D"])
+        self.assertEqual(consensus_objects["A"]["Bucket"], "s3-csu-003")
+        self.assertEqual(consensus_objects["D"]["ETag"], "D")
+        self.assertEqual(sorted(skipped), ["B", "C"])
+        # skipped samples are left out of the multi fasta
+        with mock.patch("btbphylo.phylogeny.append_multi_fasta") as \
+                mock_append_multi_fasta, \
+                mock.patch("btbphylo.phylogeny.utils.s3_client"), \
+                mock.patch("builtins.open", mock.mock_open()):
+            phylogeny.build_multi_fasta("foo", test_df, mock.Mock(), skipped)
+        self.assertEqual([call.args[3] for call in
+                          mock_append_multi_fasta.call_args_list], ["A", "D"])
+
+    @mock.patch("btbphylo.phylogeny.time.sleep")
+    @mock.patch("btbphylo.phylogeny.storage.get_storage")
+    def test_download_consensus(self, mock_get_storage, _):
+        attempts = {}
+        # mock a missing object for "B", a transient error for "C" and a
+        # persistent error for "D"
+        def side_effect(bucket, key, dest):
+            attempts[key] = attempts.get(key, 0) + 1
+            if key == "b":
+                raise phylogeny.utils.NoS3ObjectError(bucket, key)
+            if key == "c" and attempts[key] == 1 or key == "d":
+                raise Exception("foo error")
+        mock_get_storage.return_value.download_file.side_effect = side_effect
+        # mock a consensus cache containing an up to date copy of "E"
+        mock_cache = mock.Mock()
+        mock_cache.get.side_effect = lambda sample, etag: "E.fas" if sample == "E" else None
+        mock_cache.temp_filepath.side_effect = lambda sample: f"bar/{sample}.fas"
+        consensus_objects = {sample: {"Bucket": "foo_bucket", "Key": sample.lower(), "ETag": sample}
+                             for sample in ["A", "B", "C", "D", "E"]}
+        errors = phylogeny.download_consensus(consensus_objects, mock_cache, n_workers=3, retries=2)
+        self.assertEqual(sorted(errors), ["B", "D"])
+        self.assertEqual(errors["D"], "foo error")
+        # cached samples are not downloaded and missing objects are not
+        # retried
+        self.assertDictEqual(attempts, {"a": 1, "b": 1, "c": 2, "d": 3})
+        # assert the worker pool shares a single storage backend
+        mock_get_storage.assert_called_once_with(max_pool_connections=3)
+        mock_get_storage.return_value.download_file.assert_any_call("foo_bucket", "a", "bar/A.fas")
+        # assert downloaded samples are added to the cache
+        mock_cache.put.assert_has_calls([mock.call("A", "A", "bar/A.fas"),
+                                         mock.call("C", "C", "bar/C.fas")], any_order=True)
+        self.assertEqual(mock_cache.put.call_count, 2)
+
+    def test_assemble_multi_fasta(self):
+        test_input = {"A": b">A\nACGT\nAC\n",
+                      "B": b">B_consensus\nNNGT\nA-\n",
+                      "C": b">C\nACGTAC\n",
+                      "D": b">D\nACGTACG\n",
+                      "E": b">E\nACGTAC\n"}
+        test_df = pd.DataFrame({"Sample": ["C", "A", "B", "D", "E", "F"]})
+        with tempfile.TemporaryDirectory() as consensus_path:
+            cache = phylogeny.consensus_cache.ConsensusCache(consensus_path)
+            for sample, contents in test_input.items():
+                # store sample "B" with the 2bit encoding
+                cache.encoding = "2bit" if sample == "B" else "fasta"
+                with open(cache.temp_filepath(sample), "wb") as f:
+                    f.write(contents)
+                cache.put(sample, None, cache.temp_filepath(sample))
+            multi_fasta_path = path.join(consensus_path, "multi_fasta.fas")
+            for copy_file_range in (os.copy_file_range, mock.Mock(side_effect=AttributeError)):
+                # test with and without kernel-side copies
+                with mock.patch("btbphylo.phylogeny.os.copy_file_range", copy_file_range):
+                    invalid = phylogeny.assemble_multi_fasta(multi_fasta_path, test_df, cache,
+                                                             skipped={"E": "foo"}, n_workers=3,
+                                                             reference_length=6)
+                # sample "D" has the wrong sequence length and "F" is
+                # not cached
+                self.assertEqual(sorted(invalid), ["D", "F"])
+                with open(multi_fasta_path, "rb") as f:
+                    self.assertEqual(f.read(), test_input["C"] + test_input["A"] + test_input["B"])
+            # test a truncated cache file is detected
+            with open(cache.record("A")["filepath"], "r+b") as f:
+                f.truncate(3)
+            with self.assertRaises(phylogeny.consensus_cache.CorruptCacheError):
+                phylogeny.assemble_multi_fasta(multi_fasta_path, test_df, cache,
+                                               reference_length=6)
+
+    def test_snp_sites_to_snp_matrix(self):
+        popen = phylogeny.subprocess.Popen
+        test_alignment = b">A\nACG\n>B\nATG\n"
+
+        def mock_popen(cmd, **kwargs):
+            # stand in for snp-sites with cat and snp-dists with wc
+            if cmd[0] == "snp-sites":
+                return popen(["cat", cmd[1]], **kwargs)
+            return popen(["wc", "-c"], **kwargs)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            multi_fasta_path = path.join(temp_dir, "multi_fasta.fas")
+            snp_dists_outpath = path.join(temp_dir, "snps.csv")
+            snp_sites_outpath = path.join(temp_dir, "snps.fas")
+            with open(multi_fasta_path, "wb") as f:
+                f.write(test_alignment)
+            with mock.patch("btbphylo.phylogeny.subprocess.Popen", side_effect=mock_popen):
+                # test relaying in small chunks without writing snps.fas
+                self.assertDictEqual(phylogeny.snp_sites_to_snp_matrix(snp_dists_outpath, multi_fasta_path,
+                                                                       chunk_size=5),
+                                     {"number_of_snps": 3})
+                self.assertFalse(path.exists(snp_sites_outpath))
+                with open(snp_dists_outpath, "rb") as f:
+                    self.assertEqual(int(f.read()), len(test_alignment))
+                # test teeing the snp alignment to snps.fas
+                phylogeny.snp_sites_to_snp_matrix(snp_dists_outpath, multi_fasta_path,
+                                                  snp_sites_outpath=snp_sites_outpath)
+                with open(snp_sites_outpath, "rb") as f:
+                    self.assertEqual(f.read(), test_alignment)
+            # test failures are raised
+            with mock.patch("btbphylo.phylogeny.subprocess.Popen",
+                            side_effect=lambda cmd, **kwargs: popen(["false"], **kwargs)):
+                with self.assertRaises(Exception):
+                    phylogeny.snp_sites_to_snp_matrix(snp_dists_outpath, multi_fasta_path)
 
     def test_extract_s3_bucket(self):
         # test good input
@@ -179,6 +354,23 @@ class TestPhylogeny(unittest.TestCase):
             print(f"{i} test failures")
             raise AssertionError
 
+    def test_post_process_snps_csv(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            snp_dists_outpath = path.join(temp_dir, "snps.csv")
+            with open(snp_dists_outpath, "w") as f:
+                f.write("snp-dists 0.8.2,AFT-61-03769-21_consensus,20-0620719_consensus,ABCDEFGH\n"
+                        "AFT-61-03769-21_consensus,0,12,3\n"
+                        "20-0620719_consensus,12,0,7\n"
+                        "ABCDEFGH,3,7,0\n")
+            # test equivalence with post_process_snps_df
+            expected = phylogeny.post_process_snps_df(pd.read_csv(snp_dists_outpath, index_col=0))
+            phylogeny.post_process_snps_csv(snp_dists_outpath)
+            self.assertFalse(path.exists(f"{snp_dists_outpath}.part"))
+            pd.testing.assert_frame_equal(pd.read_csv(snp_dists_outpath, index_col=0), expected,
+                                          check_names=False)
+            with open(snp_dists_outpath, "r") as f:
+                self.assertEqual(f.readline(), "snp-dists 0.8.2,AF-61-03769-21,20-0620719,ABCDEFGH\n")
+
     @mock.patch("btbphylo.phylogeny.process_sample_name")
     def test_post_process_snps_df(self, mock_process_sample_name):
         mock_process_sample_name.return_value = ["a", "b", "c", "d", "e", "f", "g", "h", "i", "j"]
@@ -0,0 +1,148 @@
+import unittest
+import tempfile
+from os import path
+
+import numpy as np
+
+from btbphylo import alignment
+from btbphylo import placement
+
+
+def leaf_sets(tree, sequences):
+    """
+        Returns the Fitch state sets of the leaves of tree from a dict
+        of sequences by name
+    """
+    return {node: placement.STATE_SETS[alignment.NUCLEOTIDE_CODES[
+                np.frombuffer(sequences[tree["name"][node]].encode(), dtype=np.uint8)]]
+            for node in placement.leaves(tree)}
+
+
+class TestPlacement(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.sequences = {"a": "AAAAAA", "b": "AAAAAC", "c": "CCCAAA", "d": "CCCAAG",
+                          "e": "AAATTT", "f": "AAATTA", "g": "CCCAAT"}
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_alignment(self, names):
+        snp_sites_path = path.join(self.temp_dir.name, "snps.fas")
+        with open(snp_sites_path, "w") as f:
+            for name in names:
+                f.write(f">{name}\n{self.sequences[name]}\n")
+        return snp_sites_path
+
+    def test_prune_graft(self):
+        tree = placement.from_newick("((a:1,b:2)90:1,c:3,(d:1,e:1)80:2);")
+        self.assertEqual(placement.to_newick(tree), "((a:1,b:2)90:1,c:3,(d:1,e:1)80:2);")
+        # pruning b splices out its parent
+        placement.prune(tree, 1)
+        self.assertEqual(placement.to_newick(tree), "(a:2,c:3,(d:1,e:1)80:2);")
+        node = placement.add_node(tree, "f")
+        placement.graft(tree, node, 2, 0.5)
+        self.assertEqual(placement.to_newick(tree), "(a:2,(c:1.5,f:0.5):1.5,(d:1,e:1)80:2);")
+        # grafting above the root makes a new root
+        node = placement.add_node(tree, "g")
+        placement.graft(tree, node, tree["root"], 1)
+        self.assertEqual(placement.to_newick(tree), "((a:2,(c:1.5,f:0.5):1.5,(d:1,e:1)80:2):0,g:1);")
+        self.assertEqual(sorted(placement.neighbourhood(tree, 0, 1)), [0, tree["parent"][0]])
+
+    def test_fitch(self):
+        tree = placement.from_newick("((a,b),(c,d),(e,f));")
+        sets = leaf_sets(tree, self.sequences)
+        down, score = placement.down_sets(tree, sets)
+        self.assertEqual(score, 8)
+        up = placement.up_sets(tree, down)
+        # the cost of attaching g to each branch is the change in score
+        g_sets = leaf_sets(placement.from_newick("(g);"), self.sequences)[0]
+        edges = placement.preorder(tree)[1:]
+        costs = placement.placement_costs(tree, down, up, g_sets, edges)
+        for edge, cost in zip(edges, costs):
+            grafted = placement.from_newick("((a,b),(c,d),(e,f));")
+            node = placement.add_node(grafted, "g")
+            placement.graft(grafted, node, edge, 0)
+            self.assertEqual(placement.down_sets(grafted, leaf_sets(grafted, self.sequences))[1],
+                             score + cost)
+        self.assertEqual(costs.min(), 1)
+
+    def test_update_tree(self):
+        previous_tree_path = path.join(self.temp_dir.name, "previous.nwk")
+        with open(previous_tree_path, "w") as f:
+            f.write("((a:1,b:1)100:1,c:1,(e:1,f:1)90:1);\n")
+        snp_sites_path = self.write_alignment(["a", "c", "d", "e", "f"])
+        for method in placement.PLACEMENT_METHODS:
+            metadata = placement.update_tree(previous_tree_path, self.temp_dir.name,
+                                             snp_sites_path, method, 2)
+            self.assertEqual(metadata["samples_placed"], 1)
+            self.assertEqual(metadata["samples_pruned"], 1)
+            with open(path.join(self.temp_dir.name, "placed_tree.nwk")) as f:
+                tree = placement.from_newick(f.read())
+            self.assertEqual(sorted(tree["name"][node] for node in placement.leaves(tree)),
+                             ["a", "c", "d", "e", "f"])
+            # d is placed next to c
+            c, d = (tree["name"].index(name) for name in "cd")
+            self.assertEqual(tree["parent"][c], tree["parent"][d])
+            self.assertIn("90", tree["label"])
+        # test too few samples
+        with self.assertRaises(placement.IncompatibleTreeError):
+            placement.update_tree(previous_tree_path, self.temp_dir.name,
+                                  self.write_alignment(["a", "c", "d"]))
+        # test an invalid tree
+        with open(previous_tree_path, "w") as f:
+            f.write("((a,b),c;\n")
+        with self.assertRaises(placement.IncompatibleTreeError):
+            placement.update_tree(previous_tree_path, self.temp_dir.name, snp_sites_path)
+
+    def test_regraft(self):
+        # a is misplaced next to e
+        tree = placement.from_newick("((c,d),((e,a),f),b);")
+        sets = leaf_sets(tree, self.sequences)
+        self.assertEqual(placement.down_sets(tree, sets)[1], 10)
+        fitch = placement.FitchSets(tree, sets)
+        a = tree["name"].index("a")
+        self.assertTrue(placement.regraft(fitch, a, 3))
+        self.assertEqual(placement.down_sets(tree, sets)[1], 8)
+        # a is now in place, and the tree is left as it was
+        newick = placement.to_newick(tree)
+        self.assertFalse(placement.regraft(fitch, a, 3))
+        self.assertEqual(placement.to_newick(tree), newick)
+        # only subtrees with a binary parent are moved
+        self.assertFalse(placement.regraft(fitch, tree["name"].index("b"), 3))
+
+    def test_fitch_sets(self):
+        rng = np.random.default_rng(0)
+        sequences = {f"s{i}": "".join(rng.choice(list("ACGTN"), 20)) for i in range(12)}
+        tree = placement.from_newick("((s0,s1),(s2,(s3,s4)),s5);")
+        sets = leaf_sets(tree, sequences)
+        fitch = placement.FitchSets(tree, sets)
+
+        def assert_sets():
+            down, _ = placement.down_sets(tree, sets)
+            up = placement.up_sets(tree, down)
+            nodes = placement.preorder(tree)
+            np.testing.assert_array_equal(fitch.down[nodes], down[nodes])
+            np.testing.assert_array_equal(fitch.up[nodes], up[nodes])
+
+        # the sets updated after each graft and prune are those of a full pass
+        for i in range(6, 12):
+            node = placement.add_node(tree, f"s{i}")
+            sets[node] = placement.STATE_SETS[
+                alignment.NUCLEOTIDE_CODES[np.frombuffer(sequences[f"s{i}"].encode(),
+                                                         dtype=np.uint8)]]
+            nodes = placement.preorder(tree)
+            fitch.graft(node, nodes[rng.integers(len(nodes))], 1.0)
+            assert_sets()
+        for node in placement.preorder(tree)[1:]:
+            if len(tree["children"][tree["parent"][node]]) == 2:
+                placement.regraft(fitch, node, 2)
+                assert_sets()
+                fitch.prune(node)
+                assert_sets()
+                fitch.graft(node, tree["root"], 1.0)
+                assert_sets()
+
+
+if __name__ == '__main__':
+    unittest.main()
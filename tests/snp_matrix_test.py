@@ -0,0 +1,83 @@
+import json
+import unittest
+import tempfile
+from os import path
+
+import numpy as np
+import numpy.testing as nptesting
+
+from btbphylo import distances
+from btbphylo import snp_matrix
+
+
+class TestSnpMatrix(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.matrix_path = path.join(self.temp_dir.name, "snps.npy")
+        self.csv_path = path.join(self.temp_dir.name, "snps.csv")
+        rng = np.random.default_rng(0)
+        matrix = rng.integers(0, 1000, (7, 7))
+        self.matrix = np.triu(matrix, 1) + np.triu(matrix, 1).T
+        self.names = [f"sample_{i}" for i in range(7)]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_write_triangle(self):
+        snp_matrix.write_triangle(self.matrix_path, self.names, self.matrix)
+        self.assertEqual(np.load(self.matrix_path).shape, (21,))
+        reader = snp_matrix.SnpMatrix(self.matrix_path)
+        self.assertEqual(reader.names, self.names)
+        for i, name in enumerate(self.names):
+            nptesting.assert_array_equal(reader.row(name), self.matrix[i])
+        nptesting.assert_array_equal(reader.submatrix(["sample_5", "sample_1", "sample_3"]),
+                                     self.matrix[np.ix_([5, 1, 3], [5, 1, 3])])
+        with self.assertRaises(KeyError):
+            reader.row("sample_7")
+        # test too large distances
+        with self.assertRaises(ValueError):
+            snp_matrix.write_triangle(self.matrix_path, self.names[:2],
+                                      np.array([[0, 70000], [70000, 0]]))
+        # test a single sample
+        snp_matrix.write_triangle(self.matrix_path, self.names[:1], np.zeros((1, 1)))
+        reader = snp_matrix.SnpMatrix(self.matrix_path)
+        nptesting.assert_array_equal(reader.submatrix(self.names[:1]), [[0]])
+
+    def test_csv_round_trip(self):
+        distances.write_snp_matrix(self.csv_path, self.names, self.matrix)
+        with open(self.csv_path, "r") as f:
+            expected = f.read()
+        snp_matrix.csv_to_triangle(self.matrix_path, self.csv_path)
+        reader = snp_matrix.SnpMatrix(self.matrix_path)
+        nptesting.assert_array_equal(reader.submatrix(self.names), self.matrix)
+        snp_matrix.SnpMatrix(self.matrix_path).to_csv(self.csv_path)
+        with open(self.csv_path, "r") as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_save_matrix(self):
+        snp_matrix.save_matrix(self.csv_path, self.names, self.matrix, "npy")
+        self.assertFalse(path.exists(self.csv_path))
+        self.assertEqual(snp_matrix.matrix_filepath(self.csv_path), self.matrix_path)
+        nptesting.assert_array_equal(snp_matrix.SnpMatrix(self.matrix_path).submatrix(self.names),
+                                     self.matrix)
+        snp_matrix.save_matrix(self.csv_path, self.names, self.matrix)
+        self.assertTrue(path.exists(self.csv_path))
+
+    def test_save_clade_matrices(self):
+        clade_names = {"B1-11": self.names[:3], "B6-11": self.names[3:]}
+        matrices = {"B1-11": self.matrix[:3, :3], "B6-11": self.matrix[3:, 3:]}
+        snp_matrix.save_clade_matrices(self.temp_dir.name, clade_names, matrices, "npy",
+                                       np.array([[0, 5], [5, 0]]))
+        with open(path.join(self.temp_dir.name, "index.json")) as f:
+            index = json.load(f)
+        self.assertEqual(index["clades"]["B6-11"], {"file": "B6-11.npy", "samples": 4})
+        reader = snp_matrix.SnpMatrix(path.join(self.temp_dir.name, "B6-11.npy"))
+        nptesting.assert_array_equal(reader.submatrix(self.names[3:]), self.matrix[3:, 3:])
+        with open(path.join(self.temp_dir.name, "cross_clade_minimums.csv")) as f:
+            self.assertEqual(f.read(), "clade,B1-11,B6-11\nB1-11,0,5\nB6-11,5,0\n")
+        snp_matrix.save_clade_matrices(self.temp_dir.name, clade_names, matrices)
+        self.assertTrue(path.exists(path.join(self.temp_dir.name, "B1-11.csv")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import time
+import unittest
+import tempfile
+from os import path
+
+from btbphylo import storage
+from btbphylo import utils
+
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root_path = self.temp_dir.name
+        # mock bucket with two batches under a pipeline version prefix
+        for key in ["v3-2/A/A_FinalOut.csv", "v3-2/A/consensus/a_consensus.fas",
+                    "v3-2/B/B_FinalOut.csv", "v3-2/README"]:
+            filepath = path.join(self.root_path, "s3-csu-003", key)
+            os.makedirs(path.dirname(filepath), exist_ok=True)
+            with open(filepath, "w") as f:
+                f.write(key)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_local_storage(self):
+        store = storage.LocalStorage(self.root_path)
+        # test listing with and without a delimiter
+        self.assertEqual([s3_object["Key"] for s3_object in store.list_objects("s3-csu-003", "v3-2/", "/")],
+                         ["v3-2/README"])
+        self.assertEqual([s3_object["Key"] for s3_object in store.list_objects("s3-csu-003", "v3-2/A")],
+                         ["v3-2/A/A_FinalOut.csv", "v3-2/A/consensus/a_consensus.fas"])
+        self.assertEqual(store.list_prefixes("s3-csu-003", "v3-2/"), ["v3-2/A/", "v3-2/B/"])
+        self.assertEqual(store.list_objects("s3-csu-003", "v3-3/"), [])
+        s3_object = store.list_objects("s3-csu-003", "v3-2/README")[0]
+        self.assertEqual(s3_object["Size"], 11)
+        self.assertIsNotNone(s3_object["LastModified"].tzinfo)
+        # test get, download and upload
+        self.assertEqual(store.get_object("s3-csu-003", "v3-2/README"), b"v3-2/README")
+        dest = path.join(self.root_path, "README")
+        store.download_file("s3-csu-003", "v3-2/README", dest)
+        self.assertTrue(path.exists(dest))
+        self.assertFalse(path.exists(f"{dest}.part"))
+        store.upload_file(dest, "s3-ranch-042", "prod/README")
+        self.assertEqual(store.get_object("s3-ranch-042", "prod/README"), b"v3-2/README")
+        # test missing objects
+        with self.assertRaises(utils.NoS3ObjectError):
+            store.get_object("s3-csu-003", "v3-2/foo")
+        with self.assertRaises(utils.NoS3ObjectError):
+            store.download_file("s3-csu-003", "v3-2/foo", dest)
+
+    def test_local_storage_throttle(self):
+        store = storage.LocalStorage(self.root_path, latency=0.05, bandwidth=110)
+        start = time.perf_counter()
+        store.get_object("s3-csu-003", "v3-2/README")
+        # 0.05 s latency + 11 bytes at 110 bytes/s
+        self.assertGreaterEqual(time.perf_counter() - start, 0.15)
+        self.assertDictEqual(store.stats, {"requests": 1, "bytes": 11})
+
+    def test_get_storage(self):
+        storage_uri = storage.get_storage_uri()
+        try:
+            storage.set_storage(f"file://{self.root_path}?latency=0.1")
+            store = storage.get_storage()
+            self.assertIsInstance(store, storage.LocalStorage)
+            self.assertEqual(store.root_path, self.root_path)
+            self.assertEqual(store.latency, 0.1)
+            for bad_uri in ["foo://bar", "file://", "file:///foo?bar=1"]:
+                with self.assertRaises(storage.BadStorageUriError):
+                    storage.set_storage(bad_uri)
+        finally:
+            storage.set_storage(storage_uri)
@@ -8,6 +8,16 @@ from consistify_test import TestConsistify
 from missing_samples_report_test import TestMissingSamplesReport
 from de_duplicate_test import TestDeDuplicate
 from utils_test import TestUtils
+from storage_test import TestStorage
+from consensus_cache_test import TestConsensusCache
+from alignment_test import TestAlignment
+from distances_test import TestDistances
+from incremental_test import TestIncremental
+from variant_profiles_test import TestVariantProfiles
+from snp_matrix_test import TestSnpMatrix
+from neighbour_joining_test import TestNeighbourJoining
+from mega_test import TestMega
+from placement_test import TestPlacement
 
 
 def test_suit(test_objs):
@@ -17,25 +27,85 @@ def test_suit(test_objs):
 
 if __name__ == "__main__":
     phylogeny_test = [TestPhylogeny('test_build_multi_fasta'),
+                      TestPhylogeny('test_build_multi_fasta_lengths'),
                       TestPhylogeny('test_extract_s3_bucket'),
                       TestPhylogeny('test_match_s3_uri'),
                       TestPhylogeny('test_process_sample_name'),
-                      TestPhylogeny('test_post_process_snps_df')]
+                      TestPhylogeny('test_post_process_snps_df'),
+                      TestPhylogeny('test_post_process_snps_csv'),
+                      TestPhylogeny('test_preflight_consensus'),
+                      TestPhylogeny('test_download_consensus'),
+                      TestPhylogeny('test_assemble_multi_fasta'),
+                      TestPhylogeny('test_snp_sites_to_snp_matrix')]
     filter_samples_test = [TestFilterSamples('test_filter_df'),
                            TestFilterSamples('test_filter_columns_numeric'),
-                           TestFilterSamples('test_filter_columns_categorical')]
+                           TestFilterSamples('test_filter_columns_categorical'),
+                           TestFilterSamples('test_parquet_filters')]
     de_duplicate_test = [TestDeDuplicate('test_remove_duplicates'),
+                         TestDeDuplicate('test_remove_duplicates_rules'),
+                         TestDeDuplicate('test_priority_chain'),
                          TestDeDuplicate('test_get_indexes_to_remove')]
     update_summary_test = [TestUpdateSummary('test_append_df_wgs'),
+                           TestUpdateSummary('test_download_finalouts'),
+                           TestUpdateSummary('test_get_finalout_s3_objects'),
                            TestUpdateSummary('test_get_finalout_s3_keys'),
-                           TestUpdateSummary('test_extract_s3_key')]
+                           TestUpdateSummary('test_new_final_out_keys'),
+                           TestUpdateSummary('test_seed_manifest'),
+                           TestUpdateSummary('test_list_finalout_objects'),
+                           TestUpdateSummary('test_load_save_manifest'),
+                           TestUpdateSummary('test_append_df_wgs_reprocessed')]
     missing_samples_report_test = [TestMissingSamplesReport('test_get_excluded'),
                                    TestMissingSamplesReport('test_exclusion_reason'),
                                    TestMissingSamplesReport('test_missing_data'),
                                    TestMissingSamplesReport('test_add_eartag_column')]
     consistify_test = [TestConsistify('test_consistify'),
                        TestConsistify('test_clade_correction')]
-    utils_test = [TestUtils('test_extract_submission_no')]
+    utils_test = [TestUtils('test_extract_submission_no'),
+                  TestUtils('test_is_parquet'),
+                  TestUtils('test_parquet_round_trip')]
+    storage_test = [TestStorage('test_local_storage'),
+                    TestStorage('test_local_storage_throttle'),
+                    TestStorage('test_get_storage')]
+    consensus_cache_test = [TestConsensusCache('test_get_put_read'),
+                            TestConsensusCache('test_checksum'),
+                            TestConsensusCache('test_shared_contents'),
+                            TestConsensusCache('test_evict'),
+                            TestConsensusCache('test_adopt_legacy'),
+                            TestConsensusCache('test_2bit_round_trip'),
+                            TestConsensusCache('test_migrate')]
+    alignment_test = [TestAlignment('test_fasta_records'),
+                      TestAlignment('test_snp_sites'),
+                      TestAlignment('test_snp_sites_equivalence')]
+    distances_test = [TestDistances('test_popcount'),
+                      TestDistances('test_build_snp_matrix'),
+                      TestDistances('test_pairwise_distances'),
+                      TestDistances('test_tiled_distances'),
+                      TestDistances('test_distance_matrix'),
+                      TestDistances('test_close_pairs'),
+                      TestDistances('test_clade_distances'),
+                      TestDistances('test_snp_dists_equivalence')]
+    incremental_test = [TestIncremental('test_build_state'),
+                        TestIncremental('test_update_state'),
+                        TestIncremental('test_update_state_incompatible')]
+    variant_profiles_test = [TestVariantProfiles('test_build_profile'),
+                             TestVariantProfiles('test_snp_sites'),
+                             TestVariantProfiles('test_profile_store')]
+    snp_matrix_test = [TestSnpMatrix('test_write_triangle'),
+                       TestSnpMatrix('test_csv_round_trip'),
+                       TestSnpMatrix('test_save_matrix'),
+                       TestSnpMatrix('test_save_clade_matrices')]
+    neighbour_joining_test = [TestNeighbourJoining('test_neighbour_joining'),
+                              TestNeighbourJoining('test_to_newick'),
+                              TestNeighbourJoining('test_build_tree')]
+    mega_test = [TestMega('test_write_mao'),
+                 TestMega('test_concurrent_jobs'),
+                 TestMega('test_bootstrap_supports'),
+                 TestMega('test_build_tree')]
+    placement_test = [TestPlacement('test_prune_graft'),
+                      TestPlacement('test_fitch'),
+                      TestPlacement('test_update_tree'),
+                      TestPlacement('test_regraft'),
+                      TestPlacement('test_fitch_sets')]
     runner = unittest.TextTestRunner()
     parser = argparse.ArgumentParser(description='Test code')
     module_arg = parser.add_argument('--module', '-m', nargs=1,
@@ -57,8 +127,28 @@ if __name__ == "__main__":
             runner.run(test_suit(consistify_test))
         elif args.module[0] == 'utils':
             runner.run(test_suit(utils_test))
+        elif args.module[0] == 'storage':
+            runner.run(test_suit(storage_test))
+        elif args.module[0] == 'consensus_cache':
+            runner.run(test_suit(consensus_cache_test))
+        elif args.module[0] == 'alignment':
+            runner.run(test_suit(alignment_test))
+        elif args.module[0] == 'distances':
+            runner.run(test_suit(distances_test))
+        elif args.module[0] == 'incremental':
+            runner.run(test_suit(incremental_test))
+        elif args.module[0] == 'variant_profiles':
+            runner.run(test_suit(variant_profiles_test))
+        elif args.module[0] == 'snp_matrix':
+            runner.run(test_suit(snp_matrix_test))
+        elif args.module[0] == 'neighbour_joining':
+            runner.run(test_suit(neighbour_joining_test))
+        elif args.module[0] == 'mega':
+            runner.run(test_suit(mega_test))
+        elif args.module[0] == 'placement':
+            runner.run(test_suit(placement_test))
         else:
             raise argparse.ArgumentError(module_arg,
-                                         "Invalid argument. Please use phylogeny, update_summary, filter_samples, consistify or utils")
+                                         "Invalid argument. Please use phylogeny, update_summary, filter_samples, consistify, utils, storage, consensus_cache, alignment, distances, incremental, variant_profiles, snp_matrix, neighbour_joining, mega or placement")
     else:
         unittest.main(buffer=True)
@@ -1,4 +1,8 @@
+import json
 import unittest
+import tempfile
+from os import path
+from datetime import datetime, timezone
 from unittest import mock
 
 import pandas as pd
@@ -8,8 +12,9 @@ from btbphylo import update_summary
 
 
 class TestUpdateSummary(unittest.TestCase):
+    @mock.patch("btbphylo.update_summary.utils.s3_client")
     @mock.patch("btbphylo.update_summary.finalout_s3_to_df")
-    def test_append_df_wgs(self, mock_finalout_s3_to_df):
+    def test_append_df_wgs(self, mock_finalout_s3_to_df, _):
         mock_finalout_s3_to_df.return_value = pd.DataFrame()
         # simulate 7 new keys
         test_new_keys = [0, 1, 2, 3, 4, 5, 6]
@@ -17,7 +22,7 @@ class TestUpdateSummary(unittest.TestCase):
         test_df_wgs = pd.DataFrame({"foo": [], "bar": [], "baz": []})
         with mock.patch("btbphylo.update_summary.add_submission_col") as mock_add_submission_col:
             # mock sequential return values of calls to update_summary.add_submission_col,
-            # this effectively mocks the return value of finalout_csv_to_df(new_keys[itteration]).pipe(add_submission_col)
+            # this effectively mocks the return value of finalout_s3_to_df(key).pipe(add_submission_col)
             mock_add_submission_col.side_effect = [pd.DataFrame({"foo": ["a"], "bar": ["a"], "baz": ["a"]}),
                                                    pd.DataFrame({"foo": ["b"], "bar": ["b"], "baz": ["b"]}),
                                                    pd.DataFrame({"foo": ["c"], "bar": ["c"], "baz": ["c"]}),
@@ -31,59 +36,174 @@ class TestUpdateSummary(unittest.TestCase):
                                          pd.DataFrame({"foo": ["a", "b", "c", "d", "e", "f", "g"],
                                                        "bar": ["a", "b", "c", "d", "e", "f", "g"],
                                                        "baz": ["a", "b", "c", "d", "e", "f", "g"]}).values)
-            finalout_csv_to_df_calls = [mock.call(0), mock.call(1), mock.call(2), mock.call(3),
-                                        mock.call(4), mock.call(5), mock.call(6)]
-            # assert recursion was called with correct order of arguments
-            mock_finalout_s3_to_df.assert_has_calls(finalout_csv_to_df_calls)
+            # assert a single, contiguous index after merging
+            pd.testing.assert_index_equal(test_output.index, pd.RangeIndex(7))
+            finalout_csv_to_df_calls = [mock.call(0, mock.ANY, mock.ANY), mock.call(1, mock.ANY, mock.ANY),
+                                        mock.call(2, mock.ANY, mock.ANY), mock.call(3, mock.ANY, mock.ANY),
+                                        mock.call(4, mock.ANY, mock.ANY), mock.call(5, mock.ANY, mock.ANY),
+                                        mock.call(6, mock.ANY, mock.ANY)]
+            # assert every key was downloaded (concurrently, so in any order)
+            mock_finalout_s3_to_df.assert_has_calls(finalout_csv_to_df_calls, any_order=True)
+
+    @mock.patch("btbphylo.update_summary.utils.s3_client")
+    @mock.patch("btbphylo.update_summary.finalout_s3_to_df")
+    def test_download_finalouts(self, mock_finalout_s3_to_df, mock_s3_client):
+        # mock a failure for key "b" and a dataframe for all other keys
+        def side_effect(key, *args):
+            if key == "b":
+                raise Exception("foo error")
+            return pd.DataFrame({"key": [key]})
+        mock_finalout_s3_to_df.side_effect = side_effect
+        test_dfs, test_errors = update_summary.download_finalouts(["a", "b", "c", "d"], n_workers=3)
+        # assert output order matches input order and failures are reported
+        self.assertEqual([df["key"][0] for df in test_dfs], ["a", "c", "d"])
+        self.assertDictEqual(test_errors, {"b": "foo error"})
+        # assert the worker pool shares a single client
+        mock_s3_client.assert_called_once_with(max_pool_connections=3)
+        stores = {call.args[2] for call in mock_finalout_s3_to_df.call_args_list}
+        self.assertEqual(len(stores), 1)
+        self.assertIs(stores.pop().client, mock_s3_client.return_value)
+
+    @mock.patch("btbphylo.update_summary.utils.s3_client")
+    def test_get_finalout_s3_objects(self, mock_s3_client):
+        # mock s3 listing: "v3-2/" and "v4/" each contain 1 top level object
+        # and a number of batch sub-prefixes
+        listings = {("v3-2/", "/"): [{"CommonPrefixes": [{"Prefix": "v3-2/A/"}],
+                                      "Contents": [{"Key": "v3-2/FinalOut_top.csv"}]},
+                                     {"CommonPrefixes": [{"Prefix": "v3-2/B/"}]}],
+                    ("v4/", "/"): [{"CommonPrefixes": [{"Prefix": "v4/C/"}],
+                                    "Contents": [{"Key": "v4/foo.csv"}]}],
+                    ("v3-2/A/", ""): [{"Contents": [{"Key": "v3-2/A/A_FinalOut.csv"},
+                                                    {"Key": "v3-2/A/bar.csv"}]},
+                                      {"Contents": [{"Key": "v3-2/A/consensus/baz.fas"}]}],
+                    ("v3-2/B/", ""): [{}],
+                    ("v4/C/", ""): [{"Contents": [{"Key": "v4/C/C_FinalOut.csv"}]}]}
+
+        def paginate(Bucket, Delimiter, Prefix):
+            pages = listings[(Prefix, Delimiter)]
+            for page in pages:
+                for s3_object in page.get("Contents", []):
+                    s3_object.update({"Size": 1, "ETag": '"etag"', "LastModified": "date"})
+            return pages
+        mock_s3_client.return_value.get_paginator.return_value.paginate.side_effect = paginate
+        test_output = update_summary.get_finalout_s3_objects(prefixes=["v4", "v3-2"], n_workers=2)
+        self.assertEqual(test_output,
+                         [{"Key": key, "Size": 1, "ETag": "etag", "LastModified": "date"} for key in
+                          ["v3-2/A/A_FinalOut.csv", "v3-2/FinalOut_top.csv", "v4/C/C_FinalOut.csv"]])
+        mock_s3_client.return_value.get_paginator.assert_called_with("list_objects_v2")
 
     def test_get_finalout_s3_keys(self):
-        # mock AWS s3 CLI command for getting s3 metadata
-        with mock.patch("btbphylo.update_summary.utils.run") as mock_run:
-            mock_run.return_value = "2022-06-28 06:38:51      45876 v3-2/Results_10032_27Jun22/10032_FinalOut_28Jun22.csv\n \
-                                     2022-06-28 06:38:51 45876 v3-2/Results_10032_27Jun22/bar\n \
-                                     a b c foo"
+        with mock.patch("btbphylo.update_summary.get_finalout_s3_objects") as mock_get_finalout_s3_objects:
+            mock_get_finalout_s3_objects.return_value = \
+                [{"Key": "v3-2/Results_10032_27Jun22/10032_FinalOut_28Jun22.csv", "Size": 45876},
+                 {"Key": "v3-2/Results_10033_28Jun22/10033_FinalOut_29Jun22.csv", "Size": 45876}]
             test_output = ["v3-2/Results_10032_27Jun22/10032_FinalOut_28Jun22.csv",
-                           "v3-2/Results_10032_27Jun22/bar",
-                           "foo"]
+                           "v3-2/Results_10033_28Jun22/10033_FinalOut_29Jun22.csv"]
             self.assertEqual(update_summary.get_finalout_s3_keys(), test_output)
 
-    def test_extract_s3_key(self):
-        # test case
-        test_input = ["2022-06-28 06:38:51      45876 v3-2/Results_10032_27Jun22/10032_FinalOut_28Jun22.csv",
-                      "2022-06-28 06:38:51 45876 v3-2/Results_10032_27Jun22/bar",
-                      "a b c foo"]
-        test_output = ["v3-2/Results_10032_27Jun22/10032_FinalOut_28Jun22.csv",
-                       "v3-2/Results_10032_27Jun22/bar",
-                       "foo"]
-        fail = False
-        for input, output in zip(test_input, test_output):
-            try:
-                self.assertEqual(update_summary.extract_s3_key(input), output)
-            except AssertionError as e:
-                fail = True
-                print(e)
-        if fail:
-            raise AssertionError
-
     def test_new_final_out_keys(self):
+        # test case: A, B and C ingested, D reprocessed in place after
+        # ingestion, E and F new
+        test_manifest = {"ingested": {"v3-2/A/FinalOut.csv": {"ETag": "a", "LastModified": "2022-06-01T00:00:00+00:00"},
+                                      "v3-2/B/FinalOut.csv": {"ETag": "b", "LastModified": "2022-06-02T00:00:00+00:00"},
+                                      "v3-2/C/FinalOut.csv": {"ETag": "c", "LastModified": "2022-06-03T00:00:00+00:00"},
+                                      "v3-2/D/FinalOut.csv": {"ETag": "d", "LastModified": "2022-06-03T00:00:00+00:00"}}}
+        test_objects = [{"Key": "v3-2/A/FinalOut.csv", "ETag": "a", "LastModified": "2022-06-01T00:00:00+00:00"},
+                        {"Key": "v3-2/B/FinalOut.csv", "ETag": "b", "LastModified": "2022-06-02T00:00:00+00:00"},
+                        {"Key": "v3-2/C/FinalOut.csv", "ETag": "c", "LastModified": "2022-06-03T00:00:00+00:00"},
+                        {"Key": "v3-2/D/FinalOut.csv", "ETag": "d2", "LastModified": "2022-06-05T00:00:00+00:00"},
+                        {"Key": "v3-2/E/FinalOut.csv", "ETag": "e", "LastModified": "2022-06-01T00:00:00+00:00"},
+                        {"Key": "v3-2/F/FinalOut.csv", "ETag": "f", "LastModified": "2022-06-06T00:00:00+00:00"}]
+        new_keys, changed_keys = update_summary.new_final_out_keys(test_objects, test_manifest)
+        self.assertEqual(new_keys, ["v3-2/E/FinalOut.csv", "v3-2/F/FinalOut.csv"])
+        self.assertEqual(changed_keys, ["v3-2/D/FinalOut.csv"])
+        # test empty manifest: all keys are new
+        new_keys, changed_keys = update_summary.new_final_out_keys(test_objects, {"ingested": {}})
+        self.assertEqual(new_keys, [s3_object["Key"] for s3_object in test_objects])
+        self.assertEqual(changed_keys, [])
+        # test a reprocessed batch that fails to ingest while a newer batch
+        # succeeds: it is compared again on the next run
+        update_summary.update_manifest(test_manifest, [s3_object for s3_object in test_objects
+                                                       if s3_object["Key"] in ("v3-2/E/FinalOut.csv",
+                                                                               "v3-2/F/FinalOut.csv")])
+        new_keys, changed_keys = update_summary.new_final_out_keys(test_objects, test_manifest)
+        self.assertEqual(new_keys, [])
+        self.assertEqual(changed_keys, ["v3-2/D/FinalOut.csv"])
+
+    def test_seed_manifest(self):
         # test case
         test_df = pd.DataFrame({"ResultLoc": ["s3://s3-csu-003/v3-2/A/",
                                               "s3://s3-csu-003/v3-2/A/",
-                                              "s3://s3-csu-003/v3-2/A/",
-                                              "s3://s3-csu-003/v3-2/B/",
                                               "s3://s3-csu-003/v3-2/B/",
-                                              "s3://s3-csu-003/v3-2/C/",
-                                              "s3://s3-csu-003/v3-2/D/",
-                                              "s3://s3-csu-003/v3-2/D/",
-                                              "s3://s3-csu-003/v3-2/E/"]})
-        # mock get_finalout_s3_keys
-        with mock.patch("btbphylo.update_summary.get_finalout_s3_keys") as mock_get_finalout_s3_keys:
-            mock_get_finalout_s3_keys.return_value = ["v3-2/A/FinalOut.csv",
-                                                      "v3-2/B/FinalOut.csv",
-                                                      "v3-2/C/FinalOut.csv",
-                                                      "v3-2/D/FinalOut.csv",
-                                                      "v3-2/E/FinalOut.csv",
-                                                      "v3-2/F/FinalOut.csv",
-                                                      "v3-2/G/FinalOut.csv"]
-            self.assertEqual(update_summary.new_final_out_keys(test_df), ["v3-2/F/FinalOut.csv",
-                                                                          "v3-2/G/FinalOut.csv"])
+                                              "s3://s3-csu-003/v3-2/C/"]})
+        test_objects = [{"Key": "v3-2/A/FinalOut.csv", "ETag": "a", "LastModified": "2022-06-01T00:00:00+00:00"},
+                        {"Key": "v3-2/B/FinalOut.csv", "ETag": "b", "LastModified": "2022-06-03T00:00:00+00:00"},
+                        {"Key": "v3-2/C/FinalOut.csv", "ETag": "c", "LastModified": "2022-06-02T00:00:00+00:00"},
+                        {"Key": "v3-2/D/FinalOut.csv", "ETag": "d", "LastModified": "2022-06-04T00:00:00+00:00"}]
+        test_manifest = {"ingested": {}}
+        update_summary.seed_manifest(test_manifest, test_df, test_objects)
+        # assert batches in test_df are recorded
+        self.assertEqual(sorted(test_manifest["ingested"]), ["v3-2/A/FinalOut.csv",
+                                                             "v3-2/B/FinalOut.csv",
+                                                             "v3-2/C/FinalOut.csv"])
+        self.assertEqual(update_summary.new_final_out_keys(test_objects, test_manifest),
+                         (["v3-2/D/FinalOut.csv"], []))
+
+    @mock.patch("btbphylo.update_summary.get_finalout_s3_objects")
+    def test_list_finalout_objects(self, mock_get_finalout_s3_objects):
+        mock_get_finalout_s3_objects.return_value = \
+            [{"Key": "v3-2/A/FinalOut.csv", "ETag": "a",
+              "LastModified": datetime(2022, 6, 1, tzinfo=timezone.utc)}]
+        test_manifest = {"listed_at": None, "prefixes": [], "listing": []}
+        test_objects = [{"Key": "v3-2/A/FinalOut.csv", "ETag": "a",
+                         "LastModified": "2022-06-01T00:00:00+00:00"}]
+        # test listing s3 and caching in the manifest
+        self.assertEqual(update_summary.list_finalout_objects(test_manifest, ["v3-2"], listing_ttl=60),
+                         test_objects)
+        self.assertEqual(test_manifest["listing"], test_objects)
+        # test cached listing is used within the ttl
+        self.assertEqual(update_summary.list_finalout_objects(test_manifest, ["v3-2"], listing_ttl=60),
+                         test_objects)
+        mock_get_finalout_s3_objects.assert_called_once()
+        # test s3 is listed when prefixes differ or caching is disabled
+        update_summary.list_finalout_objects(test_manifest, ["v3-2", "v4"], listing_ttl=60)
+        update_summary.list_finalout_objects(test_manifest, ["v3-2", "v4"], listing_ttl=0)
+        self.assertEqual(mock_get_finalout_s3_objects.call_count, 3)
+
+    def test_load_save_manifest(self):
+        with tempfile.TemporaryDirectory() as temp_dirname:
+            manifest_filepath = update_summary.get_manifest_filepath(path.join(temp_dirname, "foo.csv"))
+            self.assertEqual(manifest_filepath, path.join(temp_dirname, "foo_manifest.json"))
+            # test missing and empty manifests
+            self.assertEqual(update_summary.load_manifest(manifest_filepath)["ingested"], {})
+            open(manifest_filepath, "w").close()
+            self.assertEqual(update_summary.load_manifest(manifest_filepath)["ingested"], {})
+            # test round trip
+            test_manifest = update_summary.load_manifest(manifest_filepath)
+            update_summary.update_manifest(test_manifest, [{"Key": "v3-2/A/FinalOut.csv", "ETag": "a",
+                                                            "LastModified": "2022-06-01T00:00:00+00:00"}])
+            update_summary.save_manifest(test_manifest, manifest_filepath)
+            self.assertDictEqual(update_summary.load_manifest(manifest_filepath), test_manifest)
+            # test the watermark of an earlier version is discarded
+            with open(manifest_filepath, "w") as f:
+                json.dump(dict(test_manifest, watermark="2022-06-01T00:00:00+00:00"), f)
+            self.assertDictEqual(update_summary.load_manifest(manifest_filepath), test_manifest)
+
+    @mock.patch("btbphylo.update_summary.download_finalouts")
+    def test_append_df_wgs_reprocessed(self, mock_download_finalouts):
+        # test case: batch A is reprocessed successfully, batch B fails
+        test_df_wgs = pd.DataFrame({"Sample": ["a1", "a2", "b1"],
+                                    "ResultLoc": ["s3://s3-csu-003/v3-2/A/",
+                                                  "s3://s3-csu-003/v3-2/A/",
+                                                  "s3://s3-csu-003/v3-2/B/"]})
+        mock_download_finalouts.return_value = \
+            ([pd.DataFrame({"Sample": ["c1"], "ResultLoc": ["s3://s3-csu-003/v3-2/C/"]}),
+              pd.DataFrame({"Sample": ["a3"], "ResultLoc": ["s3://s3-csu-003/v3-2/A/"]})],
+             {"v3-2/B/FinalOut.csv": "foo error"})
+        test_output, metadata = \
+            update_summary.append_df_wgs(test_df_wgs, ["v3-2/C/FinalOut.csv"],
+                                         reprocessed_keys=["v3-2/A/FinalOut.csv", "v3-2/B/FinalOut.csv"])
+        self.assertEqual(list(test_output["Sample"]), ["b1", "c1", "a3"])
+        self.assertEqual(list(test_output["Submission"])[1:], ["C1", "A3"])
+        self.assertDictEqual(metadata, {"total_number_of_wgs_samples": 3,
+                                        "failed_batch_summaries": {"v3-2/B/FinalOut.csv": "foo error"}})
@@ -1,4 +1,9 @@
 import unittest
+import tempfile
+import importlib.util
+from os import path
+
+import pandas as pd
 
 from btbphylo import utils as utils
 
@@ -80,3 +85,39 @@ class TestUtils(unittest.TestCase):
         if fail:
             print(f"{i} test failures")
             raise AssertionError
+
+    def test_is_parquet(self):
+        self.assertTrue(utils.is_parquet("foo/all_wgs_samples.parquet"))
+        self.assertTrue(utils.is_parquet("foo/all_wgs_samples.parquet/"))
+        self.assertFalse(utils.is_parquet("foo/all_wgs_samples.csv"))
+        self.assertFalse(utils.is_parquet("foo.parquet/all_wgs_samples"))
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "requires pyarrow")
+    def test_parquet_round_trip(self):
+        test_df = pd.DataFrame({column: pd.Series([None]*5, dtype=object) for column in utils.WGS_DTYPES})
+        test_df["Sample"] = ["e", "d", "c", "b", "a"]
+        test_df["Submission"] = ["E", "D", "C", "B", "A"]
+        test_df["group"] = ["B1-11", "B6-84", "B1-11", None, "B6-84"]
+        test_df["Outcome"] = ["Pass", "Pass", "Fail", "Pass", "Pass"]
+        test_df["ResultLoc"] = ["s3://s3-csu-003/v3-2/A/"]*3 + ["s3://s3-csu-003/v3-2/B/"]*2
+        test_df["Ncount"] = [1.0, 2.0, 3.0, 4.0, 5.0]
+        test_df = test_df.astype(utils.WGS_DTYPES)
+        with tempfile.TemporaryDirectory() as temp_dirname:
+            for partition_by in ("group", "batch"):
+                summary_filepath = path.join(temp_dirname, f"{partition_by}.parquet")
+                # save twice to test overwriting an existing dataset
+                utils.save_wgs_samples(test_df.iloc[:2], summary_filepath, partition_by)
+                utils.save_wgs_samples(test_df, summary_filepath, partition_by)
+                # test row order, column order and dtypes survive partitioning
+                pd.testing.assert_frame_equal(utils.load_wgs_samples(summary_filepath), test_df,
+                                              check_categorical=False)
+                # test reading a subset of columns and rows
+                pd.testing.assert_frame_equal(
+                    utils.load_wgs_samples(summary_filepath, columns=["Sample", "Ncount"],
+                                           filters=[("group", "in", ["B6-84"]), ("Ncount", ">=", 2.0)]),
+                    pd.DataFrame({"Sample": ["d", "a"], "Ncount": [2.0, 5.0]}))
+                # test csv export
+                csv_filepath = path.join(temp_dirname, f"{partition_by}.csv")
+                utils.export_wgs_samples_csv(summary_filepath, csv_filepath)
+                pd.testing.assert_frame_equal(utils.load_wgs_samples(csv_filepath), test_df,
+                                              check_categorical=False)
@@ -0,0 +1,88 @@
+import os
+import unittest
+import tempfile
+from os import path
+
+import numpy as np
+import numpy.testing as nptesting
+
+from btbphylo import alignment
+from btbphylo import consensus_cache
+from btbphylo import variant_profiles
+
+
+class TestVariantProfiles(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.reference = alignment.NUCLEOTIDE_CODES[np.frombuffer(b"ACGTACGTAC", dtype=np.uint8)]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_build_profile(self):
+        profile = variant_profiles.build_profile(b">A x\nAGGTN\nN-TAa\n", self.reference)
+        self.assertEqual(profile["name"], "A")
+        self.assertEqual(profile["length"], 10)
+        nptesting.assert_array_equal(profile["positions"], [1, 9])
+        nptesting.assert_array_equal(profile["alleles"], [2, 0])
+        nptesting.assert_array_equal(profile["mask_starts"], [4])
+        nptesting.assert_array_equal(profile["mask_lengths"], [3])
+        # test serialisation round trip
+        decoded = variant_profiles.decode_profile(variant_profiles.encode_profile(profile))
+        for key in profile:
+            nptesting.assert_array_equal(decoded[key], profile[key])
+        with self.assertRaises(ValueError):
+            variant_profiles.build_profile(b">A\nACGT\n", self.reference)
+
+    def test_snp_sites(self):
+        # test equivalence with the native snp-sites engine on random
+        # alignments
+        rng = np.random.default_rng(0)
+        reference = rng.integers(0, 4, 300)
+        multi_fasta_path = path.join(self.temp_dir.name, "multi_fasta.fas")
+        snp_sites_path = path.join(self.temp_dir.name, "snps.fas")
+        for _ in range(20):
+            sequences = np.tile(reference, (rng.integers(1, 10), 1))
+            for sequence in sequences:
+                sequence[rng.choice(300, 5, replace=False)] = rng.integers(0, 4, 5)
+                start = rng.integers(0, 290)
+                sequence[start:start + rng.integers(0, 10)] = 4
+            records = [b">%d\n" % i + alignment.NUCLEOTIDES[sequence].tobytes() + b"\n"
+                       for i, sequence in enumerate(sequences)]
+            with open(multi_fasta_path, "wb") as f:
+                f.write(b"".join(records))
+            _, expected = alignment.snp_sites(snp_sites_path, multi_fasta_path)
+            profiles = [variant_profiles.build_profile(record, reference) for record in records]
+            positions = variant_profiles.snp_sites(profiles)
+            nptesting.assert_array_equal(positions, expected)
+            nptesting.assert_array_equal(variant_profiles.snp_codes(profiles, reference, positions),
+                                         sequences[:, positions])
+
+    def test_profile_store(self):
+        cache = consensus_cache.ConsensusCache(path.join(self.temp_dir.name, "consensus"))
+        for sample, contents in [("A", b">A\nAGGTACGTAC\n"), ("B", b">B\nACGTACGTNN\n"),
+                                 ("C", b">C\nACGT\n")]:
+            with open(cache.temp_filepath(sample), "wb") as f:
+                f.write(contents)
+            cache.put(sample, sample, cache.temp_filepath(sample))
+        profile_path = path.join(self.temp_dir.name, "profiles")
+        store = variant_profiles.ProfileStore(profile_path, self.reference)
+        # "C" is not the same length as the reference
+        self.assertEqual(list(store.update(["A", "B", "C"], cache)), ["C"])
+        store.save()
+        store = variant_profiles.ProfileStore(profile_path, self.reference)
+        self.assertEqual(store.update(["A", "B"], cache), {})
+        self.assertDictEqual(store.stats, {"built": 0, "reused": 2})
+        nptesting.assert_array_equal(store.get("A")["positions"], [1])
+        # test a changed consensus is profiled again
+        cache.index["A"]["ETag"] = "foo"
+        store.update(["A"], cache)
+        self.assertEqual(store.stats["built"], 1)
+        # test unused profiles are dropped and the data file compacted
+        store.save(samples=["A"])
+        self.assertEqual(list(store.entries), ["A"])
+        self.assertEqual(os.path.getsize(store.data_filepath), store.entries["A"]["size"])
+        nptesting.assert_array_equal(store.get("A")["positions"], [1])
+        # test profiles against another reference are discarded
+        store = variant_profiles.ProfileStore(profile_path, self.reference[::-1].copy())
+        self.assertDictEqual(store.entries, {})